@@ -66,7 +66,7 @@ def run_experiment(problem_size, shard_size, pipeline, priority, lru, eager, tru
     else:
         num_priorities = 1
     if (lru):
-        cache_size = 5
+        cache_size = None
     else:
         cache_size = 0
 
@@ -91,7 +91,7 @@ def run_experiment(problem_size, shard_size, pipeline, num_priorities, lru, eage
     instructions, trailing, L_sharded = compiler._chol(XXT_sharded, truncate=truncate)
     pipeline_width = args.pipeline
     if (lru):
-        cache_size = 5
+        cache_size = None
     else:
         cache_size = 0
     pywren_config = pwex.config
@@ -7,27 +7,39 @@ from numpywren.compiler import lpcompile_for_execution
 from numpywren.algs import CHOLESKY, TSQR, GEMM, QR, BDFAC
 from numpywren.matrix_utils import constant_zeros, constant_zeros_ext
 from numpywren.matrix_init import shard_matrix
+from numpywren.block_manifest import RedisBlockManifest
 import dill
 import numpywren as npw
 import time
 
 
+def _attach_manifest(program, matrices):
+    '''
+    Track written, zero and deduplicated blocks of matrices on the control
+    plane. Only pass intermediates, blocks of a program's outputs must be
+    stored under their own keys to be readable once the control plane is gone.
+    '''
+    manifest = RedisBlockManifest(program.control_plane, namespace=program.hash)
+    for M in matrices:
+        M.manifest = manifest
 
-def cholesky(X, truncate=0):
+
+def cholesky(X, truncate=0, materialize=False, num_priorities=1):
     S = BigMatrix("Cholesky.Intermediate({0})".format(X.key), shape=(X.num_blocks(1)+1, X.shape[0], X.shape[0]), shard_sizes=(1, X.shard_sizes[0], X.shard_sizes[0]), bucket=X.bucket, write_header=True, parent_fn=constant_zeros)
     #S.free()
     O = BigMatrix("Cholesky({0})".format(X.key), shape=(X.shape[0], X.shape[0]), shard_sizes=(X.shard_sizes[0], X.shard_sizes[0]), write_header=True, parent_fn=constant_zeros)
     t = time.time()
-    p0= lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"])
+    p0= lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"], materialize=materialize)
     p1 = p0(O,X,S,int(np.ceil(X.shape[0]/X.shard_sizes[0])), truncate)
     e = time.time()
     c_time = e - t
     config = npw.config.default()
-    program = lp.LambdaPackProgram(p1, config=config)
+    program = lp.LambdaPackProgram(p1, config=config, num_priorities=num_priorities)
+    _attach_manifest(program, [S])
     return program, {"outputs":[O], "intermediates": [S], "compile_time": c_time}
 
 
-def tsqr(X, truncate=0):
+def tsqr(X, truncate=0, materialize=False, num_priorities=1):
     b_fac = 2
     assert(X.shard_sizes[1] == X.shape[1])
     shard_size = X.shard_sizes[0]
@@ -37,16 +49,16 @@ def tsqr(X, truncate=0):
     T_sharded= BigMatrix("tsqr_T({0})".format(X.key), shape=(num_tree_levels*shard_size*b_fac, X.shape[0]), shard_sizes=(shard_size*b_fac, shard_size), write_header=True, safe=False)
     V_sharded= BigMatrix("tsqr_V({0})".format(X.key), shape=(num_tree_levels*shard_size*b_fac, X.shape[0]), shard_sizes=(shard_size*b_fac, shard_size), write_header=True, safe=False)
     t = time.time()
-    p0 = lpcompile_for_execution(TSQR, inputs=["A"], outputs=["Rs"])
+    p0 = lpcompile_for_execution(TSQR, inputs=["A"], outputs=["Rs"], materialize=materialize)
     config = npw.config.default()
     N_blocks = X.num_blocks(0)
     p1 = p0(X, V_sharded, T_sharded, R_sharded, N_blocks)
     e = time.time()
     c_time = e - t
-    program = lp.LambdaPackProgram(p1, config=config)
+    program = lp.LambdaPackProgram(p1, config=config, num_priorities=num_priorities)
     return program, {"outputs":[R_sharded, V_sharded, T_sharded], "intermediates": [], "compile_time": c_time}
 
-def gemm(A, B):
+def gemm(A, B, materialize=False, num_priorities=1):
     b_fac = 4
     assert(A.shape[1] == B.shape[0])
     assert(A.shard_sizes[1] == B.shard_sizes[0])
@@ -56,15 +68,16 @@ def gemm(A, B):
     C_sharded= BigMatrix("matmul_test_C", shape=(A.shape[0], B.shape[1]), shard_sizes=shard_sizes, write_header=True)
     config = npw.config.default()
     t = time.time()
-    p0 = lpcompile_for_execution(GEMM, inputs=["A", "B"], outputs=["Out"])
+    p0 = lpcompile_for_execution(GEMM, inputs=["A", "B"], outputs=["Out"], materialize=materialize)
     print("tree depth", np.ceil(np.log(B.num_blocks(1))/np.log(4)))
     p1 = p0(A, B, A.num_blocks(0), A.num_blocks(1), B.num_blocks(1), Temp, C_sharded)
     e = time.time()
     c_time = e - t
-    program = lp.LambdaPackProgram(p1, config=config)
+    program = lp.LambdaPackProgram(p1, config=config, num_priorities=num_priorities)
+    _attach_manifest(program, [Temp])
     return program, {"outputs":[C_sharded], "intermediates":[Temp], "compile_time": c_time}
 
-def qr(A):
+def qr(A, materialize=False, num_priorities=1):
     b_fac = 2
     N = A.shape[0]
     N_blocks = A.num_blocks(0)
@@ -80,16 +93,17 @@ def qr(A):
     print("Ts", Ts.shape)
     print("Vs", Vs.shape)
     t = time.time()
-    p0 = lpcompile_for_execution(QR, inputs=["I"], outputs=["Rs"])
+    p0 = lpcompile_for_execution(QR, inputs=["I"], outputs=["Rs"], materialize=materialize)
     p1 = p0(A, Vs, Ts, Rs, Ss, N_blocks, 0)
     e = time.time()
     c_time = e - t
     config = npw.config.default()
-    program = lp.LambdaPackProgram(p1, config=config)
+    program = lp.LambdaPackProgram(p1, config=config, num_priorities=num_priorities)
+    _attach_manifest(program, [Ss])
     return program, {"outputs":[Rs, Vs, Ts], "intermediates":[Ss], "compile_time": c_time}
 
 
-def bdfac(A, truncate=0):
+def bdfac(A, truncate=0, materialize=False, num_priorities=1):
     b_fac = 2
     N = A.shape[0]
     N_blocks = A.num_blocks(0)
@@ -105,12 +119,13 @@ def bdfac(A, truncate=0):
     L_LQ = BigMatrix("L_LQ", shape=(2*N, num_tree_levels, 2*N), parent_fn=constant_zeros_ext, shard_sizes=(1, 1, shard_size), write_header=True, safe=False)
     S_LQ = BigMatrix("S_LQ", shape=(2*N, num_tree_levels, 2*N, 2*N), parent_fn=constant_zeros_ext, shard_sizes=(1, 1, shard_size, shard_size), write_header=True, safe=False)
     t = time.time()
-    p0 = lpcompile_for_execution(BDFAC, inputs=["I"], outputs=["R_QR", "L_LQ"])
+    p0 = lpcompile_for_execution(BDFAC, inputs=["I"], outputs=["R_QR", "L_LQ"], materialize=materialize)
     p1 = p0(A, V_QR, T_QR, S_QR, R_QR, V_LQ, T_LQ, S_LQ, L_LQ, N_blocks, truncate)
     e = time.time()
     c_time = e - t
     config = npw.config.default()
-    program = lp.LambdaPackProgram(p1, config=config)
+    program = lp.LambdaPackProgram(p1, config=config, num_priorities=num_priorities)
+    _attach_manifest(program, [S_LQ, S_QR, T_QR, V_QR, V_LQ, T_LQ])
     return program, {"outputs":[L_LQ, R_QR], "intermediates":[S_LQ, S_QR, T_QR, V_QR, V_LQ, T_LQ], "compile_time": c_time}
 
 
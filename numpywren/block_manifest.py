@@ -0,0 +1,246 @@
+import abc
+from collections import namedtuple
+import json
+
+import numpy as np
+
+# states of a block in the manifest
+MISSING = 0
+WRITTEN = 1
+ZERO = 2
+ALIAS = 3
+
+# a block whose entry aliases another stored object
+BlockReference = namedtuple("BlockReference", ["entries_key", "offset", "bucket", "key"])
+
+
+class BlockManifest(abc.ABC):
+    '''
+    Record of which blocks of a BigMatrix have been written.
+
+    BigMatrix consults the manifest before reading a block. Blocks that were
+    never written are generated locally by parent_fn, blocks recorded as all
+    zero are materialized locally, and blocks whose contents were already
+    stored elsewhere are read from that alias. None of these cost a storage
+    round trip on write and the first two cost none on read either.
+    '''
+
+    @abc.abstractmethod
+    def get_entry(self, matrix, block_idx):
+        ''' Return (state, target), target is the (bucket, key) of an ALIAS '''
+        pass
+
+    @abc.abstractmethod
+    def mark_written(self, matrix, block_idx, digest=None):
+        pass
+
+    @abc.abstractmethod
+    def mark_zero(self, matrix, block_idx):
+        pass
+
+    @abc.abstractmethod
+    def mark_alias(self, matrix, block_idx, target):
+        pass
+
+    @abc.abstractmethod
+    def mark_deleted(self, matrix, block_idx):
+        pass
+
+    @abc.abstractmethod
+    def claim_content(self, matrix, block_idx, digest):
+        '''
+        Record block_idx as written if a block with the given content digest
+        is already stored. Returns (target, refs): target is the (bucket, key)
+        the contents are stored at or None if the block has to be stored, refs
+        the BlockReferences that need their own copy of the object at the
+        block's key before it is overwritten.
+        '''
+        pass
+
+    @abc.abstractmethod
+    def references(self, bucket, key):
+        ''' BlockReferences of all blocks aliasing the object at (bucket, key) '''
+        pass
+
+    @abc.abstractmethod
+    def resolve_reference(self, bucket, key, ref):
+        ''' Record that ref now holds its own copy of the object at (bucket, key) '''
+        pass
+
+    @abc.abstractmethod
+    def clear(self, matrix):
+        pass
+
+    def is_written(self, matrix, block_idx):
+        return self.get_entry(matrix, block_idx)[0] != MISSING
+
+    @staticmethod
+    def block_offset(matrix, block_idx):
+        ''' Position of block_idx in the row-major enumeration of matrix blocks '''
+        num_blocks = [matrix.num_blocks(i) for i in range(len(matrix.shape))]
+        return int(np.ravel_multi_index(tuple(block_idx), num_blocks))
+
+
+# KEYS: bitmap, entries hash, content digest -> object hash, object -> content
+# digest hash. ARGV: refs key prefix, offset, object, reference, mode, value.
+# "claim" looks value up as a content digest and turns into "written" or
+# "alias" if the contents are already stored, otherwise it returns the
+# references to the object that need their own copy before it is overwritten
+# and changes nothing. Every other mode first drops whatever the manifest
+# knew about the block (its alias reference, digest and entry) and records
+# the new state: "written" (value is the content digest or ""), "zero",
+# "alias" (value is the target object) or "deleted".
+MANIFEST_SCRIPT = """
+local prefix, offset, obj, ref, mode, value = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6]
+local result = {mode}
+if mode == 'claim' then
+  local target = redis.call('HGET', KEYS[3], value)
+  if not target then
+    return {'store', redis.call('SMEMBERS', prefix .. obj)}
+  elseif target == obj then
+    mode = 'written'
+  else
+    mode = 'alias'
+    value = target
+  end
+  result = {mode, target}
+end
+local entry = redis.call('HGET', KEYS[2], offset)
+if entry and string.sub(entry, 1, 6) == 'alias:' then
+  redis.call('SREM', prefix .. string.sub(entry, 7), ref)
+end
+local old_digest = redis.call('HGET', KEYS[4], obj)
+if old_digest then
+  if redis.call('HGET', KEYS[3], old_digest) == obj then
+    redis.call('HDEL', KEYS[3], old_digest)
+  end
+  redis.call('HDEL', KEYS[4], obj)
+end
+redis.call('HDEL', KEYS[2], offset)
+if mode == 'written' then
+  if value ~= '' then
+    redis.call('HSET', KEYS[3], value, obj)
+    redis.call('HSET', KEYS[4], obj, value)
+  end
+elseif mode == 'zero' then
+  redis.call('HSET', KEYS[2], offset, 'zero')
+elseif mode == 'alias' then
+  redis.call('HSET', KEYS[2], offset, 'alias:' .. value)
+  redis.call('SADD', prefix .. value, ref)
+end
+redis.call('SETBIT', KEYS[1], offset, mode == 'deleted' and 0 or 1)
+return result
+"""
+
+
+class RedisBlockManifest(BlockManifest):
+    '''
+    Manifest kept in redis: one bitmap per matrix with a bit per block that
+    has an entry, a hash per matrix holding the zero/alias entries, and for
+    deduplication a content digest -> object index shared by every matrix
+    in the namespace.
+
+    The manifest only holds a reference to the control plane so it can be
+    shipped to workers along with the matrix. Every update of a block is a
+    single MANIFEST_SCRIPT call, so concurrent writers never see it half done.
+    '''
+    def __init__(self, control_plane, namespace="", dedup=True):
+        self.control_plane = control_plane
+        self.namespace = namespace
+        self.dedup = dedup
+
+    def _key(self, matrix):
+        return "{0}_manifest_{1}/{2}".format(self.namespace, matrix.bucket, matrix.key_base)
+
+    def _entries_key(self, matrix):
+        return self._key(matrix) + "_entries"
+
+    def _content_key(self):
+        return "{0}_manifest_content".format(self.namespace)
+
+    def _digest_key(self):
+        return "{0}_manifest_digest".format(self.namespace)
+
+    def _refs_prefix(self):
+        return "{0}_manifest_refs_".format(self.namespace)
+
+    def _refs_key(self, bucket, key):
+        return self._refs_prefix() + self._object_str(bucket, key)
+
+    @staticmethod
+    def _object_str(bucket, key):
+        return "{0}/{1}".format(bucket, key)
+
+    @staticmethod
+    def _parse_object_str(s):
+        bucket, _, key = s.partition("/")
+        return (bucket, key)
+
+    def get_entry(self, matrix, block_idx):
+        offset = self.block_offset(matrix, block_idx)
+        pipe = self.control_plane.client.pipeline()
+        pipe.getbit(self._key(matrix), offset)
+        pipe.hget(self._entries_key(matrix), offset)
+        bit, entry = pipe.execute()
+        if (bit != 1):
+            return (MISSING, None)
+        if (entry == None):
+            return (WRITTEN, None)
+        entry = entry.decode('utf-8')
+        if (entry == "zero"):
+            return (ZERO, None)
+        return (ALIAS, self._parse_object_str(entry[len("alias:"):]))
+
+    def _update(self, matrix, block_idx, mode, value=""):
+        offset = self.block_offset(matrix, block_idx)
+        key = matrix.__shard_idx_to_key__(block_idx)
+        ref = BlockReference(self._entries_key(matrix), offset, matrix.bucket, key)
+        keys = [self._key(matrix), self._entries_key(matrix), self._content_key(), self._digest_key()]
+        args = [self._refs_prefix(), offset, self._object_str(matrix.bucket, key), json.dumps(list(ref)), mode, value]
+        script = self.control_plane.client.register_script(MANIFEST_SCRIPT)
+        return script(keys=keys, args=args)
+
+    def mark_written(self, matrix, block_idx, digest=None):
+        self._update(matrix, block_idx, "written", digest or "")
+
+    def mark_zero(self, matrix, block_idx):
+        self._update(matrix, block_idx, "zero")
+
+    def mark_alias(self, matrix, block_idx, target):
+        self._update(matrix, block_idx, "alias", self._object_str(*target))
+
+    def mark_deleted(self, matrix, block_idx):
+        self._update(matrix, block_idx, "deleted")
+
+    def claim_content(self, matrix, block_idx, digest):
+        res = self._update(matrix, block_idx, "claim", digest)
+        if (res[0] == b"store"):
+            return (None, [BlockReference(*json.loads(ref.decode('utf-8'))) for ref in res[1]])
+        return (self._parse_object_str(res[1].decode('utf-8')), [])
+
+    def references(self, bucket, key):
+        refs = self.control_plane.client.smembers(self._refs_key(bucket, key))
+        return [BlockReference(*json.loads(ref.decode('utf-8'))) for ref in refs]
+
+    def resolve_reference(self, bucket, key, ref):
+        pipe = self.control_plane.client.pipeline()
+        pipe.hdel(ref.entries_key, ref.offset)
+        pipe.srem(self._refs_key(bucket, key), json.dumps(list(ref)))
+        pipe.execute()
+
+    def clear(self, matrix):
+        client = self.control_plane.client
+        pipe = client.pipeline()
+        entries = client.hgetall(self._entries_key(matrix))
+        for offset, entry in entries.items():
+            entry = entry.decode('utf-8')
+            if (entry.startswith("alias:")):
+                for ref in self.references(*self._parse_object_str(entry[len("alias:"):])):
+                    if (ref.entries_key == self._entries_key(matrix)):
+                        pipe.srem(self._refs_key(*self._parse_object_str(entry[len("alias:"):])), json.dumps(list(ref)))
+        pipe.delete(self._key(matrix))
+        pipe.delete(self._entries_key(matrix))
+        pipe.execute()
+
+    def num_written(self, matrix):
+        return self.control_plane.client.bitcount(self._key(matrix))
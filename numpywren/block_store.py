@@ -0,0 +1,293 @@
+import abc
+import os
+import shutil
+import tempfile
+
+import boto3
+import botocore
+
+from . import client_pool
+from .exceptions import BlockNotFoundException
+
+DEFAULT_SHM_ROOT = "/dev/shm/numpywren"
+DEFAULT_LOCAL_ROOT = os.path.join(tempfile.gettempdir(), "numpywren")
+S3_ENDPOINT_URL = os.environ.get("NUMPYWREN_S3_ENDPOINT_URL")
+READ_CHUNK_SIZE = 1 << 20
+
+
+class BlockStore(abc.ABC):
+    '''
+    Storage backend for BigMatrix shards and headers.
+
+    A block store maps (bucket, key) pairs to raw bytes. BigMatrix takes care of
+    (de)serializing blocks, so a backend only needs to move bytes around. Every
+    store must be picklable since BigMatrix objects are shipped to workers.
+    '''
+
+    @abc.abstractmethod
+    async def get_async(self, bucket, key, loop=None):
+        ''' Return the bytes stored at key, raise BlockNotFoundException if missing '''
+        pass
+
+    @abc.abstractmethod
+    async def put_async(self, bucket, key, data, loop=None):
+        pass
+
+    @abc.abstractmethod
+    async def delete_async(self, bucket, key, loop=None):
+        pass
+
+    @abc.abstractmethod
+    async def exists_async(self, bucket, key, loop=None):
+        pass
+
+    @abc.abstractmethod
+    def get(self, bucket, key):
+        pass
+
+    @abc.abstractmethod
+    def put(self, bucket, key, data):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, bucket, key):
+        pass
+
+    @abc.abstractmethod
+    def exists(self, bucket, key):
+        pass
+
+    @abc.abstractmethod
+    def list_keys(self, bucket, prefix):
+        ''' Return all keys stored directly underneath prefix '''
+        pass
+
+
+class S3BlockStore(BlockStore):
+    def __init__(self, region=None):
+        self.region = region
+
+    def _region(self):
+        if (self.region == ""):
+            return None
+        return self.region
+
+    async def _client(self, loop):
+        return await client_pool.get_client('s3', loop=loop, region_name=self._region(),
+                                            endpoint_url=S3_ENDPOINT_URL)
+
+    async def get_async(self, bucket, key, loop=None):
+        client = await self._client(loop)
+        try:
+            resp = await client.get_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            raise BlockNotFoundException("Key {0} does not exist in bucket {1}".format(key, bucket))
+        # fill a preallocated buffer rather than joining chunks, so callers
+        # get a writeable buffer without another copy
+        data = bytearray(resp['ContentLength'])
+        view = memoryview(data)
+        pos = 0
+        async with resp['Body'] as stream:
+            while (pos < len(data)):
+                chunk = await stream.read(min(READ_CHUNK_SIZE, len(data) - pos))
+                if (len(chunk) == 0):
+                    break
+                view[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+        if (pos != len(data)):
+            raise botocore.exceptions.IncompleteReadError(actual_bytes=pos, expected_bytes=len(data))
+        return data
+
+    async def put_async(self, bucket, key, data, loop=None):
+        client = await self._client(loop)
+        return await client.put_object(Key=key,
+                                       Bucket=bucket,
+                                       Body=data,
+                                       ACL="bucket-owner-full-control")
+
+    async def delete_async(self, bucket, key, loop=None):
+        client = await self._client(loop)
+        return await client.delete_object(Key=key, Bucket=bucket)
+
+    async def exists_async(self, bucket, key, loop=None):
+        client = await self._client(loop)
+        try:
+            await client.head_object(Bucket=bucket, Key=key)
+            return True
+        except botocore.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] != '404':
+                raise
+            return False
+
+    def get(self, bucket, key):
+        client = boto3.client('s3', region_name=self._region(), endpoint_url=S3_ENDPOINT_URL)
+        try:
+            return client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except botocore.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            raise BlockNotFoundException("Key {0} does not exist in bucket {1}".format(key, bucket))
+
+    def put(self, bucket, key, data):
+        client = boto3.client('s3', region_name=self._region(), endpoint_url=S3_ENDPOINT_URL)
+        return client.put_object(Key=key,
+                                 Bucket=bucket,
+                                 Body=data,
+                                 ACL="bucket-owner-full-control")
+
+    def delete(self, bucket, key):
+        client = boto3.client('s3', region_name=self._region(), endpoint_url=S3_ENDPOINT_URL)
+        return client.delete_object(Bucket=bucket, Key=key)
+
+    def exists(self, bucket, key):
+        client = boto3.client('s3', region_name=self._region(), endpoint_url=S3_ENDPOINT_URL)
+        try:
+            client.head_object(Bucket=bucket, Key=key)
+            return True
+        except botocore.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] != '404':
+                raise
+            return False
+
+    def list_keys(self, bucket, prefix):
+        client = boto3.client('s3', region_name=self._region(), endpoint_url=S3_ENDPOINT_URL)
+        objects = client.list_objects(Bucket=bucket, Prefix=prefix + "/", Delimiter=prefix)
+        if (objects.get('Contents') == None):
+            return []
+        keys = list(map(lambda x: x['Key'], objects.get('Contents', [] )))
+        truncated = objects['IsTruncated']
+        next_marker = objects.get('NextMarker')
+        while truncated:
+            objects = client.list_objects(Bucket=bucket, Prefix=prefix,
+                                          Delimiter=prefix, Marker=next_marker)
+            truncated = objects['IsTruncated']
+            next_marker = objects.get('NextMarker')
+            keys += list(map(lambda x: x['Key'], objects['Contents']))
+        return list(filter(lambda x: len(x) > 0, keys))
+
+    def __str__(self):
+        return "s3"
+
+
+class LocalBlockStore(BlockStore):
+    '''
+    Block store backed by a directory on the local filesystem.
+
+    Objects live at <root>/<bucket>/<key>, byte for byte what would be stored
+    in S3, so a shard is the raw header-plus-body format of shard_format that
+    any process on the host can read. Writes go through a temporary file and
+    an atomic rename so concurrent readers never observe a partial block.
+    '''
+    def __init__(self, root=DEFAULT_LOCAL_ROOT):
+        self.root = os.path.abspath(root)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    # Local reads and writes run at memory/disk bandwidth so there is little to
+    # gain from handing them to a thread pool, the async variants just wrap the
+    # synchronous ones.
+    async def get_async(self, bucket, key, loop=None):
+        return self.get(bucket, key)
+
+    async def put_async(self, bucket, key, data, loop=None):
+        return self.put(bucket, key, data)
+
+    async def delete_async(self, bucket, key, loop=None):
+        return self.delete(bucket, key)
+
+    async def exists_async(self, bucket, key, loop=None):
+        return self.exists(bucket, key)
+
+    def get(self, bucket, key):
+        try:
+            with open(self._path(bucket, key), "rb") as f:
+                data = bytearray(os.fstat(f.fileno()).st_size)
+                f.readinto(data)
+                return data
+        except FileNotFoundError:
+            raise BlockNotFoundException("Key {0} does not exist in {1}".format(key, os.path.join(self.root, bucket)))
+
+    def put(self, bucket, key, data):
+        path = self._path(bucket, key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if (isinstance(data, str)):
+                    data = data.encode('utf-8')
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            if (os.path.exists(tmp_path)):
+                os.remove(tmp_path)
+            raise
+        return None
+
+    def delete(self, bucket, key):
+        try:
+            os.remove(self._path(bucket, key))
+        except FileNotFoundError:
+            pass
+        return None
+
+    def exists(self, bucket, key):
+        return os.path.isfile(self._path(bucket, key))
+
+    def list_keys(self, bucket, prefix):
+        dirname = self._path(bucket, prefix)
+        if (not os.path.isdir(dirname)):
+            return []
+        keys = []
+        for name in sorted(os.listdir(dirname)):
+            if (name.startswith(".tmp.")): continue
+            if (os.path.isfile(os.path.join(dirname, name))):
+                keys.append(prefix + "/" + name)
+        return keys
+
+    def clear(self):
+        ''' Remove every object in this store '''
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __str__(self):
+        return "local:{0}".format(self.root)
+
+
+class SharedMemoryBlockStore(LocalBlockStore):
+    '''
+    LocalBlockStore rooted in /dev/shm so that blocks never touch disk,
+    useful to run a whole program on a single large machine.
+    '''
+    def __init__(self, root=DEFAULT_SHM_ROOT):
+        if (not os.path.isdir(os.path.dirname(os.path.abspath(root)))):
+            raise Exception("Shared memory directory {0} not available on this platform".format(os.path.dirname(root)))
+        super().__init__(root)
+
+    def __str__(self):
+        return "shm:{0}".format(self.root)
+
+
+def get_block_store(spec=None, region=None):
+    '''
+    Build a block store from a spec string:
+        * "s3" - S3BlockStore (default)
+        * "local" or "local:<root>" - LocalBlockStore
+        * "shm" or "shm:<root>" - SharedMemoryBlockStore
+    If spec is None the NUMPYWREN_BLOCK_STORE environment variable is used.
+    '''
+    if (spec is None):
+        spec = os.environ.get("NUMPYWREN_BLOCK_STORE", "s3")
+    if (isinstance(spec, BlockStore)):
+        return spec
+    kind, _, root = spec.partition(":")
+    if (kind == "s3"):
+        return S3BlockStore(region=region)
+    elif (kind == "local"):
+        return LocalBlockStore(root or DEFAULT_LOCAL_ROOT)
+    elif (kind == "shm"):
+        return SharedMemoryBlockStore(root or DEFAULT_SHM_ROOT)
+    else:
+        raise Exception("Unknown block store {0}".format(spec))
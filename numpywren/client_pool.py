@@ -0,0 +1,79 @@
+import asyncio
+import os
+import weakref
+
+import aiobotocore
+from aiobotocore.config import AioConfig
+
+MAX_POOL_CONNECTIONS = int(os.environ.get("NUMPYWREN_MAX_POOL_CONNECTIONS", 64))
+KEEPALIVE_TIMEOUT = 12
+
+_pools = weakref.WeakKeyDictionary()
+
+
+class ClientPool(object):
+    '''
+    Long lived aiobotocore clients shared by every coroutine running on one
+    event loop. Each (service, region, endpoint) gets a single client whose
+    aiohttp connector keeps up to max_pool_connections keep-alive connections
+    open, so block reads/writes and queue calls skip client creation and
+    TCP/TLS setup after the first request.
+    '''
+    def __init__(self, loop, max_pool_connections=MAX_POOL_CONNECTIONS):
+        self.loop = loop
+        self.max_pool_connections = max_pool_connections
+        self.session = aiobotocore.get_session(loop=loop)
+        self.clients = {}
+        self.contexts = {}
+        self.lock = asyncio.Lock(loop=loop)
+
+    async def get_client(self, service, region_name=None, endpoint_url=None):
+        key = (service, region_name, endpoint_url)
+        client = self.clients.get(key)
+        if (client is not None):
+            return client
+        async with self.lock:
+            if (key not in self.clients):
+                config = AioConfig(max_pool_connections=self.max_pool_connections,
+                                   connector_args={"keepalive_timeout": KEEPALIVE_TIMEOUT})
+                context = self.session.create_client(service, use_ssl=False, verify=False,
+                                                     region_name=region_name,
+                                                     endpoint_url=endpoint_url,
+                                                     config=config)
+                self.clients[key] = await context.__aenter__()
+                self.contexts[key] = context
+        return self.clients[key]
+
+    async def close(self):
+        contexts = list(self.contexts.values())
+        self.clients = {}
+        self.contexts = {}
+        for context in contexts:
+            await context.__aexit__(None, None, None)
+
+
+def get_pool(loop=None, max_pool_connections=None):
+    ''' Return the client pool for loop, creating it if needed '''
+    if (loop == None):
+        loop = asyncio.get_event_loop()
+    pool = _pools.get(loop)
+    if (pool is None):
+        if (max_pool_connections is None):
+            max_pool_connections = MAX_POOL_CONNECTIONS
+        pool = ClientPool(loop, max_pool_connections=max_pool_connections)
+        _pools[loop] = pool
+    return pool
+
+
+async def get_client(service, loop=None, region_name=None, endpoint_url=None):
+    pool = get_pool(loop)
+    return await pool.get_client(service, region_name=region_name, endpoint_url=endpoint_url)
+
+
+async def close_pool(loop=None):
+    ''' Close every client opened on loop, must run before loop.close() '''
+    if (loop == None):
+        loop = asyncio.get_event_loop()
+    pool = _pools.pop(loop, None)
+    if (pool is not None):
+        await pool.close()
@@ -0,0 +1,157 @@
+'''
+Persistent on-disk cache for lpcompile_for_execution.
+
+Two kinds of entries are kept, both pickled into one file per key under
+CACHE_DIR:
+
+    typed IR          keyed by the hash of the function source
+    derived program   starters, terminator count, dependency analysis tables
+                      and (if requested) the materialized DAG, keyed by the
+                      source hash and the arguments the program was built
+                      with (integer values, matrix shapes and shard sizes)
+
+Nothing in an entry refers to a particular BigMatrix, so a program compiled
+for new matrices of the same size is served from the cache. Hits refresh
+an entry's mtime and the least recently used entries are evicted once the
+cache grows past CACHE_MAX_BYTES.
+'''
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import tempfile
+
+from numpywren.matrix import BigMatrix
+from numpywren.version import __version__
+
+CACHE_DIR = os.environ.get("NUMPYWREN_COMPILE_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".numpywren", "compile_cache"))
+CACHE_MAX_BYTES = int(os.environ.get("NUMPYWREN_COMPILE_CACHE_MAX_BYTES", 1 << 30))
+# set NUMPYWREN_COMPILE_CACHE=0 to always compile from scratch
+CACHE_ENABLED = os.environ.get("NUMPYWREN_COMPILE_CACHE", "1") != "0"
+# bump whenever the format of cached IR or derived tables changes
+CACHE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class CompileCache(object):
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr((CACHE_VERSION, __version__, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest + ".pkl")
+
+    def get(self, key):
+        ''' Cached value for key or None '''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # unreadable entry (partial write, incompatible pickle), recompile
+            self.misses += 1
+            self._remove(path)
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        ''' Cache value for key, best effort: a failed write is only logged '''
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        except OSError as e:
+            logger.warning("Compile cache {0} is not writable: {1}".format(self.root, e))
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+            self.evict()
+        except Exception as e:
+            logger.warning("Could not write compile cache entry: {0}".format(e))
+            self._remove(tmp_path)
+
+    def evict(self):
+        ''' Remove least recently used entries until the cache fits in max_bytes '''
+        entries = []
+        for name in os.listdir(self.root):
+            if (not name.endswith(".pkl")): continue
+            path = os.path.join(self.root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if (total <= self.max_bytes):
+                break
+            self._remove(path)
+            total -= size
+
+    def size(self):
+        if (not os.path.isdir(self.root)):
+            return 0
+        return sum([os.path.getsize(os.path.join(self.root, x)) for x in os.listdir(self.root) if x.endswith(".pkl")])
+
+    def clear(self):
+        if (not os.path.isdir(self.root)):
+            return
+        for name in os.listdir(self.root):
+            if (name.endswith(".pkl")):
+                self._remove(os.path.join(self.root, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # already gone, or the cache directory is not writable
+            pass
+
+
+_default_cache = None
+
+def get_cache():
+    ''' The process wide cache, None if caching is disabled '''
+    global _default_cache
+    if (not CACHE_ENABLED):
+        return None
+    if (_default_cache is None):
+        _default_cache = CompileCache()
+    return _default_cache
+
+
+def source_hash(function):
+    return hashlib.sha1(inspect.getsource(function).encode('utf-8')).hexdigest()
+
+
+def args_key(args, kwargs):
+    '''
+    Hashable description of the arguments a program is built with. Matrices
+    are described by shape and shard sizes and by which earlier argument
+    they are (if any), since the dependency tables depend on which
+    arguments name the same matrix.
+    '''
+    args = list(args) + [kwargs[k] for k in sorted(kwargs.keys())]
+    key = []
+    for i, arg in enumerate(args):
+        if (isinstance(arg, BigMatrix)):
+            same_as = [j for j in range(i) if args[j] is arg]
+            key.append(("matrix", tuple(arg.shape), tuple(arg.shard_sizes), same_as[0] if same_as else None))
+        elif (isinstance(arg, (int, float, bool, str))):
+            key.append((type(arg).__name__, arg))
+        else:
+            key.append((type(arg).__name__, repr(arg)))
+    return (tuple(sorted(kwargs.keys())), tuple(key))
@@ -7,6 +7,8 @@ import logging
 import time
 from numpywren.matrix import BigMatrix
 from numpywren.matrix_init import shard_matrix
+from numpywren.dag import MaterializedDAG
+from numpywren import compile_cache
 from numpywren import exceptions, compiler, utils
 import asyncio
 import numpy as np
@@ -20,9 +22,16 @@ import sympy
 from sympy import Symbol
 from numbers import Number
 import copy
+import os
 
 
-def lpcompile(function):
+def typed_ir(function, cache=None):
+    ''' Parse and type check function, the result is cached per source hash '''
+    if (cache is not None):
+        key = ("typed_ir", compile_cache.source_hash(function))
+        lp_ast_type_checked = cache.get(key)
+        if (lp_ast_type_checked is not None):
+            return lp_ast_type_checked
     function_ast = ast.parse(inspect.getsource(function)).body[0]
     logging.debug("Python AST:\n{}\n".format(astor.dump(function_ast)))
     parser = frontend.LambdaPackParse()
@@ -31,42 +40,152 @@ def lpcompile(function):
     logging.debug("IR AST:\n{}\n".format(astor.dump_tree(lp_ast)))
     lp_ast_type_checked = type_checker.visit(lp_ast)
     logging.debug("typed IR AST:\n{}\n".format(astor.dump_tree(lp_ast_type_checked)))
+    if (cache is not None):
+        cache.put(key, lp_ast_type_checked)
+    return lp_ast_type_checked
+
+def lpcompile(function, cache=None):
+    lp_ast_type_checked = typed_ir(function, cache=cache)
     def f(*args, **kwargs):
         backend_generator = frontend.BackendGenerate(*args, **kwargs)
         backend_generator.visit(lp_ast_type_checked)
         return backend_generator.remote_calls
     return f
 
-def lpcompile_for_execution(function, inputs, outputs):
-    _f = lpcompile(function)
+# number of find_children/find_parents/is_terminator/eval_expr results a
+# compiled program keeps around
+MEMO_SIZE = int(os.environ.get("NUMPYWREN_MEMO_SIZE", 4096))
+
+def lpcompile_for_execution(function, inputs, outputs, materialize=False, cache=None):
+    ''' If materialize is True the whole DAG is built at compile time (see
+        CompiledLambdaPackProgram.materialize), only use it for programs whose
+        nodes can all be enumerated.
+        Typed IR, starters, terminators and dependency tables are kept in the
+        on-disk compile_cache, cache=None uses the default cache and
+        cache=False compiles from scratch
+    '''
+    if (cache is None):
+        cache = compile_cache.get_cache()
+    elif (cache is False):
+        cache = None
+    _f = lpcompile(function, cache=cache)
     def f(*args, **kwargs):
         remote_calls = _f(*args, **kwargs)
-        starters = find_starters(remote_calls, inputs)
-        num_terminators = len(find_terminators(remote_calls, outputs))
-        return CompiledLambdaPackProgram(remote_calls, starters, num_terminators, inputs, outputs)
+        derived = None
+        if (cache is not None):
+            key = ("program", compile_cache.source_hash(function), compile_cache.args_key(args, kwargs),
+                   tuple(inputs), tuple(outputs), materialize)
+            derived = cache.get(key)
+        if (derived is None):
+            starters = find_starters(remote_calls, inputs)
+            num_terminators = count_terminators(remote_calls, outputs)
+            analysis = DependencyAnalysis(remote_calls)
+            program = CompiledLambdaPackProgram(remote_calls, starters, num_terminators, inputs, outputs, analysis=analysis)
+            if (materialize):
+                program.materialize()
+            if (cache is not None):
+                derived = {"starters": starters, "num_terminators": num_terminators,
+                           "analysis": analysis.tables(),
+                           "dag": program.dag.dumps() if program.dag is not None else None}
+                cache.put(key, derived)
+            return program
+        analysis = DependencyAnalysis(remote_calls, tables=derived["analysis"])
+        program = CompiledLambdaPackProgram(remote_calls, derived["starters"], derived["num_terminators"], inputs, outputs, analysis=analysis)
+        if (derived["dag"] is not None):
+            program.materialize(MaterializedDAG.loads(derived["dag"]))
+        return program
     return f
 
 class CompiledLambdaPackProgram(object):
-    def __init__(self, remote_calls, starters, num_terminators, inputs, outputs):
+    def __init__(self, remote_calls, starters, num_terminators, inputs, outputs, analysis=None):
         self.remote_calls = remote_calls
         self.starters = starters
         self.num_terminators = num_terminators
         self.inputs = inputs
         self.outputs = outputs
+        if (analysis is None):
+            analysis = DependencyAnalysis(remote_calls)
+        self.analysis = analysis
+        self.dag = None
+        # the outermost loop of the last line in a loop runs over the panels,
+        # lines outside it (e.g. an unrolled first panel) make up panel 0
+        panel_loops = [outer_loop(r_call.scope) for _, r_call in sorted(remote_calls.items())]
+        panel_loop = ([None] + [x for x in panel_loops if x is not None])[-1]
+        self.line_priorities = {i: line_priority(r_call.scope, panel_loop) for i, r_call in remote_calls.items()}
+        self.num_panels = 1 + max([x[3] for x in self.line_priorities.values() if x is not None] + [0])
+        self.memo = utils.LRUMemo(MEMO_SIZE)
+
+    def materialize(self, dag=None):
+        ''' Resolve children and parent counts from a MaterializedDAG of the
+            whole program, built here unless a previously saved one is given
+        '''
+        if (dag is None):
+            dag = MaterializedDAG.build(walk_program(self.remote_calls), self.analysis.find_children)
+        self.dag = dag
+        return dag
+
+    @staticmethod
+    def _memo_key(i, value_map):
+        return (i, tuple(sorted(value_map.items())))
 
     def find_children(self, i, value_map):
-        return find_children(self.remote_calls, i, value_map)
+        if (self.dag is not None):
+            return self.dag.find_children(i, value_map)
+        children = self.memo.get("find_children", self._memo_key(i, value_map),
+                                 lambda: self.analysis.find_children(i, value_map))
+        return [(p_idx, dict(x)) for p_idx, x in children]
 
     def find_parents(self, i, value_map):
-        return find_parents(self.remote_calls, i, value_map)
+        parents = self.memo.get("find_parents", self._memo_key(i, value_map),
+                                lambda: self.analysis.find_parents(i, value_map))
+        return [(p_idx, dict(x)) for p_idx, x in parents]
+
+    def num_parents(self, i, value_map):
+        if (self.dag is not None):
+            return self.dag.num_parents(i, value_map)
+        return len(self.find_parents(i, value_map))
+
+    def priority(self, i, value_map):
+        '''
+        How much of the critical path is still ahead of a node, from 0 to 1,
+        nodes with higher priorities should run first. Exact bottom levels are
+        used once the DAG is materialized, otherwise the fraction of the
+        panels left after the node's panel, so every line of an earlier panel
+        outranks every line of a later one.
+        '''
+        if (self.dag is not None):
+            return self.dag.priority(i, value_map)
+        line = self.line_priorities[i]
+        if (line is None):
+            return 1.0
+        var, start, step, count = line
+        panel = (value_map[var] - start)//step + 1
+        return float(self.num_panels - panel)/self.num_panels
 
     def is_terminator(self, i):
-        return writes_to(self.remote_calls, i, self.outputs)
+        return self.memo.get("is_terminator", i, lambda: writes_to(self.remote_calls, i, self.outputs))
 
     def eval_expr(self, i, value_map):
+        # the evaluated call is memoized, instructions carry execution
+        # state so every call gets a fresh InstructionBlock
         r_call = self.remote_calls[i]
-        ib = eval_remote_call(r_call, value_map)
-        return ib
+        evaluated = self.memo.get("eval_expr", self._memo_key(i, value_map),
+                                  lambda: eval_remote_call_args(r_call, value_map))
+        block = remote_call_block(*evaluated)
+        block.priority = self.priority(i, value_map)
+        return block
+
+    def memo_stats(self, reset=False):
+        return self.memo.stats(reset=reset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["memo"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memo = utils.LRUMemo(MEMO_SIZE)
 
 
 
@@ -93,8 +212,6 @@ def eval_index_expr(index_expr, scope, dummify=False):
 def isinstance_fast(obj, typ):
     return type(obj) == typ
 
-memoize = {}
-
 def eval_expr(expr, scope, dummify=False):
     if (isinstance(expr, sympy.Basic)):
         return expr
@@ -144,39 +261,56 @@ def eval_expr(expr, scope, dummify=False):
 
 
 def eval_remote_call(r_call_with_scope, value_map):
+    return remote_call_block(*eval_remote_call_args(r_call_with_scope, value_map))
+
+def eval_remote_call_args(r_call_with_scope, value_map):
+    ''' Evaluate everything a remote call depends on value_map for: the kernel,
+        its arguments (IndexExprs become (matrix, indices) pairs), its keyword
+        arguments and its outputs as (matrix, indices, layout)
+    '''
     r_call = r_call_with_scope.remote_call
     compute = r_call.compute
     scope = copy_scope(r_call_with_scope.scope)
     scope.update(value_map)
-    pyarg_list = []
-    pyarg_symbols = []
+    args = []
     for i, _arg in enumerate(r_call.args):
-        pyarg_symbols.append(str(i))
         if (isinstance(_arg, IndexExpr)):
-            matrix, indices = eval_index_expr(_arg, scope)
-            arg = lp.RemoteRead(0, matrix, *indices)
+            args.append((True, eval_index_expr(_arg, scope)))
         else:
-            arg = eval_expr(_arg, scope)
-
-        pyarg_list.append(arg)
-
-    num_args = len(pyarg_list)
-    num_outputs = len(r_call.output)
+            args.append((False, eval_expr(_arg, scope)))
     if (r_call.kwargs is None):
         r_call_kwargs = {}
     else:
         r_call_kwargs = r_call.kwargs
 
-    compute_instr  = lp.RemoteCall(0, compute, pyarg_list, num_outputs, pyarg_symbols, **r_call_kwargs)
     outputs = []
-
+    layouts = getattr(compute, "layouts", None)
     for i, output in enumerate(r_call.output):
         assert isinstance(output, IndexExpr)
         matrix, indices = eval_index_expr(output, scope)
-        op = lp.RemoteWrite(i + num_args, matrix, compute_instr.results, i, *indices)
-        outputs.append(op)
+        layout = layouts[i] if layouts is not None else None
+        outputs.append((matrix, indices, layout))
+    return compute, args, r_call_kwargs, outputs
+
+def remote_call_block(compute, args, r_call_kwargs, outputs):
+    ''' Build a fresh InstructionBlock from the result of eval_remote_call_args '''
+    pyarg_list = []
+    pyarg_symbols = []
+    for i, (is_read, arg) in enumerate(args):
+        pyarg_symbols.append(str(i))
+        if (is_read):
+            matrix, indices = arg
+            arg = lp.RemoteRead(0, matrix, *indices)
+        pyarg_list.append(arg)
+
+    num_args = len(pyarg_list)
+    num_outputs = len(outputs)
+    compute_instr  = lp.RemoteCall(0, compute, pyarg_list, num_outputs, pyarg_symbols, **r_call_kwargs)
+    write_instrs = []
+    for i, (matrix, indices, layout) in enumerate(outputs):
+        op = lp.RemoteWrite(i + num_args, matrix, compute_instr.results, i, *indices, layout=layout)
+        write_instrs.append(op)
     read_instrs =  [x for x in pyarg_list if isinstance(x, lp.RemoteRead)]
-    write_instrs = outputs
     return lp.InstructionBlock(read_instrs + [compute_instr] + write_instrs)
 
 
@@ -621,13 +755,260 @@ def find_parents(program, idx, value_map):
     return integerify_solutions(utils.remove_duplicates(parents))
 
 
+class IndexSolver(object):
+    ''' Closed form solution of abstract_offset == offset for the loop variables
+        of one program line. At compile time the loop variables are ordered so
+        that each is either solved from an index affine in it (with
+        coefficients depending only on variables placed before it) or, if no
+        index determines it, enumerated over its range. Solving is then integer
+        arithmetic instead of a sympy solve. Use IndexSolver.build, which
+        returns None for index expressions that need the general template_match.
+    '''
+    # returned by solve when a coefficient vanishes for the given offset
+    UNSOLVABLE = "unsolvable"
+
+    def __init__(self, steps, checks, limits):
+        self.steps = steps
+        self.checks = checks
+        self.limits = limits
+
+    @classmethod
+    def build(cls, abstract_offset, scope):
+        range_vars = extract_range_vars(scope)
+        var_names = sorted(range_vars.keys())
+        symbols = [Symbol(x) for x in var_names]
+        exprs = [sympy.sympify(x) for x in abstract_offset]
+        limit_exprs = {}
+        for var in var_names:
+            range_var = range_vars[var]
+            limit_exprs[var] = [sympy.sympify(eval_expr(x, scope, dummify=True))
+                                for x in (range_var.start, range_var.end, range_var.step)]
+        known = []
+        steps = []
+        unused = list(range(len(exprs)))
+        while (len(known) < len(symbols)):
+            step = None
+            for pos in unused:
+                free = [x for x in exprs[pos].free_symbols if x not in known]
+                if (len(free) != 1 or free[0] not in symbols): continue
+                var = free[0]
+                coeff = sympy.diff(exprs[pos], var)
+                const = sympy.expand(exprs[pos] - coeff*var)
+                if (coeff.has(var) or const.has(var) or coeff == 0): continue
+                step = ("solve", str(var), pos, IntFunction(coeff, known), IntFunction(const, known))
+                unused.remove(pos)
+                break
+            if (step is None):
+                # nothing left determines a variable, enumerate one whose range is known
+                for var in symbols:
+                    if (var in known): continue
+                    limit_symbols = set().union(*[x.free_symbols for x in limit_exprs[str(var)]])
+                    if (not limit_symbols.issubset(set(known))): continue
+                    step = ("enumerate", str(var)) + tuple(IntFunction(x, known) for x in limit_exprs[str(var)])
+                    break
+            if (step is None):
+                return None
+            steps.append(step)
+            known.append(Symbol(step[1]))
+        checks = [(pos, IntFunction(exprs[pos], symbols)) for pos in unused]
+        limits = [(var, [IntFunction(x, symbols) for x in limit_exprs[var]]) for var in var_names]
+        return cls(steps, checks, limits)
+
+    def solve(self, offset):
+        ''' List of the loop variable values for which the index expression
+            equals offset, or UNSOLVABLE if template_match has to decide
+        '''
+        sols = [{}]
+        for step in self.steps:
+            new_sols = []
+            if (step[0] == "solve"):
+                _, var, pos, coeff_fn, const_fn = step
+                for sol in sols:
+                    coeff = coeff_fn(sol)
+                    const = const_fn(sol)
+                    if (not (is_integer(coeff) and is_integer(const))):
+                        return self.UNSOLVABLE
+                    coeff = int(coeff)
+                    if (coeff == 0):
+                        return self.UNSOLVABLE
+                    num = int(offset[pos]) - int(const)
+                    if (num % coeff == 0):
+                        sol[var] = num // coeff
+                        new_sols.append(sol)
+            else:
+                _, var, start_fn, end_fn, step_fn = step
+                for sol in sols:
+                    start, end, stride = start_fn(sol), end_fn(sol), step_fn(sol)
+                    if (not (is_integer(start) and is_integer(end) and is_integer(stride))):
+                        continue
+                    for i in range(int(start), int(end), int(stride)):
+                        new_sol = sol.copy()
+                        new_sol[var] = i
+                        new_sols.append(new_sol)
+            sols = new_sols
+        return [sol for sol in sols if self._valid(sol, offset)]
+
+    def _valid(self, sol, offset):
+        for pos, fn in self.checks:
+            if (fn(sol) != offset[pos]):
+                return False
+        for var, (start_fn, end_fn, step_fn) in self.limits:
+            start, end, step = start_fn(sol), end_fn(sol), step_fn(sol)
+            if (not (is_integer(start) and is_integer(end) and is_integer(step))):
+                return False
+            if (sol[var] not in range(int(start), int(end), int(step))):
+                return False
+        return True
+
+class IntFunction(object):
+    ''' expr over symbols as a function of a {name: value} dict. Expressions
+        built from integer arithmetic alone are evaluated in plain python,
+        anything involving ceiling/floor/log goes through sympy. Only the
+        expression is pickled, workers compile it again on first use
+    '''
+    def __init__(self, expr, symbols):
+        self.expr = sympy.sympify(expr)
+        self.names = [str(x) for x in symbols if x in self.expr.free_symbols]
+        self._f = None
+
+    def _compile(self):
+        if (len(self.names) == 0):
+            val = int(self.expr) if self.expr.is_integer else self.expr
+            return lambda: val
+        exact = all([isinstance(x, (sympy.Add, sympy.Mul, sympy.Pow, sympy.Symbol, sympy.Integer))
+                     for x in sympy.preorder_traversal(self.expr)])
+        symbols = [Symbol(x) for x in self.names]
+        if (exact):
+            return sympy.lambdify(symbols, self.expr, modules="math")
+        return sympy.lambdify(symbols, self.expr, modules=("sympy", {"ceil":sympy.ceiling}))
+
+    def __call__(self, sol):
+        if (self._f is None):
+            self._f = self._compile()
+        return self._f(*[sol[x] for x in self.names])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_f"] = None
+        return state
+
+class DependencyAnalysis(object):
+    ''' Compile time dependency analysis of a program.
+
+        For every pair of a line writing a matrix and a line reading the same
+        matrix an IndexSolver is built for the reader's argument and for the
+        writer's output, so finding the children or parents of a node only
+        evaluates its own index expressions and solves the precompiled
+        equations of the lines it actually shares a matrix with. Index
+        expressions without a closed form fall back to template_match, so
+        results always agree with compiler.find_children/find_parents.
+    '''
+    # everything but the program itself, none of it refers to particular matrices
+    TABLES = ["read_writers", "write_readers", "output_solvers", "arg_solvers"]
+
+    def __init__(self, program, tables=None):
+        self.program = program
+        if (tables is not None):
+            self.__dict__.update(tables)
+            return
+        writers = []
+        readers = []
+        for p_idx in program.keys():
+            r_call_abstract_with_scope = program[p_idx]
+            scope = r_call_abstract_with_scope.scope
+            r_call_abstract = r_call_abstract_with_scope.remote_call
+            for i, output in enumerate(r_call_abstract.output):
+                if (not isinstance(output, IndexExpr)): continue
+                writers.append((scope_lookup(output.matrix_name, scope), p_idx, i))
+            for i, arg in enumerate(r_call_abstract.args):
+                if (not isinstance(arg, IndexExpr)): continue
+                readers.append((scope_lookup(arg.matrix_name, scope), p_idx, i))
+        # line -> argument -> (line, output) pairs writing the matrix it reads
+        self.read_writers = {p_idx: {} for p_idx in program.keys()}
+        for page, p_idx, i in readers:
+            self.read_writers[p_idx][i] = [(w_idx, j) for (w_page, w_idx, j) in writers if w_page is page]
+        # line -> output -> (line, argument) pairs reading the matrix it writes
+        self.write_readers = {p_idx: {} for p_idx in program.keys()}
+        for page, p_idx, j in writers:
+            self.write_readers[p_idx][j] = [(r_idx, i) for (r_page, r_idx, i) in readers if r_page is page]
+        self.output_solvers = {}
+        self.arg_solvers = {}
+        for p_idx, line_writers in self.read_writers.items():
+            for i, writers in line_writers.items():
+                if (len(writers) == 0): continue
+                self.arg_solvers[(p_idx, i)] = self._build_solver(p_idx, "args", i)
+                for w_idx, j in writers:
+                    if ((w_idx, j) not in self.output_solvers):
+                        self.output_solvers[(w_idx, j)] = self._build_solver(w_idx, "output", j)
+
+    def tables(self):
+        ''' The analysis results, DependencyAnalysis(program, tables) restores them '''
+        return {name: getattr(self, name) for name in self.TABLES}
+
+    def _index_expr(self, p_idx, field, i):
+        return getattr(self.program[p_idx].remote_call, field)[i]
+
+    def _build_solver(self, p_idx, field, i):
+        scope = self.program[p_idx].scope
+        abstract_page, abstract_offset = eval_index_expr(self._index_expr(p_idx, field, i), scope, dummify=True)
+        return IndexSolver.build(abstract_offset, scope)
+
+    def _match(self, solvers, p_idx, field, i, page, offset):
+        solver = solvers.get((p_idx, i))
+        if (solver is not None):
+            sols = solver.solve(offset)
+            if (sols is not IndexSolver.UNSOLVABLE):
+                return sols
+        index_expr = self._index_expr(p_idx, field, i)
+        scope = copy_scope(self.program[p_idx].scope)
+        abstract_page, abstract_offset = eval_index_expr(index_expr, scope, dummify=True)
+        offset_types = [x.type for x in index_expr.indices]
+        return template_match(page, offset, abstract_page, abstract_offset, offset_types, scope)
+
+    def _eval_offsets(self, idx, value_map, field, idxs):
+        r_call_with_scope = self.program[idx]
+        scope = copy_scope(r_call_with_scope.scope)
+        scope.update(value_map)
+        index_exprs = getattr(r_call_with_scope.remote_call, field)
+        return {i: eval_index_expr(index_exprs[i], scope) for i in idxs}
+
+    def find_parents(self, idx, value_map):
+        line_writers = self.read_writers[idx]
+        if (not any(line_writers.values())):
+            return []
+        reads = self._eval_offsets(idx, value_map, "args", [i for i, w in line_writers.items() if len(w) > 0])
+        parents = []
+        for i in sorted(reads.keys()):
+            page, offset = reads[i]
+            for p_idx, j in line_writers[i]:
+                local_parents = self._match(self.output_solvers, p_idx, "output", j, page, offset)
+                if (len(local_parents) > 1):
+                    # No single IndexExpr should have multiple parents
+                    raise Exception("Invalid Program Graph, LambdaPackPrograms must be SSA")
+                parents += [(p_idx, x) for x in local_parents]
+        return integerify_solutions(utils.remove_duplicates(parents))
+
+    def find_children(self, idx, value_map):
+        line_readers = self.write_readers[idx]
+        if (not any(line_readers.values())):
+            return []
+        writes = self._eval_offsets(idx, value_map, "output", [j for j, r in line_readers.items() if len(r) > 0])
+        children = []
+        for j in sorted(writes.keys()):
+            page, offset = writes[j]
+            for p_idx, i in line_readers[j]:
+                local_children = self._match(self.arg_solvers, p_idx, "args", i, page, offset)
+                children += [(p_idx, x) for x in local_children]
+        return integerify_solutions(utils.remove_duplicates(children))
+
+    def num_parents(self, idx, value_map):
+        return len(self.find_parents(idx, value_map))
+
 #@profile
 def find_children(program, idx, value_map):
     ''' Given a specific r_call and arguments to evaluate it completely
         return all other program locations that read from the output of r_call
     '''
-    global memoize
-    memoize = {}
     r_call = program[idx]
     ib = eval_remote_call(r_call, value_map)
     children = []
@@ -684,8 +1065,123 @@ def replace_in_scope(scope, var, val):
     if "__parent__" in scope:
         replace_in_scope(scope["__parent__"], var, val)
 
+class RangeWalk(object):
+    ''' Iteration space of the loops enclosing a program line.
+
+        The loop bounds are compiled once: variables are ordered so that the
+        bounds of each depend only on the variables before it (the order
+        recursive_range_walk_symbolic picks them in) and the whole space is
+        then generated with NumPy, one column per variable, instead of copying
+        the scope for every iteration.
+    '''
+    def __init__(self, scope):
+        range_vars = extract_range_vars(scope)
+        limits = {}
+        for var, range_var in range_vars.items():
+            limits[var] = [sympy.sympify(eval_expr(x, scope, dummify=True))
+                           for x in (range_var.start, range_var.end, range_var.step)]
+        self.var_names = []
+        self.limits = []
+        remaining = list(range_vars.keys())
+        while (len(remaining) > 0):
+            known = set([Symbol(x) for x in self.var_names])
+            ready = [x for x in remaining
+                     if set().union(*[e.free_symbols for e in limits[x]]).issubset(known)]
+            if (len(ready) == 0):
+                break
+            var = ready[0]
+            self.var_names.append(var)
+            self.limits.append([_ArrayFunction(e, self.var_names[:-1]) for e in limits[var]])
+            remaining.remove(var)
+
+    def arrays(self):
+        ''' (var_names, values) with one row of values per iteration '''
+        values = np.zeros((1, 0), dtype=np.int64)
+        for start_fn, end_fn, step_fn in self.limits:
+            start, end, step = start_fn(values), end_fn(values), step_fn(values)
+            counts = np.maximum(0, -((start - end) // step))
+            offsets = np.cumsum(counts) - counts
+            total = int(counts.sum())
+            rows = np.repeat(np.arange(len(values)), counts)
+            iteration = np.arange(total, dtype=np.int64) - np.repeat(offsets, counts)
+            column = start[rows] + step[rows]*iteration
+            values = np.concatenate([values[rows], column[:, None]], axis=1)
+        return list(self.var_names), values
+
+    def __iter__(self):
+        ''' Lazily yield a {var: value} dict per iteration '''
+        var_names, values = self.arrays()
+        for row in values.tolist():
+            yield dict(zip(var_names, row))
+
+    def __len__(self):
+        return len(self.arrays()[1])
+
+def outer_loop(scope):
+    ''' RangeVar of the outermost loop around a line, None outside loops '''
+    loop = None
+    while ("__parent__" in scope):
+        range_vars = [x for x in scope.values() if type(x) == RangeVar]
+        if (len(range_vars) > 0):
+            loop = range_vars[0]
+        scope = scope["__parent__"]
+    return loop
+
+def line_priority(scope, panel_loop):
+    ''' (var, start, step, count) of panel_loop if it is the outermost loop
+        around a line, None for lines outside it
+    '''
+    if (panel_loop is None or outer_loop(scope) is not panel_loop):
+        return None
+    # the outermost loop's bounds do not depend on any other variable
+    start, end, step = [int(sympy.sympify(eval_expr(x, scope, dummify=True)))
+                        for x in (panel_loop.start, panel_loop.end, panel_loop.step)]
+    count = max(0, -((start - end)//step))
+    return (panel_loop.var, start, step, count)
+
+class _ArrayFunction(object):
+    ''' A loop bound over the columns of a RangeWalk values array, integer
+        arithmetic is vectorized, ceiling/floor/log are evaluated with sympy
+        once per distinct combination of the variables they use
+    '''
+    def __init__(self, expr, var_names):
+        self.expr = expr
+        self.columns = [i for i, x in enumerate(var_names) if Symbol(x) in expr.free_symbols]
+        symbols = [Symbol(var_names[i]) for i in self.columns]
+        exact = all([isinstance(x, (sympy.Add, sympy.Mul, sympy.Pow, sympy.Symbol, sympy.Integer))
+                     for x in sympy.preorder_traversal(expr)])
+        if (len(symbols) == 0):
+            self.f = None
+        elif (exact):
+            self.f = sympy.lambdify(symbols, expr, modules="numpy")
+        else:
+            self.f = sympy.lambdify(symbols, expr, modules=("sympy", {"ceil":sympy.ceiling}))
+        self.exact = exact
+
+    def __call__(self, values):
+        if (self.f is None):
+            return np.full(len(values), self._to_int(self.expr), dtype=np.int64)
+        columns = values[:, self.columns]
+        if (self.exact):
+            return np.broadcast_to(np.asarray(self.f(*columns.T), dtype=np.int64), (len(values),))
+        unique, inverse = np.unique(columns, axis=0, return_inverse=True)
+        results = np.array([self._to_int(self.f(*row)) for row in unique.tolist()], dtype=np.int64)
+        return results[inverse.reshape(-1)]
+
+    def _to_int(self, val):
+        if (not is_integer(val)):
+            raise Exception("Non integer loop bound {0} = {1}".format(self.expr, val))
+        return int(val)
+
 def recursive_range_walk(scope):
-    ''' Recursively walks scope and returns the set of all range vars '''
+    ''' Returns the loop variable values of every iteration of the loops in scope '''
+    return list(RangeWalk(scope))
+
+def recursive_range_walk_symbolic(scope):
+    ''' Recursively walks scope and returns the set of all range vars,
+        evaluating the bounds with sympy for every iteration. Kept as a
+        reference for RangeWalk
+    '''
     range_vars = extract_range_vars(scope)
     const_range_vars = [k for (k,v) in range_vars.items() if is_const_range_var(v, scope)]
     if len(const_range_vars) == 0:
@@ -699,7 +1195,7 @@ def recursive_range_walk(scope):
         scope_recurse = copy_scope(scope)
         replace_in_scope(scope_recurse, str(const_range_var), i)
         range_vars = extract_range_vars(scope_recurse)
-        vals = recursive_range_walk(scope_recurse)
+        vals = recursive_range_walk_symbolic(scope_recurse)
         [x.update({const_range_var: i}) for x in vals]
         r_vals += vals
     return r_vals
@@ -731,6 +1227,15 @@ def find_terminators(program, output_matrices):
             terminators += [(p_idx, x) for x in r_vals]
     return terminators
 
+def count_terminators(program, output_matrices):
+    ''' len(find_terminators(program, output_matrices)) without building the nodes '''
+    output_matrices = set(output_matrices)
+    count = 0
+    for p_idx in program.keys():
+        if (writes_to(program, p_idx, output_matrices)):
+            count += len(RangeWalk(program[p_idx].scope))
+    return count
+
 def writes_to(program, idx, refs):
     '''
     Returns true if program[idx] writes to any
@@ -0,0 +1,170 @@
+'''
+Fully materialized dependency graph of a compiled LambdaPack program.
+
+For programs small enough to enumerate (a few thousand to a few hundred
+thousand nodes) the whole DAG can be built once at compile time and stored
+as CSR arrays:
+
+    node_lines     line of the program every node runs
+    node_values    loop variable values of every node, in the order of
+                   line_vars[line], padded with zeros
+    child_offsets  children of node n are children[child_offsets[n]:child_offsets[n+1]]
+    children       node ids
+    parent_counts  number of parents of every node
+
+Workers then resolve the children and parent counts of a node by array
+indexing instead of solving index equations. The arrays are saved in .npz
+format, to a local file or through a BlockStore.
+'''
+import io
+import json
+
+import numpy as np
+
+
+class MaterializedDAG(object):
+    def __init__(self, line_vars, node_lines, node_values, child_offsets, children, parent_counts):
+        self.line_vars = line_vars
+        self.node_lines = node_lines
+        self.node_values = node_values
+        self.child_offsets = child_offsets
+        self.children = children
+        self.parent_counts = parent_counts
+        self._index = None
+        self._levels = None
+
+    @classmethod
+    def build(cls, nodes, find_children):
+        '''
+        Build the DAG of the nodes given as (expr_idx, var_values) pairs,
+        find_children(expr_idx, var_values) must only return nodes from nodes.
+        '''
+        line_vars = {}
+        for expr_idx, var_values in nodes:
+            line_vars.setdefault(int(expr_idx), sorted(var_values.keys()))
+        num_vars = max([len(x) for x in line_vars.values()] + [1])
+        node_lines = np.zeros(len(nodes), dtype=np.int32)
+        node_values = np.zeros((len(nodes), num_vars), dtype=np.int64)
+        for n, (expr_idx, var_values) in enumerate(nodes):
+            node_lines[n] = expr_idx
+            node_values[n, :len(var_values)] = [var_values[x] for x in line_vars[int(expr_idx)]]
+        dag = cls(line_vars, node_lines, node_values, None, None, None)
+        child_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        children = []
+        for n, (expr_idx, var_values) in enumerate(nodes):
+            children += [dag.node_id(*child) for child in find_children(expr_idx, var_values)]
+            child_offsets[n + 1] = len(children)
+        dag.child_offsets = child_offsets
+        dag.children = np.array(children, dtype=np.int64)
+        dag.parent_counts = np.bincount(dag.children, minlength=len(nodes)).astype(np.int32)
+        return dag
+
+    @property
+    def num_nodes(self):
+        return len(self.node_lines)
+
+    @property
+    def num_edges(self):
+        return len(self.children)
+
+    def _key(self, expr_idx, var_values):
+        return (int(expr_idx),) + tuple([int(var_values[x]) for x in self.line_vars[int(expr_idx)]])
+
+    def node_id(self, expr_idx, var_values):
+        ''' Id of the node, KeyError if it is not part of the DAG '''
+        if (self._index is None):
+            index = {}
+            for n in range(self.num_nodes):
+                expr_idx_n = int(self.node_lines[n])
+                num_vars = len(self.line_vars[expr_idx_n])
+                index[(expr_idx_n,) + tuple(self.node_values[n, :num_vars].tolist())] = n
+            self._index = index
+        return self._index[self._key(expr_idx, var_values)]
+
+    def node(self, n):
+        ''' (expr_idx, var_values) of node id n '''
+        expr_idx = int(self.node_lines[n])
+        names = self.line_vars[expr_idx]
+        return (expr_idx, dict(zip(names, self.node_values[n, :len(names)].tolist())))
+
+    def find_children(self, expr_idx, var_values):
+        n = self.node_id(expr_idx, var_values)
+        return [self.node(c) for c in self.children[self.child_offsets[n]:self.child_offsets[n + 1]]]
+
+    def num_parents(self, expr_idx, var_values):
+        return int(self.parent_counts[self.node_id(expr_idx, var_values)])
+
+    def starters(self):
+        return [self.node(n) for n in np.flatnonzero(self.parent_counts == 0)]
+
+    def _edges_from(self, nodes):
+        ''' (sources, targets) of every edge leaving nodes '''
+        starts = self.child_offsets[nodes]
+        counts = self.child_offsets[nodes + 1] - starts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        return np.repeat(nodes, counts), self.children[positions]
+
+    def levels(self):
+        '''
+        Bottom level of every node: the number of nodes on the longest path
+        from it to the end of the program, its own included. Nodes are
+        peeled off in topological layers and the levels filled in from the
+        last layer back.
+        '''
+        if (self._levels is None):
+            remaining = self.parent_counts.astype(np.int64)
+            layers = []
+            frontier = np.flatnonzero(remaining == 0)
+            while (len(frontier) > 0):
+                layers.append(frontier)
+                _, targets = self._edges_from(frontier)
+                np.subtract.at(remaining, targets, 1)
+                frontier = np.unique(targets[remaining[targets] == 0])
+            levels = np.ones(self.num_nodes, dtype=np.int64)
+            for layer in layers[::-1]:
+                sources, targets = self._edges_from(layer)
+                np.maximum.at(levels, sources, levels[targets] + 1)
+            self._levels = levels
+        return self._levels
+
+    def priority(self, expr_idx, var_values):
+        ''' Bottom level of the node relative to the longest path in the DAG '''
+        levels = self.levels()
+        return float(levels[self.node_id(expr_idx, var_values)])/max(int(levels.max()), 1)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+    def dumps(self):
+        out = io.BytesIO()
+        line_vars = json.dumps({str(k): v for k, v in self.line_vars.items()})
+        np.savez_compressed(out, line_vars=np.array(line_vars), node_lines=self.node_lines,
+                            node_values=self.node_values, child_offsets=self.child_offsets,
+                            children=self.children, parent_counts=self.parent_counts)
+        return out.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        arrays = np.load(io.BytesIO(data))
+        line_vars = {int(k): v for k, v in json.loads(str(arrays["line_vars"])).items()}
+        return cls(line_vars, arrays["node_lines"], arrays["node_values"], arrays["child_offsets"],
+                   arrays["children"], arrays["parent_counts"])
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.dumps())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.loads(f.read())
+
+    def put(self, store, bucket, key):
+        ''' Store the DAG in a BlockStore, e.g. S3 for workers to fetch '''
+        store.put(bucket, key, self.dumps())
+
+    @classmethod
+    def get(cls, store, bucket, key):
+        return cls.loads(bytes(store.get(bucket, key)))
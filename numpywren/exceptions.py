@@ -22,3 +22,11 @@ class LambdaPackTimeoutException(Exception):
 class LambdaPackRetriesExhaustedException(Exception):
     def __init__(self, msg):
         super().__init__(msg)
+
+class BlockNotFoundException(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+class CorruptShardException(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
@@ -0,0 +1,191 @@
+'''
+Block cache shared by the worker processes of one host.
+
+Several lambdapack_run processes on one machine read many of the same
+blocks (e.g. the panel O[j,i] consumed by every syrk update of column i).
+The first process to read a block from the block store saves it as a .npy
+file under CACHE_DIR (in /dev/shm, so it never touches disk). The other
+processes map that file copy-on-write with np.load(mmap_mode="c") and share
+the block zero-copy. A process that writes to a mapped block (e.g. a kernel
+working in place) gets private copies of the pages it touches, the cached
+file never changes.
+
+A small index holds the size of every block in the cache. It is guarded by
+a lock file and is only updated when a block is added. Hits refresh a
+block's mtime, and the least recently used blocks are evicted once the
+cache grows past max_bytes. Evicting a block never invalidates the copies
+other processes have already mapped. Blocks are named after their
+namespace, clear_namespace() removes a finished program's blocks.
+'''
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = os.environ.get("NUMPYWREN_HOST_CACHE_DIR", "/dev/shm/numpywren_cache")
+# bytes of /dev/shm the workers of a host may fill, 0 disables the cache
+CACHE_MAX_BYTES = int(os.environ.get("NUMPYWREN_HOST_CACHE_MAX_BYTES", 0))
+# room reserved for the .npy header of a block before it is written
+HEADER_BYTES = 128
+
+logger = logging.getLogger(__name__)
+
+
+class HostBlockCache(object):
+    '''
+    Blocks keyed by (key, bucket, block index), namespace (e.g. the program
+    hash) keeps programs that reuse matrix names apart
+    '''
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, root=CACHE_DIR, namespace=""):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def _prefix(self):
+        return hashlib.sha1(repr(self.namespace).encode('utf-8')).hexdigest()[:16] + "_"
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr((self.namespace, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, self._prefix() + digest + ".npy")
+
+    @contextmanager
+    def _locked(self):
+        ''' Hold the lock guarding the index '''
+        with open(os.path.join(self.root, "lock"), "a") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key, default=None):
+        ''' The block mapped copy-on-write, default if it is not cached '''
+        path = self._path(key)
+        try:
+            value = np.load(path, mmap_mode="c")
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing or evicted while we opened it
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''
+        Cache value under key. Best effort: the cache is only an accelerator,
+        so a block that does not fit or fails to write (e.g. a full
+        /dev/shm) is logged and skipped. Room is made before the block is
+        written so the cache never grows past max_bytes while it is written.
+        '''
+        if (not isinstance(value, np.ndarray) or value.dtype.hasobject):
+            return
+        if (value.nbytes + HEADER_BYTES > self.max_bytes):
+            return
+        path = self._path(key)
+        name = os.path.basename(path)
+        tmp_path = None
+        try:
+            with self._locked():
+                index = self._load_index()
+                index.pop(name, None)
+                self._evict(index, self.max_bytes - value.nbytes - HEADER_BYTES)
+                self._dump_index(index)
+            if (shutil.disk_usage(self.root).free < value.nbytes + HEADER_BYTES):
+                logger.warning("Not enough space in {0} to cache a block of {1} bytes".format(self.root, value.nbytes))
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, value)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            with self._locked():
+                index = self._load_index()
+                index[name] = size
+                if (sum(index.values()) > self.max_bytes):
+                    self._evict(index, self.max_bytes)
+                self._dump_index(index)
+        except Exception as e:
+            logger.warning("Could not cache block in {0}: {1}".format(self.root, e))
+            if (tmp_path is not None):
+                self._remove(tmp_path)
+
+    def _evict(self, index, max_bytes):
+        ''' Remove least recently used blocks until index fits in max_bytes '''
+        entries = []
+        for name in list(index.keys()):
+            try:
+                entries.append((os.stat(os.path.join(self.root, name)).st_mtime, name))
+            except FileNotFoundError:
+                del index[name]
+        total = sum(index.values())
+        for _, name in sorted(entries):
+            if (total <= max_bytes):
+                break
+            self._remove(os.path.join(self.root, name))
+            total -= index.pop(name)
+            self.evictions += 1
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.root, "index"), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            # unreadable index, rebuild it from the blocks on disk
+            index = {}
+            for name in os.listdir(self.root):
+                if (name.endswith(".npy")):
+                    try:
+                        index[name] = os.path.getsize(os.path.join(self.root, name))
+                    except FileNotFoundError:
+                        pass
+            return index
+
+    def _dump_index(self, index):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(self.root, "index"))
+
+    def size(self):
+        return sum([os.path.getsize(os.path.join(self.root, x)) for x in os.listdir(self.root) if x.endswith(".npy")])
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def clear_namespace(self):
+        ''' Remove the blocks of this namespace, e.g. once its program finished '''
+        prefix = self._prefix()
+        with self._locked():
+            index = self._load_index()
+            for name in os.listdir(self.root):
+                if (name.startswith(prefix) and name.endswith(".npy")):
+                    self._remove(os.path.join(self.root, name))
+                    index.pop(name, None)
+            self._dump_index(index)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,4 +1,5 @@
 import asyncio
+from collections import OrderedDict
 import concurrent.futures as fs
 import gc
 import logging
@@ -17,6 +18,10 @@ import boto3
 import json
 import numpy as np
 from numpywren import lambdapack as lp
+from numpywren import client_pool
+from numpywren import utils
+from numpywren.host_cache import HostBlockCache, CACHE_MAX_BYTES as HOST_CACHE_MAX_BYTES
+from numpywren.task_queue import TaskFetcher, LeaseManager
 import pywren
 from pywren.serialize import serialize
 import redis
@@ -26,45 +31,111 @@ import hashlib
 
 REDIS_CLIENT = None
 logger = logging.getLogger(__name__)
+# reads a worker has in flight at once, across all its pipeline slots
+MAX_INFLIGHT_READS = int(os.environ.get("NUMPYWREN_MAX_INFLIGHT_READS", 32))
+# fraction of the host's memory a worker's block cache may hold
+CACHE_FRACTION = float(os.environ.get("NUMPYWREN_CACHE_FRACTION", 0.1))
 
 def mem():
    mem_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
    return mem_bytes/(1024.**3)
 
+def block_nbytes(value):
+    return getattr(value, "nbytes", sys.getsizeof(value))
+
 class LRUCache(object):
-    def __init__(self, max_items=10):
-        self.cache = {}
-        self.key_order = []
-        self.max_items = max_items
+    '''
+    Blocks read or written by a worker, keyed by (key, bucket, block index)
+    and bounded by max_bytes (by default CACHE_FRACTION of the host's memory).
+    Pinned keys, the blocks of nodes already in the pipeline, are never
+    evicted so the cache can go over budget while many nodes are queued.
+    '''
+    def __init__(self, max_bytes=None):
+        if (max_bytes == None):
+            max_bytes = int(CACHE_FRACTION*mem()*1024**3)
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.sizes = {}
+        self.pins = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def __setitem__(self, key, value):
+        size = block_nbytes(value)
+        if (key in self.cache):
+            self.nbytes -= self.sizes[key]
+        elif (size > self.max_bytes):
+            return
         self.cache[key] = value
-        self._mark(key)
+        self.cache.move_to_end(key)
+        self.sizes[key] = size
+        self.nbytes += size
+        self._evict()
 
     def __getitem__(self, key):
-        try:
-            value = self.cache[key]
-        except KeyError:
-            # Explicit reraise for better tracebacks
-            raise KeyError
-        self._mark(key)
+        value = self.cache[key]
+        self.cache.move_to_end(key)
         return value
 
     def __contains__(self, obj):
         return obj in self.cache
 
-    def _mark(self, key):
-        if key in self.key_order:
-            self.key_order.remove(key)
-
-        self.key_order.insert(0, key)
-        if len(self.key_order) > self.max_items:
-            remove = self.key_order[self.max_items]
-            del self.cache[remove]
-            self.key_order.remove(remove)
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key, default=None):
+        ''' Like __getitem__ but counts the hit or miss '''
+        if (key not in self.cache):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self[key]
+
+    def pin(self, keys):
+        for key in keys:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, keys):
+        ''' Release pins taken by pin, keys that are not pinned are ignored '''
+        for key in keys:
+            count = self.pins.pop(key, 0) - 1
+            if (count > 0):
+                self.pins[key] = count
+        self._evict()
+
+    def _evict(self):
+        victims = []
+        nbytes = self.nbytes
+        # oldest first, stop as soon as the cache fits again
+        for key in self.cache:
+            if (nbytes <= self.max_bytes):
+                break
+            if (key not in self.pins):
+                victims.append(key)
+                nbytes -= self.sizes[key]
+        for key in victims:
+            del self.cache[key]
+            del self.sizes[key]
+        self.nbytes = nbytes
+        self.evictions += len(victims)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self.nbytes}
+
+class Claim(object):
+    ''' A received task, deleted once its node and every node fused into it finished post_op '''
+    def __init__(self, queue, task, start_time):
+        self.queue = queue
+        self.task = task
+        self.start_time = start_time
+        self.operator_refs = []
+        self.pinned = []
+        self.released = False
 
 class LambdaPackExecutor(object):
-    def __init__(self, program, loop, cache, read_queue):
+    def __init__(self, program, loop, cache, read_queue, post_op_queue=None, leases=None, shared_state=None):
         self.read_executor = None
         self.write_executor = None
         self.compute_executor = None
@@ -73,90 +144,135 @@ class LambdaPackExecutor(object):
         self.cache = cache
         self.block_ends= set()
         self.read_queue = read_queue
+        self.post_op_queue = post_op_queue
+        self.leases = leases
+        self.shared_state = shared_state
+        self.eager_tasks = set()
+
+    async def start(self, expr_idx, var_values, claim, computer=None):
+        ''' Run a node for claim, returns once its writes are durable. If the
+            node fails claim is released, its task reappears for a retry
+        '''
+        try:
+            ran = await self.run(expr_idx, var_values, claim, computer=computer)
+        except:
+            self.release(claim)
+            raise
+        if (not ran):
+            await self.complete(claim)
+
+    def start_eager(self, expr_idx, var_values, claim, computer=None):
+        ''' Run the eager child of a node as part of claim in the background '''
+        task = self.loop.create_task(self.start(expr_idx, var_values, claim, computer=computer))
+        self.eager_tasks.add(task)
+        task.add_done_callback(self._eager_done)
+        return task
+
+    def _eager_done(self, task):
+        self.eager_tasks.discard(task)
+        if (not task.cancelled() and task.exception() is not None):
+            logger.error("Eager node failed", exc_info=task.exception())
 
     #@profile
-    async def run(self, expr_idx, var_values, computer=None, profile=True):
-        operator_refs = [(expr_idx, var_values)]
-        event = asyncio.Event()
-        operator_refs_to_ret = []
-        profile_bytes_to_ret = []
-        for expr_idx, var_values in operator_refs:
-            try:
-               t = time.time()
-               node_status = self.program.get_node_status(expr_idx, var_values)
-               inst_block = self.program.program.eval_expr(expr_idx, var_values)
-               inst_block.start_time = time.time()
-               print(f"Running JOB={(expr_idx, var_values)}")
-               instrs = inst_block.instrs
-               next_operator = None
-            except:
-               tb = traceback.format_exc()
-               traceback.print_exc()
-               self.program.handle_exception("EXCEPTION", tb=tb, expr_idx=expr_idx, var_values=var_values)
-               raise
-
-            if (len(instrs) != len(set(instrs))):
-                raise Exception("Duplicate instruction in instruction stream")
-            try:
-                if (node_status == lp.NS.READY or node_status == lp.NS.RUNNING):
-                    if (node_status == lp.NS.RUNNING):
-                       self.program.incr_repeated_compute()
-
-                    self.program.set_node_status(expr_idx, var_values, lp.NS.RUNNING)
-                    operator_refs_to_ret.append((expr_idx, var_values))
-                    await self.read_queue.put((expr_idx, var_values, inst_block, 0, event))
-                    await event.wait()
-                    for instr in instrs:
-                        instr.run = False
-                        instr.result = None
-                    instr.post_op_start = time.time()
-                    next_operator, log_bytes = await self.loop.run_in_executor(computer, self.program.post_op, expr_idx, var_values, lp.PS.SUCCESS, inst_block)
-                    #next_operator, log_bytes = self.program.post_op(expr_idx, var_values, lp.PS.SUCCESS, inst_block)
-                    instr.post_op_end = time.time()
-                    profile_bytes_to_ret.append(log_bytes)
-                    if next_operator is not None:
-                         operator_refs.append(next_operator)
-                elif (node_status == lp.NS.POST_OP):
-                    self.program.incr_repeated_post_op()
-                    operator_refs_to_ret.append((expr_idx, var_values))
-                    logger.warning("node: {0}:{1} finished work skipping to post_op...".format(expr_idx, var_values))
-                    next_operator, log_bytes = await self.loop.run_in_executor(computer, self.program.post_op, expr_idx, var_values, lp.PS.SUCCESS, inst_block)
-                    profile_bytes_to_ret.append(log_bytes)
-                    if next_operator is not None:
-                        operator_refs.append(next_operator)
-                elif (node_status == lp.NS.NOT_READY):
-                   program.not_ready_incr()
-                   logger.warning("node: {0}:{1} not ready skipping...".format(expr_idx, var_values))
-
-                   continue
-                elif (node_status == lp.NS.FINISHED):
-                   self.program.incr_repeated_finish()
-                   logger.warning("node: {0}:{1} finished post_op skipping...".format(expr_idx, var_values))
-                   continue
-                else:
-                    raise Exception("Unknown status: {0}".format(node_status))
-                if next_operator is not None:
-                    operator_refs.append(next_operator)
-            except fs._base.TimeoutError as e:
-                self.program.decr_up(1)
-                raise
-            except RuntimeError as e:
-                self.program.decr_up(1)
-                raise
-            except Exception as e:
-                self.program.decr_up(1)
-                traceback.print_exc()
-                tb = traceback.format_exc()
-                self.program.post_op(expr_idx, var_values, lp.PS.EXCEPTION, inst_block, tb=tb)
-                raise
-        e = time.time()
-        res = list(zip(operator_refs_to_ret, profile_bytes_to_ret))
-        #print('======\n'*10)
-        #print("operator refs", operator_refs_to_ret)
-        #print("profile bytes to ret", profile_bytes_to_ret)
-        #print("RETURING ", res)
-        #print('======\n'*10)
-        return res
+    async def run(self, expr_idx, var_values, claim, computer=None, profile=True):
+        ''' Run the node through the read, compute and write stages and hand
+            it to the post_op stage, False if the node was skipped
+        '''
+        try:
+           t = time.time()
+           node_status = self.program.get_node_status(expr_idx, var_values)
+           inst_block = self.program.program.eval_expr(expr_idx, var_values)
+           inst_block.start_time = time.time()
+           print(f"Running JOB={(expr_idx, var_values)}")
+           instrs = inst_block.instrs
+        except:
+           tb = traceback.format_exc()
+           traceback.print_exc()
+           self.program.handle_exception("EXCEPTION", tb=tb, expr_idx=expr_idx, var_values=var_values)
+           raise
+
+        if (len(instrs) != len(set(instrs))):
+            raise Exception("Duplicate instruction in instruction stream")
+        try:
+            if (node_status == lp.NS.READY or node_status == lp.NS.RUNNING):
+                if (node_status == lp.NS.RUNNING):
+                   self.program.incr_repeated_compute()
+
+                self.program.set_node_status(expr_idx, var_values, lp.NS.RUNNING)
+                if (self.cache != None):
+                    # keep the node's blocks cached until it ran, along an
+                    # eager chain the child pins the blocks its parent wrote
+                    # before the parent's pins are released. claim holds the
+                    # pins from here on, release unpins them if the node fails
+                    keys = [x.cache_key() for x in instrs if isinstance(x, (lp.RemoteRead, lp.RemoteWrite))]
+                    self.cache.pin(keys)
+                    try:
+                        self.cache.unpin(claim.pinned)
+                    finally:
+                        claim.pinned = keys
+                event = asyncio.Event()
+                await self.read_queue.put((expr_idx, var_values, inst_block, 0, event))
+                await event.wait()
+                for instr in instrs:
+                    instr.run = False
+                    instr.result = None
+                await self.post_op_queue.put((expr_idx, var_values, inst_block, claim))
+            elif (node_status == lp.NS.POST_OP):
+                self.program.incr_repeated_post_op()
+                logger.warning("node: {0}:{1} finished work skipping to post_op...".format(expr_idx, var_values))
+                await self.post_op_queue.put((expr_idx, var_values, inst_block, claim))
+            elif (node_status == lp.NS.NOT_READY):
+               self.program.incr_not_ready()
+               logger.warning("node: {0}:{1} not ready skipping...".format(expr_idx, var_values))
+               return False
+            elif (node_status == lp.NS.FINISHED):
+               self.program.incr_repeated_finish()
+               logger.warning("node: {0}:{1} finished post_op skipping...".format(expr_idx, var_values))
+               return False
+            else:
+                raise Exception("Unknown status: {0}".format(node_status))
+            return True
+        except asyncio.CancelledError:
+            # the worker is shutting down, the task reappears for another worker
+            raise
+        except fs._base.TimeoutError as e:
+            self.program.decr_up(1)
+            raise
+        except RuntimeError as e:
+            self.program.decr_up(1)
+            raise
+        except Exception as e:
+            self.program.decr_up(1)
+            traceback.print_exc()
+            tb = traceback.format_exc()
+            self.program.post_op(expr_idx, var_values, lp.PS.EXCEPTION, inst_block, tb=tb)
+            raise
+
+    async def complete(self, claim):
+        ''' Mark the nodes run for claim finished and delete its task '''
+        try:
+            for operator_ref in claim.operator_refs:
+                logger.debug("Marking {0} as done".format(operator_ref))
+                self.program.set_node_status(*operator_ref, lp.NS.FINISHED)
+                self.shared_state["all_operator_refs"].append(operator_ref)
+            self.leases.remove(claim.queue, claim.task)
+            await claim.queue.delete(claim.task, loop=self.loop)
+        finally:
+            self.release(claim)
+
+    def release(self, claim):
+        ''' Drop claim's lease and cache pins and free its slot, only once '''
+        if (claim.released):
+            return
+        claim.released = True
+        if (self.cache != None):
+            self.cache.unpin(claim.pinned)
+            claim.pinned = []
+        self.leases.remove(claim.queue, claim.task)
+        self.shared_state["running_times"].append((claim.start_time, time.time()))
+        self.shared_state["busy_workers"] -= 1
+        self.program.control_plane.client.decr("{0}_busy".format(self.program.hash))
+        self.shared_state["last_busy_time"] = time.time()
 
 
 def calculate_busy_time(rtimes):
@@ -188,32 +304,23 @@ async def check_failure(loop, program, failure_key):
       await asyncio.sleep(5)
 
 
-def lambdapack_run_with_failures(failure_key, program, pipeline_width=5, msg_vis_timeout=60, cache_size=0, timeout=200, idle_timeout=5, msg_vis_timeout_jitter=15, compute_threads=1):
+def lambdapack_run_with_failures(failure_key, program, pipeline_width=5, msg_vis_timeout=60, cache_size=None, timeout=200, idle_timeout=5, msg_vis_timeout_jitter=15, compute_threads=1):
+    ''' lambdapack_run that stops as soon as failure_key is set '''
     program.incr_up(1)
     lambda_start = time.time()
-    loop = asyncio.new_event_loop(200)
+    loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    computer = fs.ThreadPoolExecutor(compute_threads)
-    if (cache_size > 0):
-        cache = LRUCache(max_items=cache_size)
-    else:
-        cache = None
-    shared_state = {}
-    shared_state["busy_workers"] = 0
-    shared_state["done_workers"] = 0
-    shared_state["pipeline_width"] = pipeline_width
-    shared_state["running_times"] = []
-    shared_state["last_busy_time"] = time.time()
-    loop.create_task(check_program_state(program, loop, shared_state, timeout, idle_timeout))
-    loop.create_task(check_failure(loop, program, failure_key))
-    tasks = []
-    for i in range(pipeline_width):
-        # all the async tasks share 1 compute thread and a io cache
-        coro = lambdapack_run_async(loop, program, computer, cache, shared_state=shared_state, timeout=timeout, msg_vis_timeout=msg_vis_timeout, msg_vis_timeout_jitter=msg_vis_timeout_jitter)
-        tasks.append(loop.create_task(coro))
-    #results = loop.run_until_complete(asyncio.gather(*tasks))
-    loop.run_forever()
-    loop.close()
+    try:
+        client_pool.get_pool(loop)
+        loop.create_task(check_failure(loop, program, failure_key))
+        shared_state, stats = run_worker(loop, program, pipeline_width=pipeline_width, msg_vis_timeout=msg_vis_timeout, cache_size=cache_size,
+                                         timeout=timeout, idle_timeout=idle_timeout, msg_vis_timeout_jitter=msg_vis_timeout_jitter,
+                                         compute_threads=compute_threads)
+        loop.run_until_complete(client_pool.close_pool(loop))
+    finally:
+        # never leave a closed loop installed as the current one
+        loop.close()
+        asyncio.set_event_loop(None)
     lambda_stop = time.time()
     program.decr_up(1)
     logger.debug("Loop end program status: {0}".format(program.program_status()))
@@ -221,49 +328,77 @@ def lambdapack_run_with_failures(failure_key, program, pipeline_width=5, msg_vis
             "exec_time": calculate_busy_time(shared_state["running_times"])}
 
 #@profile
-async def read(read_queue, compute_queue, program, loop):
+async def read_block(instr, program, read_limit=None, cache=None, host_cache=None):
+   instr.cache = cache
+   instr.host_cache = host_cache
+   if (read_limit is None or (cache != None and instr.cache_key() in cache)
+       or (host_cache != None and instr.cache_key() in host_cache)):
+      await instr()
+   else:
+      async with read_limit:
+         await instr()
+   instr.cache = None
+   instr.host_cache = None
+   program.incr_read(instr.read_size, instr.wire_read_size)
+
+#@profile
+async def read(read_queue, compute_queue, program, loop, read_limit=None, cache=None, host_cache=None):
    while (loop.is_running()):
       val = await read_queue.get()
       expr_idx, var_values, inst_block, i, event = val
       assert i == 0
-      for i, instr in enumerate(inst_block.instrs):
-         #print("inst_block, i", inst_block, i)
-         if (not isinstance(instr, lp.RemoteRead)):
-            break
+      while (i < len(inst_block.instrs) and isinstance(inst_block.instrs[i], lp.RemoteRead)):
+         i += 1
+      # every read of the block is issued at once (up to read_limit for the
+      # whole worker), a block read twice by the same node is fetched once
+      unique, repeated = {}, []
+      for instr in inst_block.instrs[:i]:
+         key = (instr.matrix.key, instr.matrix.bucket, instr.bidxs)
+         if (key in unique):
+            repeated.append((instr, unique[key]))
          else:
-            try:
-               await instr()
-               read_size = instr.read_size
-               program.incr_read(read_size)
-            except (GeneratorExit, RuntimeError):
-               pass
-            except:
-                print("EXCEPTION")
-                loop.close()
-                instr.run = True
-                instr.cache = None
-                instr.executor = None
-                program.decr_up(1)
-                traceback.print_exc()
-                tb = traceback.format_exc()
-                self.program.handle_exception("READ_EXCEPTION", tb=tb, expr_idx=expr_idx, var_values=var_values)
-                loop.stop()
-                raise
+            unique[key] = instr
+      instrs = list(unique.values())
+      results = await asyncio.gather(*[read_block(instr, program, read_limit, cache, host_cache) for instr in instrs], loop=loop, return_exceptions=True)
+      for instr, result in zip(instrs, results):
+         if (not isinstance(result, BaseException) or isinstance(result, (GeneratorExit, RuntimeError))):
+            continue
+         print("EXCEPTION")
+         instr.run = True
+         instr.cache = None
+         instr.executor = None
+         program.decr_up(1)
+         tb = "".join(traceback.format_exception(type(result), result, result.__traceback__))
+         print(tb)
+         program.handle_exception("READ_EXCEPTION", tb=tb, expr_idx=expr_idx, var_values=var_values)
+         loop.stop()
+         raise result
+      for instr, first in repeated:
+         instr.result = first.result
+         instr.cache_hit = True
+         instr.start_time = instr.end_time = time.time()
+         program.incr_read(instr.read_size, 0)
 
       await compute_queue.put((expr_idx, var_values, inst_block, i, event))
       await asyncio.sleep(0)
 
 #@profile
-async def compute(compute_queue, write_queue, program, loop):
+async def compute(compute_queue, write_queue, program, loop, executor=None):
    while (loop.is_running()):
       val = await compute_queue.get()
       expr_idx, var_values, inst_block, i, event = val
       assert isinstance(inst_block.instrs[i], lp.RemoteCall)
       instr = inst_block.instrs[i]
+      instr.executor = executor
       try:
          await instr()
+         # the executor can't be pickled into the profiling info
+         instr.executor = None
          flops = int(instr.get_flops())
          program.incr_flops(flops)
+      except asyncio.CancelledError:
+         # the worker is shutting down, not a failure of the node
+         raise
       except (GeneratorExit, RuntimeError):
          pass
       except:
@@ -278,7 +413,7 @@ async def compute(compute_queue, write_queue, program, loop):
       await write_queue.put((expr_idx, var_values, inst_block, i+1, event))
       await asyncio.sleep(0)
 
-async def write(write_queue, program, loop, start_time, timeout):
+async def write(write_queue, program, loop, start_time, timeout, cache=None):
    while (loop.is_running()):
       if (time.time() > start_time + timeout):
          loop.stop()
@@ -288,12 +423,16 @@ async def write(write_queue, program, loop, start_time, timeout):
       for i in range(i, len(inst_block.instrs)):
          assert isinstance(inst_block.instrs[i], lp.RemoteWrite)
          instr = inst_block.instrs[i]
+         instr.cache = cache
          try:
             await instr(program.block_sparse)
+            instr.cache = None
             if (instr.sparse_write):
                program.incr_sparse_write(instr.write_size)
             write_size = instr.write_size
-            program.incr_write(write_size)
+            program.incr_write(write_size, instr.wire_write_size)
+         except asyncio.CancelledError:
+            raise
          except (GeneratorExit, RuntimeError):
             pass
          except:
@@ -313,50 +452,159 @@ async def write(write_queue, program, loop, start_time, timeout):
 
 
 #@profile
-def lambdapack_run(program, pipeline_width=5, msg_vis_timeout=60, cache_size=5, timeout=200, idle_timeout=5, msg_vis_timeout_jitter=15, compute_threads=1):
-    program.incr_up(1)
+async def post_op(post_op_queue, lmpk_executor, loop, computer):
+   program = lmpk_executor.program
+   while (loop.is_running()):
+      expr_idx, var_values, inst_block, claim = await post_op_queue.get()
+      try:
+         inst_block.post_op_start = time.time()
+         next_operator, log_bytes = await loop.run_in_executor(computer, program.post_op, expr_idx, var_values, lp.PS.SUCCESS, inst_block)
+      except asyncio.CancelledError:
+         lmpk_executor.release(claim)
+         raise
+      except:
+         # post_op reported the exception itself
+         lmpk_executor.release(claim)
+         program.decr_up(1)
+         traceback.print_exc()
+         loop.stop()
+         raise
+      claim.operator_refs.append((expr_idx, var_values))
+      lmpk_executor.shared_state["profiles"][str((expr_idx, var_values))] = log_bytes
+      if (next_operator is not None):
+         # eager scheduling, the child runs as part of the same claim
+         lmpk_executor.start_eager(*next_operator, claim, computer=computer)
+      else:
+         await lmpk_executor.complete(claim)
+      await asyncio.sleep(0)
+
+#@profile
+def start_pipeline(loop, program, read_queue, compute_queue, write_queue, compute_slots, io_slots, lambda_start, timeout, max_inflight_reads=MAX_INFLIGHT_READS, post_op_queue=None, lmpk_executor=None, computer=None, post_op_slots=1, cache=None, host_cache=None):
+    '''
+    Start io_slots read and write consumers and compute_slots compute
+    consumers, returns the executor RemoteCalls run on. At most
+    max_inflight_reads reads run at once across the read consumers. With a
+    post_op_queue, post_op_slots post_op consumers run post_op on computer.
+    Reads and writes go through cache if given, reads the cache misses are
+    then looked up in host_cache.
+    '''
+    compute_executor = fs.ThreadPoolExecutor(compute_slots)
+    read_limit = asyncio.Semaphore(max_inflight_reads, loop=loop)
+    for i in range(io_slots):
+        loop.create_task(read(read_queue, compute_queue, program, loop, read_limit=read_limit, cache=cache, host_cache=host_cache))
+    for i in range(compute_slots):
+        loop.create_task(compute(compute_queue, write_queue, program, loop, executor=compute_executor))
+    for i in range(io_slots):
+        loop.create_task(write(write_queue, program, loop, lambda_start, timeout, cache=cache))
+    if (post_op_queue is not None):
+        for i in range(post_op_slots):
+            loop.create_task(post_op(post_op_queue, lmpk_executor, loop, computer))
+    return compute_executor
+
+#@profile
+def run_worker(loop, program, pipeline_width=5, msg_vis_timeout=60, cache_size=None, timeout=200, idle_timeout=5, msg_vis_timeout_jitter=15, compute_threads=1, prefetch_size=None, compute_slots=None, io_slots=None, max_inflight_reads=MAX_INFLIGHT_READS, host_cache=None):
+    '''
+    Run nodes of program on loop until the program stops or timeout runs
+    out, returns the shared state of the pipeline slots and the stats of the
+    task fetcher, lease manager and block caches. The block cache holds
+    cache_size bytes (None for the default budget, 0 disables it), blocks
+    it misses are looked up in host_cache, a HostBlockCache shared with the
+    other workers on this host
+    '''
     lambda_start = time.time()
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
     computer = fs.ThreadPoolExecutor(compute_threads)
-    program.control_plane.cache()
 
-    read_queue = asyncio.Queue(pipeline_width)
-    compute_queue = asyncio.Queue(pipeline_width)
-    write_queue = asyncio.Queue(pipeline_width)
-    post_op_queue = asyncio.Queue(pipeline_width)
+    read_queue = asyncio.Queue(pipeline_width, loop=loop)
+    compute_queue = asyncio.Queue(pipeline_width, loop=loop)
+    write_queue = asyncio.Queue(pipeline_width, loop=loop)
+    post_op_queue = asyncio.Queue(pipeline_width, loop=loop)
 
-    tot_messages = []
-    if (cache_size > 0):
-        cache = LRUCache(max_items=cache_size)
+    if (cache_size == None or cache_size > 0):
+        cache = LRUCache(max_bytes=cache_size)
     else:
         cache = None
-    m = hashlib.md5()
-    profiles = {}
     shared_state = {}
     shared_state["busy_workers"] = 0
     shared_state["done_workers"] = 0
     shared_state["pipeline_width"] = pipeline_width
     shared_state["all_operator_refs"] = []
-    shared_state["profiles"] = profiles
+    shared_state["profiles"] = {}
     shared_state["running_times"] = []
     shared_state["last_busy_time"] = time.time()
     shared_state["tot_messages"]  = []
     loop.create_task(check_program_state(program, loop, shared_state, timeout, idle_timeout))
-    loop.create_task(read(read_queue, compute_queue, program, loop))
-    loop.create_task(compute(compute_queue, write_queue, program, loop))
-    loop.create_task(write(write_queue, program, loop, lambda_start, timeout))
+    # kernels run on at most one slot per core and share the cores' BLAS threads
+    if (compute_slots == None):
+        compute_slots = compute_threads
+    compute_slots = max(1, min(compute_slots, os.cpu_count() or 1))
+    if (io_slots == None):
+        io_slots = pipeline_width
+    # one lease manager keeps every buffered and running task invisible
+    leases = LeaseManager(loop, min_timeout=msg_vis_timeout)
+    leases.start()
+    # and one fetcher receives for every pipeline slot
+    if (prefetch_size == None):
+        prefetch_size = pipeline_width
+    fetcher = TaskFetcher(program.queues, loop, buffer_size=prefetch_size, leases=leases)
+    fetcher.start()
+    lmpk_executor = LambdaPackExecutor(program, loop, cache, read_queue, post_op_queue=post_op_queue, leases=leases, shared_state=shared_state)
+    compute_executor = start_pipeline(loop, program, read_queue, compute_queue, write_queue, compute_slots, io_slots, lambda_start, timeout, max_inflight_reads=max_inflight_reads,
+                                      post_op_queue=post_op_queue, lmpk_executor=lmpk_executor, computer=computer, post_op_slots=compute_threads, cache=cache, host_cache=host_cache)
 
-    tasks = []
     for i in range(pipeline_width):
-        # all the async tasks share 1 compute thread and a io cache
-        coro = lambdapack_run_async(loop, program, computer, cache, shared_state=shared_state, timeout=timeout, msg_vis_timeout=msg_vis_timeout, msg_vis_timeout_jitter=msg_vis_timeout_jitter, read_queue=read_queue)
-        tasks.append(loop.create_task(coro))
-    loop.run_forever()
+        # all the slots share the stages, post_op runs on compute_threads threads
+        coro = lambdapack_run_async(loop, program, computer, lmpk_executor, shared_state=shared_state, timeout=timeout, msg_vis_timeout=msg_vis_timeout, msg_vis_timeout_jitter=msg_vis_timeout_jitter, fetcher=fetcher, leases=leases)
+        loop.create_task(coro)
+    with utils.limit_blas_threads(utils.blas_threads_per_slot(compute_slots)):
+        loop.run_forever()
     print("loop end")
-    loop.close()
+    compute_executor.shutdown(wait=False)
+    computer.shutdown(wait=False)
+    loop.run_until_complete(fetcher.close())
+    loop.run_until_complete(leases.close())
+    # the stage consumers wait on their queues forever
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, loop=loop, return_exceptions=True))
+    cache_stats = cache.stats() if (cache != None) else {}
+    host_cache_stats = host_cache.stats() if (host_cache != None) else {}
+    # every worker adds its counters to the program's, however it was started
+    memo_stats = program.flush_memo_stats()
+    program.incr_cache_stats(cache_stats)
+    program.incr_cache_stats(host_cache_stats, name="host_cache")
+    return shared_state, {"receive_stats": fetcher.stats(), "lease_stats": leases.stats(), "cache_stats": cache_stats,
+                          "host_cache_stats": host_cache_stats, "memo_stats": memo_stats}
+
+#@profile
+def lambdapack_run(program, pipeline_width=5, msg_vis_timeout=60, cache_size=None, timeout=200, idle_timeout=5, msg_vis_timeout_jitter=15, compute_threads=1, max_pool_connections=None, prefetch_size=None, compute_slots=None, io_slots=None, max_inflight_reads=MAX_INFLIGHT_READS, host_cache_size=HOST_CACHE_MAX_BYTES):
+    program.incr_up(1)
+    lambda_start = time.time()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        # every S3/SQS call on this loop shares one keep-alive client per service
+        client_pool.get_pool(loop, max_pool_connections=max_pool_connections)
+        program.control_plane.cache()
+        # the workers of this program on this host share the blocks they read
+        if (host_cache_size > 0):
+            block_cache = HostBlockCache(host_cache_size, namespace=program.hash)
+        else:
+            block_cache = None
+        shared_state, stats = run_worker(loop, program, pipeline_width=pipeline_width, msg_vis_timeout=msg_vis_timeout, cache_size=cache_size,
+                                         timeout=timeout, idle_timeout=idle_timeout, msg_vis_timeout_jitter=msg_vis_timeout_jitter,
+                                         compute_threads=compute_threads, prefetch_size=prefetch_size, compute_slots=compute_slots,
+                                         io_slots=io_slots, max_inflight_reads=max_inflight_reads, host_cache=block_cache)
+        if (block_cache != None and program.program_status() != lp.PS.RUNNING):
+            # the program finished, no worker reads its blocks again
+            block_cache.clear_namespace()
+        loop.run_until_complete(client_pool.close_pool(loop))
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
     lambda_stop = time.time()
-    profile_bytes = pickle.dumps(profiles)
+    m = hashlib.md5()
+    profile_bytes = pickle.dumps(shared_state["profiles"])
     m.update(profile_bytes)
     p_key = m.hexdigest()
     p_key = "{0}/{1}/{2}".format("lambdapack", program.hash, p_key)
@@ -364,34 +612,17 @@ def lambdapack_run(program, pipeline_width=5, msg_vis_timeout=60, cache_size=5,
     client.put_object(Bucket=program.bucket, Key=p_key, Body=profile_bytes)
     program.decr_up(1)
     return {"up_time": [lambda_start, lambda_stop],
+            "memo_stats": stats["memo_stats"],
+            "cache_stats": stats["cache_stats"],
+            "host_cache_stats": stats["host_cache_stats"],
+            "receive_stats": stats["receive_stats"],
+            "lease_stats": stats["lease_stats"],
             "exec_time": calculate_busy_time(shared_state["running_times"]),
             "executed_messages": shared_state["tot_messages"],
             "operator_refs": shared_state["all_operator_refs"],
             "log" : profile_bytes}
 
 
-#@profile
-async def reset_msg_visibility(msg, queue_url, loop, timeout, timeout_jitter, lock):
-    assert(timeout > timeout_jitter)
-    num_tries = 0
-    while(lock[0] == 1 and loop.is_running()):
-        try:
-            if (num_tries > 2):
-               break
-            receipt_handle = msg["ReceiptHandle"]
-            operator_ref = tuple(json.loads(msg["Body"]))
-            session = aiobotocore.get_session(loop=loop)
-            async with session.create_client('sqs', use_ssl=False,  region_name="us-west-2") as sqs_client:
-               res = await sqs_client.change_message_visibility(VisibilityTimeout=60, QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            num_tries += 1
-            await asyncio.sleep(30)
-
-        except Exception as e:
-            print("PC: {0} Exception in reset msg vis ".format(operator_ref) + str(e))
-            await asyncio.sleep(10)
-    operator_ref = tuple(json.loads(msg["Body"]))
-    return 0
-
 #@profile
 async def check_program_state(program, loop, shared_state, timeout, idle_timeout):
     start_time = time.time()
@@ -415,12 +646,9 @@ async def check_program_state(program, loop, shared_state, timeout, idle_timeout
 
 
 #@profile
-async def lambdapack_run_async(loop, program, computer, cache, shared_state, read_queue, pipeline_width=1, msg_vis_timeout=60, timeout=200, msg_vis_timeout_jitter=15):
+async def lambdapack_run_async(loop, program, computer, lmpk_executor, shared_state, fetcher, leases, pipeline_width=1, msg_vis_timeout=60, timeout=200, msg_vis_timeout_jitter=15):
     global REDIS_CLIENT
-    session = aiobotocore.get_session(loop=loop)
-    lmpk_executor = LambdaPackExecutor(program, loop, cache, read_queue)
     start_time = time.time()
-    running_times = shared_state['running_times']
     if (REDIS_CLIENT == None):
        REDIS_CLIENT = program.control_plane.client
     redis_client = REDIS_CLIENT
@@ -440,54 +668,21 @@ async def lambdapack_run_async(loop, program, computer, cache, shared_state, rea
                   loop.stop()
                   break;
             await asyncio.sleep(0)
-            # go from high priority -> low priority
-            for queue_url in program.queue_urls[::-1]:
-                async with session.create_client('sqs', use_ssl=False,  region_name=program.control_plane.region) as sqs_client:
-                    messages = await sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1, VisibilityTimeout=200)
-                if ("Messages" not in messages):
-                    continue
-                else:
-                    # note for loops in python leak scope so when this breaks
-                    # messages = messages
-                    # queue_url= messages
-                    break
-            if ("Messages" not in messages):
-                #if time.time() - last_message_time > 10:
-                #    return running_times
+            # wake up every second to check the timeout and program status
+            claimed = await fetcher.get(timeout=1)
+            if (claimed == None):
+                if (fetcher.closed):
+                    return
                 continue
+            queue, task, deadline = claimed
             shared_state["busy_workers"] += 1
             redis_client.incr("{0}_busy".format(program.hash))
-            #last_message_time = time.time()
-            start_processing_time = time.time()
-            msg = messages["Messages"][0]
-            receipt_handle = msg["ReceiptHandle"]
-            # if we don't finish in 75s count as a failure
-            #res = sqs_client.change_message_visibility(VisibilityTimeout=90, QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            operator_ref = json.loads(msg["Body"])
+            operator_ref = json.loads(task.body)
             shared_state["tot_messages"].append(operator_ref)
-            redis_client.set(msg["MessageId"], str(time.time()))
-            print("creating lock")
-            lock = [1]
-            coro = reset_msg_visibility(msg, queue_url, loop, msg_vis_timeout, msg_vis_timeout_jitter, lock)
-            loop.create_task(coro)
-            all_operator_refs = shared_state["all_operator_refs"]
-            all_operator_refs = shared_state["all_operator_refs"]
-            operator_refs= await lmpk_executor.run(*operator_ref, computer=computer)
-            profiles = shared_state["profiles"]
-            for operator_ref, p_info in operator_refs:
-                logger.debug("Marking {0} as done".format(operator_ref))
-                program.set_node_status(*operator_ref, lp.NS.FINISHED)
-                all_operator_refs.append(operator_ref)
-                profiles[str(operator_ref)] = p_info
-            async with session.create_client('sqs', use_ssl=False,  region_name=program.control_plane.region) as sqs_client:
-                lock[0] = 0
-                await sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            end_processing_time = time.time()
-            running_times.append((start_processing_time, end_processing_time))
-            shared_state["busy_workers"] -= 1
-            redis_client.decr("{0}_busy".format(program.hash))
-            shared_state["last_busy_time"] = time.time()
-            current_time = time.time()
+            redis_client.set(task.message_id, str(time.time()))
+            # the slot is free again once the node's writes are durable,
+            # post_op and deleting the task happen in the post_op stage
+            await lmpk_executor.start(*operator_ref, Claim(queue, task, time.time()), computer=computer)
     except Exception as e:
         #print(e)
         traceback.print_exc()
@@ -141,6 +141,7 @@ def _qr_flops(*blocks):
     return 2*m*n*n - (2*n**3)/3
 
 qr_factor.flops = _qr_flops
+qr_factor.layouts = ("lower", "upper", "upper")
 
 def lq_factor(*blocks, **kwargs):
     if len(blocks) == 2:
@@ -150,6 +151,7 @@ def lq_factor(*blocks, **kwargs):
     return v.T,t.T,r.T
 
 lq_factor.flops = _qr_flops
+lq_factor.layouts = ("upper", "lower", "lower")
 
 def lq_leaf(V, T, S0, *args, **kwargs):
     # (I - VTV)^{T}*S
@@ -229,6 +231,7 @@ def _chol_flops(x):
     return (x.shape[0]**3)/3
 
 chol.flops = _chol_flops
+chol.layouts = ("lower",)
 
 def mul(x, y, *args, **kwargs):
     return x * y
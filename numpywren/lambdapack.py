@@ -34,6 +34,8 @@ from .matrix import BigMatrix
 from .matrix_utils import load_mmap, chunk, generate_key_name_uop, generate_key_name_binop, constant_zeros
 from . import control_plane, matrix
 from . import utils
+from . import task_queue as task_queues
+from .exceptions import CorruptShardException
 
 
 try:
@@ -123,7 +125,7 @@ def incr(client, key, amount=1, s3=False, s3_bucket=""):
       val = None
       while(True):
         try:
-          val = client.incr(key, amount=amount)
+          val = client.incr(key, amount=int(amount))
           break
         except redis.exceptions.TimeoutError:
           time.sleep(backoff)
@@ -142,7 +144,7 @@ def decr(client, key, amount, s3=False, s3_bucket=""):
       val = None
       while(True):
         try:
-          val = client.decr(key, amount=amount)
+          val = client.decr(key, amount=int(amount))
           break
         except redis.exceptions.TimeoutError:
           time.sleep(backoff)
@@ -151,50 +153,76 @@ def decr(client, key, amount, s3=False, s3_bucket=""):
 
 
 
-def conditional_increment(client, key_to_incr, condition_key):
-  ''' Crucial atomic operation needed to insure DAG correctness
-      @param key_to_incr - increment this key
-      @param condition_key - only do so if this value is 1
-      @param ip - ip of redis server
-      @param value - the value to bind key_to_set to
-    '''
-  res = 0
-
-  r = client
+# Atomically records the edges from a finished node to each of its targets
+# and returns the (0 based) indices of the targets that became ready.
+# KEYS[1] is the status key of the finished node followed by an
+# (edge key, edge sum key, status key) triple per target.
+# ARGV[1] is the status to give the finished node followed by an
+# (expected edge sum, ready status, skip status) triple per target.
+# An edge only increments its target's edge sum the first time it is
+# recorded, so replayed nodes never double count. A target is ready once its
+# edge sum reaches the expected count, unless its status is the skip status.
+# A ready target's status is set to its ready status, if that is not empty.
+RECORD_EDGES_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1])
+local ready = {}
+local num_targets = (#KEYS - 1) / 3
+for i = 0, num_targets - 1 do
+  local edge_key = KEYS[2 + 3*i]
+  local sum_key = KEYS[3 + 3*i]
+  local status_key = KEYS[4 + 3*i]
+  local val
+  if redis.call('SETNX', edge_key, 1) == 1 then
+    val = redis.call('INCR', sum_key)
+  else
+    val = tonumber(redis.call('GET', sum_key) or '0')
+  end
+  if val == tonumber(ARGV[2 + 3*i]) and redis.call('GET', status_key) ~= ARGV[4 + 3*i] then
+    if ARGV[3 + 3*i] ~= '' then
+      redis.call('SET', status_key, ARGV[3 + 3*i])
+    end
+    table.insert(ready, i)
+  end
+end
+return ready
+"""
+
+def record_edges(client, node_key, node_status, targets):
+  ''' Record all outgoing edges of a node in a single round trip
+      @param node_key - status key of the node, set to node_status
+      @param targets - list of (edge_key, edge_sum_key, status_key,
+                       expected_sum, ready_status, skip_status)
+      @return indices of targets that became ready
+  '''
+  keys = [node_key]
+  args = [node_status]
+  for edge_key, edge_sum_key, status_key, expected_sum, ready_status, skip_status in targets:
+    keys += [edge_key, edge_sum_key, status_key]
+    args += [int(expected_sum), ready_status, skip_status]
+  script = client.register_script(RECORD_EDGES_SCRIPT)
   backoff = 1
-  success = False
   while (True):
     try:
-      with r.pipeline() as pipe:
-        while True:
-          try:
-            pipe.watch(condition_key)
-            pipe.watch(key_to_incr)
-            current_value = pipe.get(key_to_incr)
-            if (current_value is None):
-              current_value = 0
-            current_value = int(current_value)
-            condition_val = pipe.get(condition_key)
-            if (condition_val is None):
-              condition_val = 0
-            condition_val = int(condition_val)
-            res = current_value
-            if (condition_val == 0):
-              pipe.multi()
-              pipe.incr(key_to_incr)
-              pipe.set(condition_key, 1)
-              t_results = pipe.execute()
-              res = int(t_results[0])
-              assert(t_results[1])
-            break
-          except redis.WatchError as e:
-            continue
-        break
+      return [int(x) for x in script(keys=keys, args=args)]
     except redis.exceptions.TimeoutError:
-        time.sleep(backoff)
-        backoff *= 2
-  return res
+      time.sleep(backoff)
+      backoff *= 2
+
+
+# threads start() sends starter batches with
+START_THREADS = int(os.environ.get("NUMPYWREN_START_THREADS", 16))
+# keys per MSET when start() marks starters ready
+MSET_CHUNK_SIZE = 1000
 
+def node_message(expr_idx, var_values):
+  return json.dumps([int(expr_idx), {str(key): int(val) for key, val in var_values.items()}])
+
+def set_many(client, keys, value, chunk_size=MSET_CHUNK_SIZE):
+  ''' Set every key to value with pipelined MSETs of chunk_size keys '''
+  pipe = client.pipeline(transaction=False)
+  for c in chunk(keys, chunk_size):
+    pipe.mset({key: value for key in c})
+  pipe.execute()
 
 OC = RemoteInstructionOpCodes
 NS = NodeStatus
@@ -212,6 +240,7 @@ class RemoteInstruction(object):
         self.type = None
         self.executor = None
         self.cache = None
+        self.host_cache = None
         self.run = False
         self.read_size = 0
         self.write_size = 0
@@ -231,7 +260,14 @@ class RemoteRead(RemoteInstruction):
         self.result = None
         self.cache_hit = False
         self.MAX_READ_TIME = 10
+        # a shard can fail its checksum while it is overwritten, one that
+        # keeps failing is corrupt for good
+        self.MAX_CORRUPT_RETRIES = 3
         self.read_size = np.product(self.matrix.shard_sizes)*np.dtype(self.matrix.dtype).itemsize
+        self.wire_read_size = 0
+
+    def cache_key(self):
+        return (self.matrix.key, self.matrix.bucket, self.matrix.true_block_idx(*self.bidxs))
 
     #@profile
     async def __call__(self):
@@ -241,29 +277,49 @@ class RemoteRead(RemoteInstruction):
         #print("TRYING TO READ ...", self.bidxs)
         #print("===========")
         if (self.result is None):
-            cache_key = (self.matrix.key, self.matrix.bucket, self.matrix.true_block_idx(*self.bidxs))
-            if (self.cache != None and cache_key in self.cache):
+            cache_key = self.cache_key()
+            cached = None
+            if (self.cache != None):
+              cached = self.cache.get(cache_key)
+            if (cached is None and self.host_cache != None):
+              # another worker on this host already read the block
+              cached = self.host_cache.get(cache_key)
+              if (cached is not None and self.cache != None):
+                self.cache[cache_key] = cached
+            if (cached is not None):
               t = time.time()
-              self.result = self.cache[cache_key]
+              self.result = cached
               self.cache_hit = True
+              self.wire_read_size = 0
               self.size = sys.getsizeof(self.result)
               e = time.time()
             else:
               t = time.time()
               backoff = 0.2
+              corrupt_retries = 0
               #print(f"Reading from {self.matrix} at {self.bidxs}")
               while (True):
                 try:
-                  self.result = await asyncio.wait_for(self.matrix.get_block_async(loop, *self.bidxs), self.MAX_READ_TIME)
+                  stats = {}
+                  self.result = await asyncio.wait_for(self.matrix.get_block_async(loop, *self.bidxs, stats=stats), self.MAX_READ_TIME)
+                  self.wire_read_size = stats.get("wire_bytes", 0)
                   #print("read shape", self.result.shape)
                   break
-                except (asyncio.TimeoutError, aiohttp.client_exceptions.ClientPayloadError, fs._base.CancelledError, botocore.exceptions.ClientError):
+                except CorruptShardException:
+                  if (corrupt_retries >= self.MAX_CORRUPT_RETRIES):
+                    raise
+                  corrupt_retries += 1
+                  await asyncio.sleep(backoff)
+                  backoff *= 2
+                except (asyncio.TimeoutError, aiohttp.client_exceptions.ClientPayloadError, fs._base.CancelledError, botocore.exceptions.ClientError, botocore.exceptions.IncompleteReadError):
                   await asyncio.sleep(backoff)
                   backoff *= 2
                   pass
               self.size = sys.getsizeof(self.result)
               if (self.cache != None):
                 self.cache[cache_key] = self.result
+              if (self.host_cache != None):
+                self.host_cache.put(cache_key, self.result)
               e = time.time()
         self.end_time = time.time()
         e = time.time()
@@ -280,17 +336,23 @@ class RemoteRead(RemoteInstruction):
         return "{0} = S3_LOAD {1} {2} {3}".format(self.id, self.matrix, len(self.bidxs), bidxs_str.strip())
 
 class RemoteWrite(RemoteInstruction):
-    def __init__(self, i_id, matrix, data_loc, data_idx, *bidxs):
+    def __init__(self, i_id, matrix, data_loc, data_idx, *bidxs, layout=None):
         super().__init__(i_id)
         self.i_code = OC.S3_WRITE
         self.matrix = matrix
         self.bidxs = bidxs
         self.data_loc = data_loc
         self.data_idx = data_idx
+        # "lower"/"upper" if the kernel producing this block declares it triangular
+        self.layout = layout
 
         self.result = None
         self.MAX_WRITE_TIME = 10
         self.write_size = np.product(self.matrix.shard_sizes)*np.dtype(self.matrix.dtype).itemsize
+        self.wire_write_size = 0
+
+    def cache_key(self):
+        return (self.matrix.key, self.matrix.bucket, self.matrix.true_block_idx(*self.bidxs))
 
     #@profile
     async def __call__(self, skip_empty=False):
@@ -298,7 +360,7 @@ class RemoteWrite(RemoteInstruction):
         loop = asyncio.get_event_loop()
         self.start_time = time.time()
         if (self.result is None):
-            cache_key = (self.matrix.key, self.matrix.bucket, self.matrix.true_block_idx(*self.bidxs))
+            cache_key = self.cache_key()
             if (self.cache != None):
               # write to the cache
               self.cache[cache_key] = self.data_loc[self.data_idx]
@@ -314,9 +376,12 @@ class RemoteWrite(RemoteInstruction):
                   sparse_write = True
                   print(f"Skipping sparse write to {self.bidxs}")
                   self.sparse_write = True
-                  pass
+                  # readers then materialize the zeros locally instead of going to storage
+                  await loop.run_in_executor(None, self.matrix.mark_zero_block, *self.bidxs)
                 else:
-                  self.result = await asyncio.wait_for(self.matrix.put_block_async(self.data_loc[self.data_idx], loop, *self.bidxs), self.MAX_WRITE_TIME)
+                  stats = {}
+                  self.result = await asyncio.wait_for(self.matrix.put_block_async(self.data_loc[self.data_idx], loop, *self.bidxs, stats=stats, layout=self.layout), self.MAX_WRITE_TIME)
+                  self.wire_write_size = stats.get("wire_bytes", 0)
                 break
               except (asyncio.TimeoutError, aiohttp.client_exceptions.ClientPayloadError, fs._base.CancelledError, botocore.exceptions.ClientError) as e:
                   await asyncio.sleep(backoff)
@@ -479,7 +544,7 @@ class LambdaPackProgram(object):
        on stateless computing substrates
        Maintains global state information
     '''
-    def __init__(self, program, config, num_priorities=1, eager=False, block_sparse=False):
+    def __init__(self, program, config, num_priorities=1, eager=False, block_sparse=False, task_queue=None, plane=None):
         self.config = config
         self.config = config
         self.bucket = matrix.DEFAULT_BUCKET
@@ -487,23 +552,34 @@ class LambdaPackProgram(object):
         self.block_sparse = block_sparse
         self.max_priority = num_priorities - 1
         self.eager = eager
-        cpid = control_plane.get_control_plane_id(config=config)
-        if (cpid is None):
-          raise Exception("No active control planes")
-        self.control_plane = control_plane.get_control_plane(config=config)
+        # an explicitly given control plane (e.g. a local redis) skips the lookup
+        if (plane == None):
+          cpid = control_plane.get_control_plane_id(config=config)
+          if (cpid is None):
+            raise Exception("No active control planes")
+          plane = control_plane.get_control_plane(config=config)
+        self.control_plane = plane
         hashed = hashlib.sha1()
         #HACK to have interpretable runs
         self.hash = str(int(time.time()))
         self.up = 'up' + self.hash
         self.set_up(0)
-        client = boto3.client('sqs', region_name=self.control_plane.region)
-        self.queue_urls = []
+        # one task queue per priority, see task_queue.TASK_QUEUES for the backends
+        if (task_queue == None):
+          task_queue = task_queues.DEFAULT_TASK_QUEUE
+        self.queues = []
         for i in range(num_priorities):
-          queue_url = client.create_queue(QueueName=self.hash + str(i))["QueueUrl"]
-          self.queue_urls.append(queue_url)
-          client.purge_queue(QueueUrl=queue_url)
+          queue = task_queues.get_task_queue(task_queue, self.hash + str(i), control_plane=self.control_plane,
+                                              region=self.control_plane.region)
+          queue.create()
+          self.queues.append(queue)
         put(self.control_plane.client, self.hash, PS.NOT_STARTED.value)
 
+    @property
+    def queue_urls(self):
+      ''' SQS urls of the task queues, empty for other backends '''
+      return [q.queue_url for q in self.queues if isinstance(q, task_queues.SQSTaskQueue)]
+
     def _node_key(self, expr_idx, var_values):
       return "{0}_{1}".format(self.hash, self._node_str(expr_idx, var_values))
 
@@ -555,39 +631,29 @@ class LambdaPackProgram(object):
           post_op_start = time.time()
           children = self.program.find_children(expr_idx, var_values)
           #print("children", children)
-          node_status = self.get_node_status(expr_idx, var_values)
-          # if we had 2 racing tasks and one finished no need to go through rigamarole
-          # of re-enqueeuing children
-          #if (node_status == NS.FINISHED):
-            # return
-          self.set_node_status(expr_idx, var_values, NS.POST_OP)
           if (ret_code == PS.EXCEPTION and tb != None):
             self.handle_exception(" EXCEPTION", tb=tb, expr_idx=expr_idx, var_values=var_values)
-          ready_children = []
-          ##print(f"ALL CHILDREN {children}")
+          # one atomic script records every outgoing edge (and the edge to the
+          # program's return counter for terminators) and reports what became ready
+          targets = []
           for child in children:
-              my_child_edge = self._edge_key(expr_idx, var_values, *child)
-              child_edge_sum_key = self._node_edge_sum_key(*child)
-              # redis transaction should be atomic
-              tp = fs.ThreadPoolExecutor(1)
-              val_future = tp.submit(conditional_increment, self.control_plane.client, child_edge_sum_key, my_child_edge)
-              done, not_done = fs.wait([val_future], timeout=60)
-              if len(done) == 0:
-                raise Exception("Redis Atomic Set and Sum timed out!")
-              val = val_future.result()
-              #print(child[1])
-              parents = self.program.find_parents(child[0], child[1])
-              #print("child parents", parents)
-              num_child_parents = len(parents)
-              if ((val == num_child_parents) and self.get_node_status(*child) != NS.FINISHED):
-                self.set_node_status(*child, NS.READY)
-                ready_children.append(child)
+              num_child_parents = self.program.num_parents(child[0], child[1])
+              targets.append((self._edge_key(expr_idx, var_values, *child), self._node_edge_sum_key(*child),
+                              self._node_key(*child), num_child_parents, NS.READY.value, NS.FINISHED.value))
+          terminator = self.program.is_terminator(expr_idx)
+          if (terminator):
+            # the program only succeeds once the last terminator's profile is
+            # dumped, the script just reports when every terminator finished
+            return_key = self.hash + "_return"
+            targets.append((self._edge_key(expr_idx, var_values, return_key, {}), return_key,
+                            self.hash, self.program.num_terminators, "", PS.SUCCESS.value))
+          ready = record_edges(self.control_plane.client, self._node_key(expr_idx, var_values), NS.POST_OP.value, targets)
+          ready_children = [children[i] for i in ready if i < len(children)]
           #print("Ready children", ready_children)
 
           if self.eager and ready_children:
-              # TODO: Re-add priorities here
-              next_operator = ready_children[-1]
-              del ready_children[-1]
+              priorities = [self.program.priority(*child) for child in ready_children]
+              next_operator = ready_children.pop(int(np.argmax(priorities)))
           else:
               next_operator = None
           # move the highest priority job thats ready onto the local task queue
@@ -595,12 +661,8 @@ class LambdaPackProgram(object):
           # the idea is that if we do something like a local cholesky decomposition
           # we would run its highest priority child *locally* by adding the instructions to the local instruction queue
           # this has 2 key benefits, first we completely obliviete scheduling overhead between these two nodes but also because of the local LRU cache the first read of this node will be saved this will translate
-          client = boto3.client('sqs', region_name=self.control_plane.region)
           assert (expr_idx, var_values) not in ready_children
-          for child in ready_children:
-            # TODO: Re-add priorities here
-            message_body = json.dumps([int(child[0]), {str(key): int(val) for key, val in child[1].items()}])
-            resp = client.send_message(QueueUrl=self.queue_urls[0], MessageBody=message_body)
+          self.enqueue(ready_children)
 
           inst_block.end_time = time.time()
           inst_block.clear()
@@ -612,22 +674,11 @@ class LambdaPackProgram(object):
           inst_block.var_values = var_values
           self.incr_progress()
           profiling_info = self.dump_profiling_info(inst_block, expr_idx, var_values)
+          if (terminator and len(children) in ready):
+            print("All {0} terminators finished".format(self.program.num_terminators))
+            self.return_success()
           e = time.time()
           #print(f"Post op for {expr_idx, var_values}, took {e - t} seconds")
-          terminator = self.program.is_terminator(expr_idx)
-          if (terminator):
-            return_key = self.hash + "_return"
-            return_edge = self._edge_key(expr_idx, var_values, return_key, {})
-            tp = fs.ThreadPoolExecutor(1)
-            val_future = tp.submit(conditional_increment, self.control_plane.client, return_key, return_edge)
-            done, not_done = fs.wait([val_future], timeout=60)
-            if len(done) == 0:
-              raise Exception("Redis Atomic Set and Sum timed out!")
-            val = val_future.result()
-            print("Num finished terminators", val,  "num terminators total", self.program.num_terminators)
-            if (val == self.program.num_terminators):
-              self.return_success()
-
           ##print('pooop\n'*20)
           ##print("next operator", next_operator)
           ##print("next operator", profiling_info)
@@ -638,23 +689,36 @@ class LambdaPackProgram(object):
             self.handle_exception("POST OP EXCEPTION", tb=tb, expr_idx=expr_idx, var_values=var_values)
             raise
 
-    def start(self, parallel=False):
+    def priority_queue(self, expr_idx, var_values):
+        ''' Index of the queue a node is sent to, nodes on the critical path go to higher queues '''
+        priority = self.program.priority(expr_idx, var_values)
+        return min(self.max_priority, int(priority*(self.max_priority + 1)))
+
+    def enqueue(self, nodes, num_threads=1):
+        by_queue = defaultdict(list)
+        for node in nodes:
+          by_queue[self.priority_queue(*node)].append(node_message(*node))
+        for i, bodies in by_queue.items():
+          self.queues[i].send_batch(bodies, num_threads=num_threads)
+
+    def start(self, parallel=False, num_threads=START_THREADS):
+        ''' Mark every starter ready and enqueue it. Statuses are written with
+            pipelined MSETs and messages sent 10 per send_message_batch call
+            from num_threads threads, with parallel=True chunks of starters
+            are instead enqueued from pywren workers
+        '''
         put(self.control_plane.client, self.hash, PS.RUNNING.value)
         print("len starters", len(self.program.starters))
-        chunked_starters = chunk(self.program.starters, 100)
-        def start_chunk(c):
-          sqs = boto3.resource('sqs')
-          queue = sqs.Queue(self.queue_urls[0])
-          for x in c:
-            self.set_node_status(*x, NS.READY)
-            queue.send_message(MessageBody=json.dumps([x[0], {str(key): val for key, val in x[1].items()}]))
+        def start_chunk(c, num_threads=1):
+          set_many(self.control_plane.client, [self._node_key(*x) for x in c], NS.READY.value)
+          self.enqueue(c, num_threads=num_threads)
         if (parallel):
+          chunked_starters = chunk(self.program.starters, 1000)
           pwex = pywren.default_executor()
           futures = pwex.map(start_chunk, chunked_starters)
           pywren.wait(futures)
         else:
-          for c in chunked_starters:
-            start_chunk(c)
+          start_chunk(self.program.starters, num_threads=num_threads)
           return 0
 
 
@@ -702,22 +766,51 @@ class LambdaPackProgram(object):
       if (amount > 0):
         incr(self.control_plane.client, "{0}_flops".format(self.hash), amount)
 
-    def incr_read(self, amount):
+    def incr_read(self, amount, wire_amount=None):
+      ''' amount is the logical size of the blocks read, wire_amount the bytes actually transferred '''
+      if (wire_amount == None):
+        wire_amount = amount
       if (amount > 0):
         incr(self.control_plane.client,"{0}_read".format(self.hash), amount)
+      if (wire_amount > 0):
+        incr(self.control_plane.client,"{0}_read_wire".format(self.hash), wire_amount)
 
     def incr_sparse_read(self, amount):
       if (amount > 0):
         incr(self.control_plane.client,"{0}_sparse_read".format(self.hash), amount)
 
-    def incr_write(self, amount):
+    def incr_write(self, amount, wire_amount=None):
+      ''' amount is the logical size of the blocks written, wire_amount the bytes actually transferred '''
+      if (wire_amount == None):
+        wire_amount = amount
       if (amount > 0):
         incr(self.control_plane.client,"{0}_write".format(self.hash), amount)
+      if (wire_amount > 0):
+        incr(self.control_plane.client,"{0}_write_wire".format(self.hash), wire_amount)
 
     def incr_sparse_write(self, amount):
       if (amount > 0):
         incr(self.control_plane.client,"{0}_write_sparse".format(self.hash), amount)
 
+    def incr_memo_stats(self, stats):
+      ''' stats as returned by CompiledLambdaPackProgram.memo_stats '''
+      for name, counts in stats.items():
+        for kind in ["hits", "misses"]:
+          if (counts[kind] > 0):
+            incr(self.control_plane.client, "{0}_memo_{1}_{2}".format(self.hash, name, kind), counts[kind])
+
+    def flush_memo_stats(self):
+      ''' Add this worker's memo hits/misses since the last flush to the program counters '''
+      stats = self.program.memo_stats(reset=True)
+      self.incr_memo_stats(stats)
+      return stats
+
+    def incr_cache_stats(self, stats, name="cache"):
+      ''' stats as returned by job_runner.LRUCache.stats or host_cache.HostBlockCache.stats '''
+      for kind in ["hits", "misses", "evictions"]:
+        if (stats.get(kind, 0) > 0):
+          incr(self.control_plane.client, "{0}_{1}_{2}".format(self.hash, name, kind), stats[kind])
+
     def decr_flops(self, amount):
       if (amount > 0):
         decr(self.control_plane.client,"{0}_flops".format(self.hash), amount)
@@ -745,6 +838,28 @@ class LambdaPackProgram(object):
     def get_write(self):
       return get(self.control_plane.client, "{0}_write".format(self.hash))
 
+    def get_read_wire(self):
+      return get(self.control_plane.client, "{0}_read_wire".format(self.hash))
+
+    def get_write_wire(self):
+      return get(self.control_plane.client, "{0}_write_wire".format(self.hash))
+
+    def get_memo_stats(self):
+      stats = {}
+      for name in ["find_children", "find_parents", "is_terminator", "eval_expr"]:
+        stats[name] = {}
+        for kind in ["hits", "misses"]:
+          value = get(self.control_plane.client, "{0}_memo_{1}_{2}".format(self.hash, name, kind))
+          stats[name][kind] = int(value) if value != None else 0
+      return stats
+
+    def get_cache_stats(self, name="cache"):
+      stats = {}
+      for kind in ["hits", "misses", "evictions"]:
+        value = get(self.control_plane.client, "{0}_{1}_{2}".format(self.hash, name, kind))
+        stats[kind] = int(value) if value != None else 0
+      return stats
+
     def get_progress(self):
       return get(self.control_plane.client, "{0}_progress".format(self.hash))
 
@@ -760,9 +875,8 @@ class LambdaPackProgram(object):
               #print("Program status is ", status)
 
     def free(self):
-        for queue_url in self.queue_urls:
-          client = boto3.client('sqs')
-          client.delete_queue(QueueUrl=queue_url)
+        for queue in self.queues:
+          queue.destroy()
 
     def get_all_profiling_info(self):
         return [self.get_profiling_info(i) for i in range(self.num_inst_blocks) if i is not None]
@@ -17,11 +17,17 @@ import cloudpickle
 import numpy as np
 import pywren.wrenconfig as wc
 import dill
+import redis
 from collections import defaultdict
 
 from . import matrix_utils
 from .matrix_utils import list_all_keys, block_key_to_block, get_local_matrix, key_exists_async
 from . import utils
+from . import client_pool
+from .block_store import get_block_store
+from .exceptions import BlockNotFoundException, ControlPlaneException
+from .shard_format import encode_block, decode_block, get_codec, content_digest
+from . import block_manifest
 
 cpu_count = multiprocessing.cpu_count()
 logger = logging.getLogger('numpywren')
@@ -67,6 +73,19 @@ class BigMatrix(object):
         Squeeze all 1-dimensional entries when calling get_block, and put_block's input shape must be shard_size except without 1 dimensionally entries
     lambdav: float, optional
         add a floating point value to diagonal (square matrices only)
+    store : BlockStore or string, optional
+        The block store holding the shards and header of this matrix. Either a
+        BlockStore instance or a spec understood by block_store.get_block_store
+        such as "s3", "local:/path" or "shm". Defaults to the
+        NUMPYWREN_BLOCK_STORE environment variable, or S3 if it is unset.
+    codec : string, optional
+        Compression codec for the shards of this matrix, one of "zlib",
+        "lz4", "zstd" or "blosc". Each block is only stored compressed if it
+        is large enough and compresses well. Stored in the header.
+    manifest : BlockManifest, optional
+        Record of written blocks. When set together with parent_fn, reads of
+        blocks the manifest has never seen written are served by parent_fn
+        without touching the block store.
 
     Notes
     -----
@@ -86,7 +105,10 @@ class BigMatrix(object):
                  autosqueeze=True,
                  lambdav=0.0,
                  region=DEFAULT_REGION,
-                 safe=True):
+                 safe=True,
+                 store=None,
+                 manifest=None,
+                 codec=None):
         if bucket is None:
             bucket = os.environ.get('PYWREN_LINALG_BUCKET')
             if bucket is None:
@@ -103,6 +125,9 @@ class BigMatrix(object):
         self.autosqueeze = autosqueeze
         self.lambdav = lambdav
         self.region = region
+        self.store = get_block_store(store, region=region)
+        self.manifest = manifest
+        self.codec = codec
         if (shape == None or shard_sizes == None):
             header = self.__read_header__()
         else:
@@ -114,6 +139,7 @@ class BigMatrix(object):
             self.shard_sizes = header['shard_sizes']
             self.shape = header['shape']
             self.dtype = self.__decode_dtype__(header['dtype'])
+            self.codec = header.get('codec', codec)
         else:
             # Initialize the matrix parameters from inputs.
             self.shape = shape
@@ -122,6 +148,8 @@ class BigMatrix(object):
 
         if (self.shard_sizes is None) or (len(self.shape) != len(self.shard_sizes)):
             raise Exception("shard_sizes should be same length as shape.")
+        # fail early if the codec is unknown or its package is missing
+        get_codec(self.codec)
         self.symmetric = False
         if write_header:
             # Write a header if you want to load this value later.
@@ -174,7 +202,7 @@ class BigMatrix(object):
             each tuple stores the start and end indices of the block along a
             dimension.
         """
-        all_keys = list_all_keys(self.bucket, self.key_base)
+        all_keys = list_all_keys(self.bucket, self.key_base, store=self.store)
         return list(filter(lambda x: x is not None, map(block_key_to_block, all_keys)))
 
     @property
@@ -263,14 +291,20 @@ class BigMatrix(object):
     def true_block_idx(self, *block_idx):
         return block_idx
 
-    def get_block(self, *block_idx):
+    def _run_sync(self, coro_fn, *args):
         loop = asyncio.new_event_loop()
-        #asyncio.set_event_loop(loop)
-        get_block_async_coro = self.get_block_async(loop, *block_idx)
-        res = loop.run_until_complete(asyncio.ensure_future(get_block_async_coro, loop=loop))
+        try:
+            res = loop.run_until_complete(asyncio.ensure_future(coro_fn(loop, *args), loop=loop))
+        finally:
+            # pooled clients are bound to this loop, release them before it goes away
+            loop.run_until_complete(client_pool.close_pool(loop))
+            loop.close()
         return res
 
-    async def get_block_async(self, loop, *block_idx):
+    def get_block(self, *block_idx):
+        return self._run_sync(self.get_block_async, *block_idx)
+
+    async def get_block_async(self, loop, *block_idx, stats=None):
         """
         Given a block index, get the contents of the block.
 
@@ -278,6 +312,9 @@ class BigMatrix(object):
         ----------
         block_idx : int or sequence of ints
             The index of the block to retrieve.
+        stats : dict, optional
+            If given, "wire_bytes" is incremented by the number of bytes
+            fetched from the block store.
 
         Returns
         -------
@@ -291,31 +328,41 @@ class BigMatrix(object):
             print("shape", self.shape)
             raise Exception("Get block query does not match shape {0} vs {1}".format(block_idx, self.shape))
         key = self.__shard_idx_to_key__(block_idx)
-        exists = await key_exists_async(self.bucket, key, loop)
-        if (not exists and dill.loads(self.parent_fn) == None):
-            logger.warning(self.bucket)
-            logger.warning(key)
-            logger.warning(block_idx)
-            raise Exception("Key does {0} not exist, and no parent function prescripted".format(key))
-        elif (not exists and dill.loads(self.parent_fn) != None):
-            X_block = await dill.loads(self.parent_fn)(self, loop, *block_idx)
+        parent_fn = self.__parent_fn__()
+        state, target = await self.__manifest_entry__(block_idx, loop)
+        if (state == block_manifest.ZERO):
+            X_block = np.zeros(self.__block_shape__(block_idx), dtype=self.dtype)
+        elif (parent_fn != None and state == block_manifest.MISSING):
+            X_block = await parent_fn(self, loop, *block_idx)
         else:
-            bio = await self.__s3_key_to_byte_io__(key, loop=loop)
-            X_block = np.load(bio)
+            # optimistically GET the block, only a missing key falls back to parent_fn
+            try:
+                if (state == block_manifest.ALIAS):
+                    X_block = await self.__s3_key_to_block__(target[1], loop=loop, stats=stats, bucket=target[0])
+                    X_block = X_block.reshape(self.__block_shape__(block_idx))
+                else:
+                    X_block = await self.__s3_key_to_block__(key, loop=loop, stats=stats)
+            except BlockNotFoundException:
+                if (parent_fn == None):
+                    logger.warning(self.bucket)
+                    logger.warning(key)
+                    logger.warning(block_idx)
+                    raise Exception("Key does {0} not exist, and no parent function prescripted".format(key))
+                X_block = await parent_fn(self, loop, *block_idx)
         if (self.autosqueeze):
             X_block = np.squeeze(X_block)
         if (len(set(block_idx)) == 1 and len(set(self.shape)) == 1 and len(self.shape) != 1):
-            idxs = np.diag_indices(X_block.shape[0])
-            X_block[idxs] += self.lambdav
+            if (self.lambdav != 0):
+                if (not X_block.flags.writeable):
+                    X_block = X_block.copy()
+                idxs = np.diag_indices(X_block.shape[0])
+                X_block[idxs] += self.lambdav
         return X_block
 
     def put_block(self, block, *block_idx):
-        loop = asyncio.new_event_loop()
-        put_block_async_coro = self.put_block_async(block, loop, *block_idx)
-        res = loop.run_until_complete(asyncio.ensure_future(put_block_async_coro, loop=loop))
-        return res
+        return self._run_sync(lambda loop, *idx: self.put_block_async(block, loop, *idx), *block_idx)
 
-    async def put_block_async(self, block, loop=None, *block_idx, no_overwrite=False):
+    async def put_block_async(self, block, loop=None, *block_idx, no_overwrite=False, stats=None, layout=None):
         """
         Given a block index, sets the contents of the block.
 
@@ -325,12 +372,19 @@ class BigMatrix(object):
             The array to set the block to.
         block_idx : int or sequence of ints
             The index of the block to set.
+        stats : dict, optional
+            If given, "wire_bytes" is incremented by the number of bytes
+            sent to the block store.
+        layout : string, optional
+            "lower" or "upper" if the block is known to be triangular, only
+            the triangle is then stored. Blocks that turn out not to be
+            triangular are stored densely.
 
         Returns
         -------
         response : dict
-            The response from S3 containing information on the status of
-            the put request.
+            The response from the block store containing information on the
+            status of the put request.
 
         Notes
         -----
@@ -342,7 +396,7 @@ class BigMatrix(object):
 
         key = self.__shard_idx_to_key__(block_idx)
         if (no_overwrite):
-            exists = await key_exists_async(self.bucket, key, loop)
+            exists = await key_exists_async(self.bucket, key, loop, store=self.store)
             if (exists):
                 old_block = await self.get_block_async(loop, *block_idx)
                 assert(np.allclose(old_block, block))
@@ -358,13 +412,22 @@ class BigMatrix(object):
             raise Exception("{2} Incompatible block size: {0} vs {1}".format(block.shape, current_shape, self))
 
         #block = block.astype(self.dtype)
-        return await self.__save_matrix_to_s3__(block, key, loop)
+        # manifest updates are single redis round trips run off the event loop
+        digest = None
+        if (self.manifest != None and getattr(self.manifest, "dedup", False)):
+            digest = content_digest(block)
+            target, refs = await loop.run_in_executor(None, self.manifest.claim_content, self, block_idx, digest)
+            if (target != None):
+                # identical contents already stored, here or under another key
+                return None
+            await self.__materialize_references__(key, loop, refs=refs)
+        resp = await self.__save_matrix_to_s3__(block, key, loop, stats=stats, layout=layout)
+        if (self.manifest != None):
+            await loop.run_in_executor(None, self.manifest.mark_written, self, block_idx, digest)
+        return resp
 
     def delete_block(self, block, *block_idx):
-        loop = asyncio.new_event_loop()
-        delete_block_async_coro = self.delete_block_async(loop, block, *block_idx)
-        res = loop.run_until_complete(asyncio.ensure_future(delete_block_async_coro, loop=loop))
-        return res
+        return self._run_sync(self.delete_block_async, block, *block_idx)
 
     async def delete_block_async(self, loop=None, *block_idx):
         """
@@ -390,15 +453,18 @@ class BigMatrix(object):
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
         key = self.__shard_idx_to_key__(block_idx)
-        session = aiobotocore.get_session(loop=loop)
-        async with session.create_client('s3', use_ssl=False, verify=False, region_name=self.region) as client:
-            resp = await client.delete_object(Key=key, Bucket=self.bucket)
+        if (self.manifest != None):
+            await self.__materialize_references__(key, loop)
+            await loop.run_in_executor(None, self.manifest.mark_deleted, self, block_idx)
+        resp = await self.store.delete_async(self.bucket, key, loop=loop)
         return resp
 
     def free(self):
         """Delete all allocated blocks while leaving the matrix metadata intact."""
 
         [self.delete_block(*x) for x in self.block_idxs_exist]
+        if (self.manifest != None):
+            self.manifest.clear(self)
         return 0
 
     def delete(self):
@@ -445,6 +511,82 @@ class BigMatrix(object):
     def _register_parent(self, parent_fn):
         self.parent_fn = parent_fn
 
+    def __parent_fn__(self):
+        ''' Deserialized parent_fn, cached until parent_fn is reassigned '''
+        cached = self.__dict__.get("_parent_fn_cache")
+        if (cached == None or cached[0] is not self.parent_fn):
+            parent_fn = self.parent_fn
+            if (isinstance(parent_fn, bytes)):
+                parent_fn = dill.loads(parent_fn)
+            cached = (self.parent_fn, parent_fn)
+            self._parent_fn_cache = cached
+        return cached[1]
+
+    async def __manifest_entry__(self, block_idx, loop):
+        '''
+        Manifest state of block_idx, WRITTEN if there is no manifest. Raises
+        ControlPlaneException if the manifest can't be reached, zero and
+        alias blocks can't be told apart from missing ones without it.
+        '''
+        if (self.manifest == None):
+            return (block_manifest.WRITTEN, None)
+        try:
+            return await loop.run_in_executor(None, self.manifest.get_entry, self, block_idx)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            raise ControlPlaneException("Block manifest unavailable for {0}: {1}".format(self.key, e))
+
+    def __block_shape__(self, block_idx):
+        return tuple([e - s for s,e in self.__block_idx_to_real_idx__(block_idx)])
+
+    async def __materialize_references__(self, key, loop, refs=None):
+        '''
+        Give every block aliasing the object at key its own copy, called
+        before that object is overwritten or deleted. refs are looked up in
+        the manifest if not given.
+        '''
+        if (refs == None):
+            refs = await loop.run_in_executor(None, self.manifest.references, self.bucket, key)
+        if (len(refs) == 0):
+            return
+        data = await self.store.get_async(self.bucket, key, loop=loop)
+        for ref in refs:
+            await self.store.put_async(ref.bucket, ref.key, data, loop=loop)
+            await loop.run_in_executor(None, self.manifest.resolve_reference, self.bucket, key, ref)
+
+    def mark_zero_block(self, *block_idx):
+        '''
+        Record block_idx as all zeros in the manifest instead of storing it.
+        Returns False if the matrix has no manifest to record it in.
+        '''
+        if (self.manifest == None):
+            return False
+        self.manifest.mark_zero(self, block_idx)
+        return True
+
+    def materialize(self):
+        '''
+        Store a real copy of every block that only exists as a zero or alias
+        entry in the manifest, so the matrix can be read without it.
+        '''
+        if (self.manifest == None):
+            return
+        for block_idx in self.block_idxs:
+            state, target = self.manifest.get_entry(self, block_idx)
+            if (state == block_manifest.ZERO):
+                block = np.zeros(self.__block_shape__(block_idx), dtype=self.dtype)
+            elif (state == block_manifest.ALIAS):
+                block = decode_block(self.store.get(*target)).reshape(self.__block_shape__(block_idx))
+            else:
+                continue
+            key = self.__shard_idx_to_key__(block_idx)
+            self.store.put(self.bucket, key, encode_block(block, codec=self.codec))
+            self.manifest.mark_written(self, block_idx)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_parent_fn_cache", None)
+        return state
+
     def _block_idxs(self, axis=None):
         idxs = [list(range(len(self._blocks(axis=i)))) for i in range(len(self.shape))]
         if axis is None:
@@ -464,19 +606,16 @@ class BigMatrix(object):
             return os.path.join(self.key_base, key_string)
 
     def __read_header__(self):
-        client = boto3.client('s3')
         try:
             key = os.path.join(self.key_base, "header")
-            header = json.loads(client.get_object(Bucket=self.bucket,
-                                                  Key=key)['Body'].read().decode('utf-8'))
+            header = json.loads(self.store.get(self.bucket, key).decode('utf-8'))
         except Exception as e:
             header = None
         return header
 
     def __delete_header__(self):
         key = os.path.join(self.key_base, "header")
-        client = boto3.client('s3')
-        client.delete_object(Bucket=self.bucket, Key=key)
+        self.store.delete(self.bucket, key)
 
     def __block_idx_to_real_idx__(self, block_idx):
         starts = []
@@ -494,55 +633,36 @@ class BigMatrix(object):
         key = self.__get_matrix_shard_key__(real_idxs)
         return key
 
-    async def __s3_key_to_byte_io__(self, key, loop=None):
+    async def __s3_key_to_block__(self, key, loop=None, stats=None, bucket=None):
         if (loop == None):
             loop = asyncio.get_event_loop()
-
-        session = aiobotocore.get_session(loop=loop)
-        async with session.create_client('s3', use_ssl=False, verify=False, region_name=self.region) as client:
-            n_tries = 0
-            max_n_tries = 5
-            bio = None
-            while bio is None and n_tries <= max_n_tries:
-                try:
-                    resp = await client.get_object(Bucket=self.bucket, Key=key)
-                    async with resp['Body'] as stream:
-                        matrix_bytes = await stream.read()
-                    bio = io.BytesIO(matrix_bytes)
-                except Exception as e:
-                    raise
-                    n_tries += 1
-        if bio is None:
-            raise Exception("S3 Read Failed")
-        return bio
-
-    async def __save_matrix_to_s3__(self, X, out_key, loop, client=None):
+        if (bucket == None):
+            bucket = self.bucket
+        matrix_bytes = await self.store.get_async(bucket, key, loop=loop)
+        if (stats != None):
+            stats["wire_bytes"] = stats.get("wire_bytes", 0) + len(matrix_bytes)
+        return decode_block(matrix_bytes)
+
+    async def __save_matrix_to_s3__(self, X, out_key, loop, client=None, stats=None, layout=None):
         if (loop == None):
             loop = asyncio.get_event_loop()
-
-        session = aiobotocore.get_session(loop=loop)
-        async with session.create_client('s3', use_ssl=False, verify=False, region_name=self.region) as client:
-            outb = io.BytesIO()
-            np.save(outb, X)
-            response = await client.put_object(Key=out_key,
-                                         Bucket=self.bucket,
-                                         Body=outb.getvalue(),
-                                         ACL="bucket-owner-full-control")
-            del outb
-            del X
+        outb = encode_block(X, codec=self.codec, layout=layout)
+        if (stats != None):
+            stats["wire_bytes"] = stats.get("wire_bytes", 0) + len(outb)
+        response = await self.store.put_async(self.bucket, out_key, outb, loop=loop)
+        del outb
+        del X
         return None
 
     def __write_header__(self):
         key = os.path.join(self.key_base, "header")
-        client = boto3.client('s3')
         header = {}
         header['shape'] = self.shape
         header['shard_sizes'] = self.shard_sizes
         header['dtype'] = self.__encode_dtype__(self.dtype)
-        client.put_object(Key=key,
-                          Bucket=self.bucket,
-                          Body=json.dumps(header),
-                          ACL="bucket-owner-full-control")
+        if (self.codec != None):
+            header['codec'] = self.codec
+        self.store.put(self.bucket, key, json.dumps(header))
 
     def __encode_dtype__(self, dtype):
         dtype_pickle = pickle.dumps(dtype)
@@ -568,6 +688,9 @@ class BigMatrixView(BigMatrix):
         self.key = parent.key
         self.key_base = parent.key_base 
         self.dtype = parent.dtype
+        self.store = parent.store
+        self.manifest = parent.manifest
+        self.codec = parent.codec
 
         # Initialize all size information.
         self.shard_sizes = parent.shard_sizes
@@ -647,9 +770,9 @@ class BigMatrixView(BigMatrix):
             block = block.T
         return block
 
-    async def get_block_async(self, loop, *block_idx):
+    async def get_block_async(self, loop, *block_idx, stats=None):
         parent_idx = self.__view_to_parent_block_idx__(block_idx)
-        block = await self.parent.get_block_async(loop, *parent_idx)
+        block = await self.parent.get_block_async(loop, *parent_idx, stats=stats)
         if self.transposed:
             block = block.T
         return block
@@ -660,16 +783,21 @@ class BigMatrixView(BigMatrix):
         parent_idx = self.__view_to_parent_block_idx__(block_idx)
         return self.parent.put_block(block, *parent_idx)
 
-    async def put_block_async(self, block, loop=None, *block_idx):
+    async def put_block_async(self, block, loop=None, *block_idx, stats=None, layout=None):
         if self.transposed:
             block = block.T
+            layout = {"lower": "upper", "upper": "lower"}.get(layout, layout)
         parent_idx = self.__view_to_parent_block_idx__(block_idx)
-        return await self.parent.put_block_async(block, loop, *parent_idx)
+        return await self.parent.put_block_async(block, loop, *parent_idx, stats=stats, layout=layout)
 
     def delete_block(self, *block_idx):
         parent_idx = self.__view_to_parent_block_idx__(block_idx)
         return self.parent.delete_block(*parent_idx)
 
+    def mark_zero_block(self, *block_idx):
+        parent_idx = self.__view_to_parent_block_idx__(block_idx)
+        return self.parent.mark_zero_block(*parent_idx)
+
     async def delete_block_async(self, loop, *block_idx):
         parent_idx = self.__view_to_parent_block_idx__(block_idx)
         return await self.parent.delete_block(loop, *parent_idx)
@@ -787,7 +915,7 @@ class RowPivotedBigMatrix(BigMatrix):
         if (len(permutation_dict) >  4.0 * matrix.shard_sizes[0]):
             logger.warning("Permutation seems to permute *too many* rows consider doing a full shuffle")
         self.matrix = matrix
-        super().__init__(self, key=matrix.key, shape=matrix.shape, shard_sizes=matrix.shard_sizes, bucket=matrix.bucket, prefix=matrix.prefix, dtype=matrix.dtype, parent_fn=matrix.parent_fn, write_header=matrix_write_header, autosqueeze=matrix.autosqueeze, lambdav=matrix.lambdav, region=matrix.region)
+        super().__init__(self, key=matrix.key, shape=matrix.shape, shard_sizes=matrix.shard_sizes, bucket=matrix.bucket, prefix=matrix.prefix, dtype=matrix.dtype, parent_fn=matrix.parent_fn, write_header=matrix_write_header, autosqueeze=matrix.autosqueeze, lambdav=matrix.lambdav, region=matrix.region, codec=matrix.codec)
         self.permutation_dict = permutation_dict
         self.block_permutation_dict = collections.defaultdict(list)
         for in_row, out_row in self.permutation_dict.items():
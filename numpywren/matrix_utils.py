@@ -15,6 +15,8 @@ import inspect
 import multiprocessing
 import aiobotocore
 
+from .block_store import S3BlockStore
+
 cpu_count = multiprocessing.cpu_count()
 
 class MmapArray():
@@ -79,46 +81,22 @@ def generate_key_name_local_matrix(X_local):
 def load_mmap(mmap_loc, mmap_shape, mmap_dtype):
     return np.memmap(mmap_loc, dtype=mmap_dtype, mode='r+', shape=mmap_shape)
 
-def list_all_keys(bucket, prefix):
-    client = boto3.client('s3')
-    objects = client.list_objects(Bucket=bucket, Prefix=prefix + "/", Delimiter=prefix)
-    if (objects.get('Contents') == None):
-        return []
-    keys = list(map(lambda x: x['Key'], objects.get('Contents', [] )))
-    truncated = objects['IsTruncated']
-    next_marker = objects.get('NextMarker')
-    while truncated:
-        objects = client.list_objects(Bucket=bucket, Prefix=prefix,
-                                      Delimiter=prefix, Marker=next_marker)
-        truncated = objects['IsTruncated']
-        next_marker = objects.get('NextMarker')
-        keys += list(map(lambda x: x['Key'], objects['Contents']))
-    return list(filter(lambda x: len(x) > 0, keys))
-
-def key_exists(bucket, key):
+def list_all_keys(bucket, prefix, store=None):
+    if (store is None):
+        store = S3BlockStore()
+    return store.list_keys(bucket, prefix)
+
+def key_exists(bucket, key, store=None):
     '''Return true if a key exists in s3 bucket'''
-    client = boto3.client('s3')
-    try:
-        obj = client.head_object(Bucket=bucket, Key=key)
-        return True
-    except botocore.exceptions.ClientError as exc:
-        if exc.response['Error']['Code'] != '404':
-            raise
-        return False
-
-async def key_exists_async(bucket, key, loop=None):
+    if (store is None):
+        store = S3BlockStore()
+    return store.exists(bucket, key)
+
+async def key_exists_async(bucket, key, loop=None, store=None):
     '''Return true if a key exists in s3 bucket'''
-    session = aiobotocore.get_session(loop=loop)
-    async with session.create_client('s3', use_ssl=False, verify=False) as client:
-        try:
-            obj = await client.head_object(Bucket=bucket, Key=key)
-            resp = True
-        except botocore.exceptions.ClientError as exc:
-            if exc.response['Error']['Code'] != '404':
-                raise
-            else:
-                resp = False
-    return resp
+    if (store is None):
+        store = S3BlockStore()
+    return await store.exists_async(bucket, key, loop=loop)
 
 def block_key_to_block(key):
     try:
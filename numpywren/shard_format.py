@@ -0,0 +1,270 @@
+'''
+On-storage format of BigMatrix shards.
+
+A shard is a fixed 128 byte header followed by the raw array bytes:
+
+    magic      4s   b"NPWB"
+    version    B    SHARD_VERSION
+    order      c    b"C" or b"F"
+    ndim       B    at most MAX_NDIM
+    codec      B    id of the codec the body is compressed with, 0 if raw
+    dtype      16s  numpy dtype string, e.g. b"<f8"
+    checksum   I    crc32 of the body as stored
+    nbytes     Q    length of the body as stored
+    shape      8Q   dimensions, unused entries are 0
+    layout     B    0 dense, 1 lower triangle packed, 2 upper triangle packed
+
+The body can be handed straight to np.frombuffer so reading a block does not
+copy it again after it comes off the wire. Blocks known to be triangular
+(see the layouts annotation of kernels) can instead store only their
+triangle, row by row, which the reader expands back to a dense block. Arrays that cannot be expressed in
+this format (object dtypes, more than MAX_NDIM dimensions) and shards written
+by older versions of numpywren use the .npy format, which is still read
+transparently.
+
+Bodies may be compressed with one of CODECS. lz4, zstd and blosc are only
+available when the matching python package is installed, zlib always is.
+'''
+from functools import lru_cache
+import hashlib
+import io
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .exceptions import CorruptShardException
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+SHARD_MAGIC = b"NPWB"
+SHARD_VERSION = 2
+MAX_NDIM = 8
+NPY_MAGIC = b"\x93NUMPY"
+
+_HEADER = struct.Struct("<4sBcBB16sIQ{0}QB27x".format(MAX_NDIM))
+HEADER_SIZE = _HEADER.size
+
+LAYOUTS = {"dense": 0, "lower": 1, "upper": 2}
+
+# blocks smaller than this are never compressed
+MIN_COMPRESS_BYTES = int(os.environ.get("NUMPYWREN_MIN_COMPRESS_BYTES", 1 << 16))
+# a block is stored raw unless its compressed size is below this fraction
+MAX_COMPRESS_RATIO = float(os.environ.get("NUMPYWREN_MAX_COMPRESS_RATIO", 0.8))
+# amount of data compressed to estimate the ratio before doing the full block
+COMPRESS_SAMPLE_BYTES = 1 << 16
+COMPRESS_SAMPLE_CHUNKS = 8
+
+
+class Codec(object):
+    def __init__(self, name, codec_id, module, compress, decompress):
+        self.name = name
+        self.codec_id = codec_id
+        self.module = module
+        self.compress = compress
+        self.decompress = decompress
+
+    @property
+    def available(self):
+        return self.module is not None
+
+
+def _zstd_compress(body, itemsize):
+    return zstandard.ZstdCompressor(level=1).compress(body)
+
+def _zstd_decompress(body, nbytes):
+    return zstandard.ZstdDecompressor().decompress(body, max_output_size=nbytes)
+
+def _blosc_compress(body, itemsize):
+    return blosc.compress(body, typesize=itemsize, cname="lz4")
+
+def _blosc_decompress(body, nbytes):
+    return blosc.decompress(body, as_bytearray=True)
+
+CODECS = {}
+for _codec in [Codec("zlib", 1, zlib,
+                     lambda body, itemsize: zlib.compress(body, 1),
+                     lambda body, nbytes: zlib.decompress(body, bufsize=nbytes)),
+               Codec("lz4", 2, lz4,
+                     lambda body, itemsize: lz4.frame.compress(body),
+                     lambda body, nbytes: lz4.frame.decompress(body, return_bytearray=True)),
+               Codec("zstd", 3, zstandard, _zstd_compress, _zstd_decompress),
+               Codec("blosc", 4, blosc, _blosc_compress, _blosc_decompress)]:
+    CODECS[_codec.name] = _codec
+    CODECS[_codec.codec_id] = _codec
+
+
+def get_codec(codec):
+    ''' Look up a codec by name or id, None means no compression '''
+    if (codec is None or codec == 0):
+        return None
+    if (codec not in CODECS):
+        raise CorruptShardException("Unknown shard codec {0}".format(codec))
+    codec = CODECS[codec]
+    if (not codec.available):
+        raise ImportError("Shard codec {0} requires a package that is not installed".format(codec.name))
+    return codec
+
+
+def _compress_body(body, itemsize, codec):
+    ''' Compressed body, or None if the block is too small or compresses poorly '''
+    if (codec is None or body.nbytes < MIN_COMPRESS_BYTES):
+        return None
+    if (body.nbytes > 2*COMPRESS_SAMPLE_BYTES):
+        # sample evenly spaced chunks, blocks such as triangular factors are
+        # far from uniform so a prefix is a poor estimate
+        step = body.nbytes // COMPRESS_SAMPLE_CHUNKS
+        chunk_size = COMPRESS_SAMPLE_BYTES // COMPRESS_SAMPLE_CHUNKS
+        sample = b"".join([body[i*step:i*step + chunk_size] for i in range(COMPRESS_SAMPLE_CHUNKS)])
+        if (len(codec.compress(sample, itemsize)) > MAX_COMPRESS_RATIO*len(sample)):
+            return None
+    compressed = codec.compress(body, itemsize)
+    if (len(compressed) > MAX_COMPRESS_RATIO*body.nbytes):
+        return None
+    return compressed
+
+
+@lru_cache(maxsize=64)
+def _triangle_indices(shape, layout):
+    ''' Indices of the stored triangle, row by row, and of the rest of a matrix '''
+    m, n = shape
+    if (layout == LAYOUTS["lower"]):
+        return np.tril_indices(m, 0, n), np.triu_indices(m, 1, n)
+    else:
+        return np.triu_indices(m, 0, n), np.tril_indices(m, -1, n)
+
+
+def _matrix_view(X):
+    ''' X as a 2-D matrix with its unit dimensions dropped, or None '''
+    shape = [d for d in X.shape if d != 1]
+    if (len(shape) != 2):
+        return None
+    return X.reshape(shape)
+
+
+def pack_triangle(X, layout):
+    '''
+    Return the lower or upper triangle of X packed row by row, or None if X
+    is not a matrix or has nonzeros outside of the triangle.
+    '''
+    layout = LAYOUTS[layout]
+    M = _matrix_view(X)
+    if (M is None or layout == LAYOUTS["dense"]):
+        return None
+    stored, rest = _triangle_indices(M.shape, layout)
+    if (M[rest].any()):
+        return None
+    return M[stored]
+
+
+def unpack_triangle(packed, shape, layout):
+    M = np.zeros([d for d in shape if d != 1], dtype=packed.dtype)
+    stored, _ = _triangle_indices(M.shape, layout)
+    M[stored] = packed
+    return M.reshape(shape)
+
+
+def encode_block(X, codec=None, layout=None):
+    '''
+    Serialize X into a single buffer ready to be uploaded. Uncompressed, the
+    array is copied exactly once, from its memoryview into the buffer after
+    the header. If codec is given the body is compressed with it whenever
+    that pays off. If layout is "lower" or "upper" and X really is triangular
+    only that triangle is stored.
+    '''
+    codec = get_codec(codec)
+    X = np.asanyarray(X)
+    if (X.dtype.hasobject or X.ndim > MAX_NDIM):
+        outb = io.BytesIO()
+        np.save(outb, X)
+        return outb.getbuffer()
+    if (X.flags.c_contiguous):
+        order = b"C"
+    elif (X.flags.f_contiguous):
+        order = b"F"
+    else:
+        X = np.ascontiguousarray(X)
+        order = b"C"
+    layout_id = 0
+    packed = None
+    if (layout != None):
+        packed = pack_triangle(X, layout)
+    if (packed is not None):
+        layout_id = LAYOUTS[layout]
+        order = b"C"
+        body = memoryview(packed).cast("B")
+    else:
+        body = memoryview(X.reshape(-1, order="A")).cast("B")
+    codec_id = 0
+    compressed = _compress_body(body, X.dtype.itemsize, codec)
+    if (compressed is not None):
+        body = memoryview(compressed)
+        codec_id = codec.codec_id
+    shape = list(X.shape) + [0]*(MAX_NDIM - X.ndim)
+    out = bytearray(HEADER_SIZE + body.nbytes)
+    _HEADER.pack_into(out, 0, SHARD_MAGIC, SHARD_VERSION, order, X.ndim, codec_id,
+                      X.dtype.str.encode('ascii'), zlib.crc32(body), body.nbytes, *shape, layout_id)
+    out[HEADER_SIZE:] = body
+    return out
+
+
+def content_digest(X):
+    '''
+    Digest identifying the contents of X for deduplication, unit dimensions
+    and memory order do not matter. None for arrays that cannot be hashed.
+    '''
+    X = np.asanyarray(X)
+    if (X.dtype.hasobject):
+        return None
+    X = np.ascontiguousarray(X)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(X.dtype.str.encode('ascii'))
+    h.update(str([d for d in X.shape if d != 1]).encode('ascii'))
+    h.update(memoryview(X.reshape(-1)).cast("B"))
+    return h.hexdigest()
+
+
+def decode_block(data):
+    '''
+    Deserialize a shard produced by encode_block (or np.save). Unless the
+    shard is packed, the returned array is a view of data, it is writeable
+    only if data is.
+    '''
+    if (bytes(data[:len(NPY_MAGIC)]) == NPY_MAGIC):
+        return np.load(io.BytesIO(data), allow_pickle=True)
+    if (bytes(data[:len(SHARD_MAGIC)]) != SHARD_MAGIC or len(data) < HEADER_SIZE):
+        raise CorruptShardException("Unrecognized shard format")
+    magic, version, order, ndim, codec, dtype, checksum, nbytes, *shape, layout = _HEADER.unpack_from(data, 0)
+    if (version > SHARD_VERSION):
+        raise CorruptShardException("Shard version {0} is newer than supported version {1}".format(version, SHARD_VERSION))
+    codec = get_codec(codec)
+    body = memoryview(data)[HEADER_SIZE:]
+    if (body.nbytes != nbytes):
+        raise CorruptShardException("Truncated shard, expected {0} bytes got {1}".format(nbytes, body.nbytes))
+    if (zlib.crc32(body) != checksum):
+        raise CorruptShardException("Shard checksum mismatch")
+    dtype = np.dtype(dtype.rstrip(b"\x00").decode('ascii'))
+    if (codec is not None):
+        body = codec.decompress(body, int(np.prod(shape[:ndim]))*dtype.itemsize)
+        if (isinstance(body, bytes)):
+            body = bytearray(body)
+    X = np.frombuffer(body, dtype=dtype)
+    if (layout != LAYOUTS["dense"]):
+        if (layout not in LAYOUTS.values()):
+            raise CorruptShardException("Unknown shard layout {0}".format(layout))
+        return unpack_triangle(X, shape[:ndim], layout)
+    return X.reshape(shape[:ndim], order=order.decode('ascii'))
@@ -0,0 +1,512 @@
+'''
+Queues the runtime hands ready nodes out through.
+
+A TaskQueue delivers every message at least once: a received message stays
+invisible to other receivers for a visibility timeout, is redelivered if it
+is not deleted before the timeout runs out, and can have its timeout
+extended while it is being worked on. Three implementations are provided:
+
+    SQSTaskQueue       an SQS queue, for workers on lambda
+    RedisTaskQueue     lists on the control plane redis, for workers close to
+                       the control plane
+    InMemoryTaskQueue  process local, for single node runs and tests
+
+Sending is synchronous since it happens from the driver and from post_op
+threads, receiving, extending and deleting are coroutines used by the
+job runner.
+'''
+import abc
+import asyncio
+from collections import defaultdict, namedtuple, deque
+import concurrent.futures as fs
+import os
+import threading
+import time
+import uuid
+
+import boto3
+
+from numpywren import client_pool
+
+# default backend, one of TASK_QUEUES
+DEFAULT_TASK_QUEUE = os.environ.get("NUMPYWREN_TASK_QUEUE", "sqs")
+# most messages one receive call returns (the SQS limit)
+RECEIVE_BATCH_SIZE = 10
+# SQS accepts at most 10 messages per send_message_batch call
+SQS_BATCH_SIZE = 10
+# seconds a TaskFetcher long polls each queue for once they all came back
+# empty, short so a task sent to any queue is seen within a round
+RECEIVE_WAIT_TIME = int(os.environ.get("NUMPYWREN_RECEIVE_WAIT_TIME", 1))
+# longest visibility timeout SQS accepts
+MAX_VISIBILITY_TIMEOUT = 43200
+# leases are this many times the longest recently observed task duration
+LEASE_FACTOR = 2
+
+Task = namedtuple("Task", ["body", "handle", "message_id"])
+
+
+def _chunk(l, n):
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def send_message_batches(sqs_client, queue_url, bodies, num_threads=1, max_tries=5):
+    ''' Send bodies to queue_url with send_message_batch calls of SQS_BATCH_SIZE
+        messages, spread over num_threads threads. Entries SQS reports as failed
+        are resent, returns the number of send_message_batch calls made
+    '''
+    batches = list(_chunk(bodies, SQS_BATCH_SIZE))
+    def send_batch(batch):
+        entries = [{"Id": str(i), "MessageBody": body} for i, body in enumerate(batch)]
+        calls = 0
+        backoff = 0.1
+        for _ in range(max_tries):
+            resp = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+            calls += 1
+            failed = set([x["Id"] for x in resp.get("Failed", [])])
+            entries = [x for x in entries if x["Id"] in failed]
+            if (len(entries) == 0):
+                return calls
+            time.sleep(backoff)
+            backoff *= 2
+        raise Exception("Failed to enqueue {0} messages to {1}".format(len(entries), queue_url))
+    if (num_threads <= 1 or len(batches) <= 1):
+        return sum([send_batch(b) for b in batches])
+    with fs.ThreadPoolExecutor(num_threads) as executor:
+        return sum(executor.map(send_batch, batches))
+
+
+class TaskQueue(abc.ABC):
+    @abc.abstractmethod
+    def create(self):
+        ''' Create the queue (empty) if it does not exist '''
+        pass
+
+    @abc.abstractmethod
+    def destroy(self):
+        pass
+
+    @abc.abstractmethod
+    def send_batch(self, bodies, num_threads=1):
+        ''' Enqueue every string in bodies '''
+        pass
+
+    @abc.abstractmethod
+    async def receive_batch(self, max_messages=1, visibility_timeout=200, wait_time=0, loop=None):
+        ''' List of at most max_messages Tasks, waiting up to wait_time seconds for one '''
+        pass
+
+    @abc.abstractmethod
+    async def extend_visibility(self, task, timeout, loop=None):
+        ''' Keep task invisible to other receivers for another timeout seconds '''
+        pass
+
+    @abc.abstractmethod
+    async def delete(self, task, loop=None):
+        ''' Remove a received task for good '''
+        pass
+
+    async def extend_visibility_batch(self, tasks, timeout, loop=None):
+        for task in tasks:
+            await self.extend_visibility(task, timeout, loop=loop)
+
+    async def release(self, tasks, loop=None):
+        ''' Give received tasks back, making them visible to receivers again '''
+        await self.extend_visibility_batch(tasks, 0, loop=loop)
+
+
+class SQSTaskQueue(TaskQueue):
+    def __init__(self, name, region):
+        self.name = name
+        self.region = region
+        self.queue_url = None
+
+    def _client(self):
+        return boto3.client('sqs', region_name=self.region)
+
+    def create(self):
+        client = self._client()
+        self.queue_url = client.create_queue(QueueName=self.name)["QueueUrl"]
+        client.purge_queue(QueueUrl=self.queue_url)
+
+    def destroy(self):
+        self._client().delete_queue(QueueUrl=self.queue_url)
+
+    def send_batch(self, bodies, num_threads=1):
+        send_message_batches(self._client(), self.queue_url, bodies, num_threads=num_threads)
+
+    async def receive_batch(self, max_messages=1, visibility_timeout=200, wait_time=0, loop=None):
+        sqs_client = await client_pool.get_client('sqs', loop=loop, region_name=self.region)
+        resp = await sqs_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=max_messages,
+                                                VisibilityTimeout=visibility_timeout, WaitTimeSeconds=wait_time)
+        return [Task(msg["Body"], msg["ReceiptHandle"], msg["MessageId"]) for msg in resp.get("Messages", [])]
+
+    async def extend_visibility(self, task, timeout, loop=None):
+        sqs_client = await client_pool.get_client('sqs', loop=loop, region_name=self.region)
+        await sqs_client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=task.handle, VisibilityTimeout=timeout)
+
+    async def extend_visibility_batch(self, tasks, timeout, loop=None):
+        sqs_client = await client_pool.get_client('sqs', loop=loop, region_name=self.region)
+        for c in _chunk(tasks, RECEIVE_BATCH_SIZE):
+            entries = [{"Id": str(i), "ReceiptHandle": task.handle, "VisibilityTimeout": timeout} for i, task in enumerate(c)]
+            resp = await sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            for failed in resp.get("Failed", []):
+                print("Failed to change visibility of {0}: {1}".format(c[int(failed["Id"])].message_id, failed.get("Message")))
+
+    async def delete(self, task, loop=None):
+        sqs_client = await client_pool.get_client('sqs', loop=loop, region_name=self.region)
+        await sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=task.handle)
+
+
+# KEYS: list, inflight zset, bodies hash. ARGV: now, max messages, deadline
+RECEIVE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for i, id in ipairs(expired) do
+  redis.call('ZREM', KEYS[2], id)
+  redis.call('RPUSH', KEYS[1], id)
+end
+local tasks = {}
+for i = 1, tonumber(ARGV[2]) do
+  local id = redis.call('LPOP', KEYS[1])
+  if not id then break end
+  local body = redis.call('HGET', KEYS[3], id)
+  if body then
+    redis.call('ZADD', KEYS[2], ARGV[3], id)
+    table.insert(tasks, id)
+    table.insert(tasks, body)
+  end
+end
+return tasks
+"""
+
+
+class RedisTaskQueue(TaskQueue):
+    '''
+    Message ids wait in a list, bodies live in a hash and received ids sit in
+    a sorted set scored by their visibility deadline. Receiving first moves
+    expired ids back to the list, all in one script.
+    '''
+    def __init__(self, name, control_plane):
+        self.name = name
+        self.control_plane = control_plane
+
+    def _keys(self):
+        return ["{0}_tasks".format(self.name), "{0}_tasks_inflight".format(self.name), "{0}_tasks_bodies".format(self.name)]
+
+    def create(self):
+        self.destroy()
+
+    def destroy(self):
+        self.control_plane.client.delete(*self._keys())
+
+    def send_batch(self, bodies, num_threads=1):
+        list_key, _, bodies_key = self._keys()
+        pipe = self.control_plane.client.pipeline(transaction=False)
+        for c in _chunk(bodies, 1000):
+            ids = [uuid.uuid4().hex for _ in c]
+            pipe.hset(bodies_key, mapping=dict(zip(ids, c)))
+            pipe.rpush(list_key, *ids)
+        pipe.execute()
+
+    async def receive_batch(self, max_messages=1, visibility_timeout=200, wait_time=0, loop=None):
+        script = self.control_plane.client.register_script(RECEIVE_SCRIPT)
+        end = time.time() + wait_time
+        while (True):
+            now = time.time()
+            res = script(keys=self._keys(), args=[now, max_messages, now + visibility_timeout])
+            if (len(res) > 0 or now >= end):
+                break
+            await asyncio.sleep(min(0.05, end - now))
+        tasks = []
+        for i in range(0, len(res), 2):
+            message_id = res[i].decode('utf-8')
+            tasks.append(Task(res[i + 1].decode('utf-8'), message_id, message_id))
+        return tasks
+
+    async def extend_visibility(self, task, timeout, loop=None):
+        self.control_plane.client.zadd(self._keys()[1], {task.handle: time.time() + timeout}, xx=True)
+
+    async def extend_visibility_batch(self, tasks, timeout, loop=None):
+        if (len(tasks) == 0):
+            return
+        deadline = time.time() + timeout
+        self.control_plane.client.zadd(self._keys()[1], {task.handle: deadline for task in tasks}, xx=True)
+
+    async def delete(self, task, loop=None):
+        pipe = self.control_plane.client.pipeline()
+        pipe.zrem(self._keys()[1], task.handle)
+        pipe.hdel(self._keys()[2], task.handle)
+        pipe.execute()
+
+
+class _MemoryQueueState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = deque()
+        self.inflight = {}
+
+
+_memory_queues = {}
+_memory_queues_lock = threading.Lock()
+
+
+class InMemoryTaskQueue(TaskQueue):
+    '''
+    Queue shared by everything in this process that uses the same name. Only
+    the name is pickled so a program shipped to threads or an in-process
+    executor keeps using the same queue.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def _state(self):
+        with _memory_queues_lock:
+            if (self.name not in _memory_queues):
+                _memory_queues[self.name] = _MemoryQueueState()
+            return _memory_queues[self.name]
+
+    def create(self):
+        with _memory_queues_lock:
+            _memory_queues[self.name] = _MemoryQueueState()
+
+    def destroy(self):
+        with _memory_queues_lock:
+            _memory_queues.pop(self.name, None)
+
+    def send_batch(self, bodies, num_threads=1):
+        state = self._state()
+        with state.lock:
+            for body in bodies:
+                state.ready.append((uuid.uuid4().hex, body))
+
+    def _receive(self, max_messages, visibility_timeout):
+        state = self._state()
+        now = time.time()
+        tasks = []
+        with state.lock:
+            for message_id, (body, deadline) in list(state.inflight.items()):
+                if (deadline <= now):
+                    del state.inflight[message_id]
+                    state.ready.append((message_id, body))
+            while (len(tasks) < max_messages and len(state.ready) > 0):
+                message_id, body = state.ready.popleft()
+                state.inflight[message_id] = (body, now + visibility_timeout)
+                tasks.append(Task(body, message_id, message_id))
+        return tasks
+
+    async def receive_batch(self, max_messages=1, visibility_timeout=200, wait_time=0, loop=None):
+        end = time.time() + wait_time
+        while (True):
+            tasks = self._receive(max_messages, visibility_timeout)
+            now = time.time()
+            if (len(tasks) > 0 or now >= end):
+                return tasks
+            await asyncio.sleep(min(0.01, end - now))
+
+    async def extend_visibility(self, task, timeout, loop=None):
+        state = self._state()
+        with state.lock:
+            if (task.handle in state.inflight):
+                state.inflight[task.handle] = (state.inflight[task.handle][0], time.time() + timeout)
+
+    async def delete(self, task, loop=None):
+        state = self._state()
+        with state.lock:
+            state.inflight.pop(task.handle, None)
+
+    def __len__(self):
+        state = self._state()
+        with state.lock:
+            return len(state.ready) + len(state.inflight)
+
+
+class TaskFetcher(object):
+    '''
+    Receives tasks for all the pipeline slots of a worker. Queues are polled
+    from the highest priority down in batches of up to batch_size. Once
+    every queue came back empty, the next round long polls each queue in
+    turn for wait_time seconds, so no queue waits on another's long poll
+    for more than a round. Received tasks wait in a buffer of at most
+    buffer_size tasks, highest priority first, until a slot claims one
+    (along with the time its visibility runs out) with get(). With a
+    LeaseManager, buffered tasks are leased as soon as they arrive so their
+    visibility never runs out while they wait. The buffer is only refilled
+    once it has drained to half full so receives stay batched. close()
+    hands unclaimed tasks back to their queues.
+    '''
+    def __init__(self, queues, loop, buffer_size=RECEIVE_BATCH_SIZE, batch_size=RECEIVE_BATCH_SIZE,
+                 wait_time=RECEIVE_WAIT_TIME, visibility_timeout=200, leases=None):
+        self.queues = queues
+        self.loop = loop
+        self.leases = leases
+        self.batch_size = batch_size
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.buffer = asyncio.PriorityQueue(maxsize=buffer_size, loop=loop)
+        self.low_water = buffer_size // 2
+        self.closed = False
+        self.receive_calls = 0
+        self.received = 0
+        self.released = 0
+        self._claimed = asyncio.Event(loop=loop)
+        self._fetch_task = None
+
+    def start(self):
+        self._fetch_task = self.loop.create_task(self.run())
+        return self._fetch_task
+
+    async def _receive(self, max_messages, wait_time=0):
+        for priority in range(len(self.queues) - 1, -1, -1):
+            queue = self.queues[priority]
+            tasks = await queue.receive_batch(max_messages=max_messages, visibility_timeout=self.visibility_timeout,
+                                              wait_time=wait_time, loop=self.loop)
+            self.receive_calls += 1
+            if (len(tasks) > 0):
+                return priority, queue, tasks
+        return 0, None, []
+
+    async def run(self):
+        idle = False
+        while (not self.closed):
+            if (self.buffer.qsize() > self.low_water):
+                await self._claimed.wait()
+                self._claimed.clear()
+                continue
+            space = self.buffer.maxsize - self.buffer.qsize()
+            try:
+                priority, queue, tasks = await self._receive(min(space, self.batch_size), wait_time=self.wait_time if idle else 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Exception in task fetcher " + str(e))
+                await asyncio.sleep(1)
+                continue
+            idle = (len(tasks) == 0)
+            deadline = time.time() + self.visibility_timeout
+            for task in tasks:
+                self.received += 1
+                if (self.leases is not None):
+                    self.leases.add(queue, task, deadline)
+                self.buffer.put_nowait((-priority, self.received, queue, task, deadline))
+
+    async def get(self, timeout=None):
+        ''' (queue, task, deadline) for the next buffered task, None if none arrived within timeout '''
+        if (self.closed):
+            return None
+        try:
+            _, _, queue, task, deadline = await asyncio.wait_for(self.buffer.get(), timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            return None
+        self._claimed.set()
+        return queue, task, deadline
+
+    async def close(self):
+        self.closed = True
+        if (self._fetch_task is not None):
+            self._fetch_task.cancel()
+            await asyncio.gather(self._fetch_task, loop=self.loop, return_exceptions=True)
+        unclaimed = defaultdict(list)
+        queues = {}
+        while (not self.buffer.empty()):
+            _, _, queue, task, _ = self.buffer.get_nowait()
+            if (self.leases is not None):
+                self.leases.remove(queue, task, finished=False)
+            unclaimed[id(queue)].append(task)
+            queues[id(queue)] = queue
+        for key, tasks in unclaimed.items():
+            try:
+                await queues[key].release(tasks, loop=self.loop)
+                self.released += len(tasks)
+            except Exception as e:
+                print("Exception releasing tasks " + str(e))
+
+    def stats(self):
+        return {"receive_calls": self.receive_calls, "received": self.received, "released": self.released}
+
+
+class LeaseManager(object):
+    '''
+    Keeps the tasks a worker is running invisible to other workers. Every
+    tick, tasks whose visibility runs out within half a lease are extended
+    by a full lease, with one extend_visibility_batch call per queue. A
+    lease is LEASE_FACTOR times the longest of the last few task durations
+    and never shorter than min_timeout, so long running tasks are extended
+    rarely and tasks of a dead worker reappear soon after they should have
+    finished.
+    '''
+    def __init__(self, loop, min_timeout=60, max_timeout=MAX_VISIBILITY_TIMEOUT, history=32):
+        self.loop = loop
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.tick = min_timeout/3
+        self.durations = deque(maxlen=history)
+        self.leases = {}
+        self.closed = False
+        self.extend_calls = 0
+        self.extended = 0
+        self._task = None
+
+    def start(self):
+        self._task = self.loop.create_task(self.run())
+        return self._task
+
+    def lease_timeout(self):
+        if (len(self.durations) == 0):
+            return self.min_timeout
+        return int(min(self.max_timeout, max(self.min_timeout, LEASE_FACTOR*max(self.durations))))
+
+    def add(self, queue, task, deadline):
+        ''' Start tracking task, whose visibility runs out at deadline '''
+        self.leases[(id(queue), task.handle)] = [queue, task, deadline, time.time()]
+
+    def remove(self, queue, task, finished=True):
+        ''' Stop tracking task, the duration of a finished task feeds the lease length '''
+        lease = self.leases.pop((id(queue), task.handle), None)
+        if (lease is not None and finished):
+            self.durations.append(time.time() - lease[3])
+
+    async def extend(self):
+        timeout = self.lease_timeout()
+        now = time.time()
+        expiring = defaultdict(list)
+        for lease in list(self.leases.values()):
+            if (lease[2] - now < timeout/2):
+                expiring[id(lease[0])].append(lease)
+        for leases in expiring.values():
+            queue = leases[0][0]
+            try:
+                await queue.extend_visibility_batch([x[1] for x in leases], timeout, loop=self.loop)
+            except Exception as e:
+                print("Exception extending leases " + str(e))
+                continue
+            self.extend_calls += 1
+            self.extended += len(leases)
+            for lease in leases:
+                lease[2] = now + timeout
+
+    async def run(self):
+        while (not self.closed):
+            await self.extend()
+            await asyncio.sleep(self.tick)
+
+    async def close(self):
+        self.closed = True
+        if (self._task is not None):
+            self._task.cancel()
+            await asyncio.gather(self._task, loop=self.loop, return_exceptions=True)
+
+    def stats(self):
+        return {"extend_calls": self.extend_calls, "extended": self.extended, "lease_timeout": self.lease_timeout()}
+
+
+TASK_QUEUES = ["sqs", "redis", "memory"]
+
+def get_task_queue(kind, name, control_plane=None, region=None):
+    if (kind == "sqs"):
+        return SQSTaskQueue(name, region)
+    elif (kind == "redis"):
+        return RedisTaskQueue(name, control_plane)
+    elif (kind == "memory"):
+        return InMemoryTaskQueue(name)
+    else:
+        raise ValueError("Unknown task queue {0}, expected one of {1}".format(kind, TASK_QUEUES))
@@ -1,6 +1,18 @@
 import boto3
+from collections import OrderedDict
+import contextlib
+import logging
+import os
+import threading
 import time
 
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+logger = logging.getLogger(__name__)
+
 BACKOFF = 1
 MAX_TRIES = 100
 
@@ -61,6 +73,71 @@ def chunk(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
+class LRUMemo(object):
+    '''
+    Bounded, thread safe memo of function results. Each memoized function
+    gets its own hit/miss counters, values must not be modified by callers.
+    '''
+    def __init__(self, max_items=4096):
+        self.max_items = max_items
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, name, key, fn):
+        key = (name, key)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return self.cache[key]
+            self.misses[name] = self.misses.get(name, 0) + 1
+        # computed outside the lock, racing threads may both compute a value
+        value = fn()
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_items:
+                self.cache.popitem(last=False)
+        return value
+
+    def stats(self, reset=False):
+        ''' {name: {"hits": n, "misses": n}} for every memoized function '''
+        with self.lock:
+            names = set(self.hits.keys()) | set(self.misses.keys())
+            stats = {name: {"hits": self.hits.get(name, 0), "misses": self.misses.get(name, 0)} for name in names}
+            if (reset):
+                self.hits = {}
+                self.misses = {}
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+def blas_threads_per_slot(compute_slots, num_cores=None):
+    ''' BLAS threads each of compute_slots concurrently running kernels gets '''
+    if (num_cores is None):
+        num_cores = os.cpu_count() or 1
+    return max(1, num_cores // compute_slots)
+
+_warned_blas_threads = False
+
+def limit_blas_threads(num_threads):
+    '''
+    Context manager capping the BLAS thread pools of the process at
+    num_threads, does nothing (and warns once) if threadpoolctl is not
+    installed
+    '''
+    global _warned_blas_threads
+    if (threadpool_limits is None):
+        if (not _warned_blas_threads):
+            logger.warning("threadpoolctl is not installed, BLAS threads are not limited to {0}".format(num_threads))
+            _warned_blas_threads = True
+        return contextlib.ExitStack()
+    return threadpool_limits(limits=num_threads, user_api="blas")
+
 def get_object_with_backoff(s3_client, bucket, key, max_tries=MAX_TRIES, backoff=BACKOFF, **extra_get_args):
     num_tries = 0
     while (num_tries < max_tries):
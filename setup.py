@@ -23,8 +23,15 @@ setup(
     install_requires=[
         'Click', 'PyYAML',
         'enum34', 'flaky', 'glob2',
-        'watchtower', 'tblib', 'pywren' # it's nuts that we need both botos
+        'watchtower', 'tblib', 'pywren', # it's nuts that we need both botos
+        'threadpoolctl'
     ],
+    extras_require={
+        # shard codecs other than zlib
+        'compression': ['lz4', 'zstandard', 'blosc'],
+        # in process redis for the tests, the control plane runs lua scripts
+        'test': ['fakeredis[lua]'],
+    },
     entry_points={
         'console_scripts' : ['numpywren=numpywren.scripts.cli:main']
     },
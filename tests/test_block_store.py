@@ -0,0 +1,180 @@
+from numpywren.matrix import BigMatrix
+from numpywren.block_store import LocalBlockStore, SharedMemoryBlockStore, get_block_store
+from numpywren.block_manifest import RedisBlockManifest
+from numpywren.exceptions import BlockNotFoundException, ControlPlaneException
+from numpywren.matrix_utils import constant_zeros
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+import pickle
+import fakeredis
+
+
+class CountingBlockStore(LocalBlockStore):
+    def __init__(self, root):
+        super().__init__(root)
+        self.gets = 0
+        self.puts = 0
+        self.exists_calls = 0
+
+    def get(self, bucket, key):
+        self.gets += 1
+        return super().get(bucket, key)
+
+    def put(self, bucket, key, data):
+        self.puts += 1
+        return super().put(bucket, key, data)
+
+    def exists(self, bucket, key):
+        self.exists_calls += 1
+        return super().exists(bucket, key)
+
+
+class FakeControlPlane(object):
+    def __init__(self, server=None):
+        self.client = fakeredis.FakeStrictRedis(server=server)
+
+
+async def readonly_zeros(bigm, loop, *block_idx):
+    block = await constant_zeros(bigm, loop, *block_idx)
+    block.flags.writeable = False
+    return block
+
+
+class BlockStoreTestClass(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = LocalBlockStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_local_put_get(self):
+        self.store.put("bucket", "a/b/c", b"hello")
+        assert(self.store.exists("bucket", "a/b/c"))
+        assert(self.store.get("bucket", "a/b/c") == b"hello")
+        assert(self.store.list_keys("bucket", "a/b") == ["a/b/c"])
+        self.store.delete("bucket", "a/b/c")
+        assert(not self.store.exists("bucket", "a/b/c"))
+        with self.assertRaises(BlockNotFoundException):
+            self.store.get("bucket", "a/b/c")
+
+    def test_local_matrix(self):
+        np.random.seed(0)
+        X = np.random.randn(128, 128)
+        X_sharded = BigMatrix("block_store_test", shape=X.shape, shard_sizes=(64, 64), bucket="test", store=self.store, write_header=True)
+        for bidx, block in zip(X_sharded.block_idxs, X_sharded.blocks):
+            X_sharded.put_block(X[block[0][0]:block[0][1], block[1][0]:block[1][1]], *bidx)
+        assert(len(X_sharded.block_idxs_exist) == 4)
+        X_sharded_2 = BigMatrix("block_store_test", bucket="test", store=self.store)
+        assert(X_sharded_2.shape == [128, 128])
+        assert(np.all(X_sharded_2.get_block(1, 0) == X[64:, :64]))
+        X_sharded.free()
+        assert(len(X_sharded.block_idxs_exist) == 0)
+
+    def test_local_parent_fn(self):
+        Z = BigMatrix("block_store_test_zeros", shape=(16, 16), shard_sizes=(8, 8), bucket="test", store=self.store, parent_fn=constant_zeros)
+        assert(np.all(Z.get_block(0, 1) == 0))
+
+    def test_readonly_diagonal_block(self):
+        Z = BigMatrix("block_store_test_readonly", shape=(16, 16), shard_sizes=(8, 8), bucket="test", store=self.store, parent_fn=readonly_zeros)
+        assert(np.all(Z.get_block(1, 1) == 0))
+        # lambdav is added to a copy of a read only block
+        Z.lambdav = 2.0
+        assert(np.all(Z.get_block(1, 1) == 2*np.eye(8)))
+
+    def test_get_block_single_request(self):
+        store = CountingBlockStore(self.root)
+        Z = BigMatrix("block_store_test_get", shape=(16, 16), shard_sizes=(8, 8), bucket="test", store=store, parent_fn=constant_zeros)
+        Z.put_block(np.ones((8, 8)), 0, 0)
+        store.gets = 0
+        assert(np.all(Z.get_block(0, 0) == 1))
+        assert(np.all(Z.get_block(1, 1) == 0))
+        assert(store.gets == 2)
+        assert(store.exists_calls == 0)
+        parent_fn = Z.__parent_fn__()
+        assert(Z.__parent_fn__() is parent_fn)
+        Z_2 = pickle.loads(pickle.dumps(Z))
+        assert("_parent_fn_cache" not in Z_2.__dict__)
+        assert(np.all(Z_2.get_block(0, 1) == 0))
+
+    def test_manifest(self):
+        store = CountingBlockStore(self.root)
+        manifest = RedisBlockManifest(FakeControlPlane(), namespace="test")
+        Z = BigMatrix("block_store_test_manifest", shape=(16, 16, 2), shard_sizes=(8, 8, 1), bucket="test", store=store, parent_fn=constant_zeros, manifest=manifest)
+        Z.put_block(np.ones((8, 8)), 1, 0, 1)
+        assert(manifest.is_written(Z, (1, 0, 1)))
+        assert(manifest.num_written(Z) == 1)
+        store.gets = 0
+        assert(np.all(Z.get_block(0, 1, 0) == 0))
+        assert(store.gets == 0)
+        assert(np.all(Z.get_block(1, 0, 1) == 1))
+        assert(store.gets == 1)
+        Z.free()
+        assert(manifest.num_written(Z) == 0)
+        assert(np.all(Z.get_block(1, 0, 1) == 0))
+        assert(store.gets == 1)
+
+    def test_manifest_dedup(self):
+        store = CountingBlockStore(self.root)
+        manifest = RedisBlockManifest(FakeControlPlane(), namespace="test")
+        A = BigMatrix("block_store_test_dedup_A", shape=(16, 16, 2), shard_sizes=(8, 8, 1), bucket="test", store=store, manifest=manifest)
+        B = BigMatrix("block_store_test_dedup_B", shape=(16, 16), shard_sizes=(8, 8), bucket="test", store=store, manifest=manifest)
+        X = np.random.randn(8, 8)
+        A.put_block(X, 0, 1, 1)
+        assert(store.puts == 1)
+        # identical contents become an alias instead of a second upload
+        B.put_block(X, 1, 0)
+        B.put_block(X, 0, 0)
+        assert(store.puts == 1)
+        assert(np.array_equal(B.get_block(1, 0), X))
+        assert(len(manifest.references("test", A.__shard_idx_to_key__((0, 1, 1)))) == 2)
+        # deleting the aliased block first gives the aliases their own copy
+        A.free()
+        assert(store.puts == 3)
+        assert(np.array_equal(B.get_block(1, 0), X))
+        assert(np.array_equal(B.get_block(0, 0), X))
+        assert(len(B.block_idxs_exist) == 2)
+
+    def test_manifest_zero(self):
+        store = CountingBlockStore(self.root)
+        manifest = RedisBlockManifest(FakeControlPlane(), namespace="test")
+        Z = BigMatrix("block_store_test_zero", shape=(16, 16), shard_sizes=(8, 8), bucket="test", store=store, manifest=manifest)
+        assert(Z.mark_zero_block(1, 1))
+        assert(np.all(Z.get_block(1, 1) == 0))
+        assert(Z.get_block(1, 1).shape == (8, 8))
+        assert(store.gets == 0 and store.puts == 0)
+        Z.materialize()
+        assert(Z.block_idxs_exist == [(1, 1)])
+        Z.manifest = None
+        assert(np.all(Z.get_block(1, 1) == 0))
+
+    def test_manifest_unavailable(self):
+        store = CountingBlockStore(self.root)
+        server = fakeredis.FakeServer()
+        manifest = RedisBlockManifest(FakeControlPlane(server), namespace="test")
+        Z = BigMatrix("block_store_test_unavailable", shape=(16, 16), shard_sizes=(8, 8), bucket="test", store=store, parent_fn=constant_zeros, manifest=manifest)
+        Z.put_block(np.ones((8, 8)), 0, 0)
+        assert(Z.mark_zero_block(1, 1))
+        server.connected = False
+        # without the manifest a zero or alias block can't be told apart
+        # from a missing one, reads fail instead of returning parent_fn's zeros
+        try:
+            Z.get_block(1, 1)
+        except ControlPlaneException:
+            return
+        assert(False)
+
+    def test_store_spec(self):
+        store = get_block_store("local:{0}".format(self.root))
+        assert(isinstance(store, LocalBlockStore))
+        assert(store.root == os.path.abspath(self.root))
+        if (os.path.isdir("/dev/shm")):
+            assert(isinstance(get_block_store("shm"), SharedMemoryBlockStore))
+
+
+if __name__ == "__main__":
+    tests = BlockStoreTestClass()
+    tests.test_local_matrix()
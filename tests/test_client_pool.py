@@ -0,0 +1,30 @@
+from numpywren import client_pool
+import asyncio
+import unittest
+
+
+class ClientPoolTestClass(unittest.TestCase):
+    def test_client_reuse(self):
+        loop = asyncio.new_event_loop()
+        pool = client_pool.get_pool(loop, max_pool_connections=8)
+        assert(pool.max_pool_connections == 8)
+        c0 = loop.run_until_complete(client_pool.get_client('s3', loop=loop, region_name="us-west-2"))
+        c1 = loop.run_until_complete(client_pool.get_client('s3', loop=loop, region_name="us-west-2"))
+        c2 = loop.run_until_complete(client_pool.get_client('sqs', loop=loop, region_name="us-west-2"))
+        assert(c0 is c1)
+        assert(c0 is not c2)
+        assert(len(pool.clients) == 2)
+        loop.run_until_complete(client_pool.close_pool(loop))
+        assert(len(pool.clients) == 0)
+        assert(client_pool.get_pool(loop) is not pool)
+        loop.run_until_complete(client_pool.close_pool(loop))
+        loop.close()
+
+    def test_pool_per_loop(self):
+        loop0 = asyncio.new_event_loop()
+        loop1 = asyncio.new_event_loop()
+        assert(client_pool.get_pool(loop0) is client_pool.get_pool(loop0))
+        assert(client_pool.get_pool(loop0) is not client_pool.get_pool(loop1))
+        for loop in [loop0, loop1]:
+            loop.run_until_complete(client_pool.close_pool(loop))
+            loop.close()
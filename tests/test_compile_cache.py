@@ -0,0 +1,81 @@
+import os
+import random
+import shutil
+import string
+import tempfile
+import unittest
+
+from numpywren.matrix import BigMatrix
+from numpywren.algs import CHOLESKY
+from numpywren.compile_cache import CompileCache
+from numpywren.compiler import lpcompile_for_execution, walk_program
+
+
+def dummy_matrix(shape):
+    key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(64))
+    return BigMatrix(key, shape=shape, shard_sizes=shape, write_header=False)
+
+def cholesky_program(cache, N=6, materialize=False):
+    p0 = lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"], materialize=materialize, cache=cache)
+    return p0(dummy_matrix((1, 1)), dummy_matrix((1, 1)), dummy_matrix((1, 1, 1)), N, 0)
+
+
+class CompileCacheTestClass(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = CompileCache(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_program_cache(self):
+        program = cholesky_program(self.cache)
+        assert(self.cache.hits == 0)
+        cached = cholesky_program(self.cache)
+        # typed IR and derived tables
+        assert(self.cache.hits == 2)
+        assert(cached.starters == program.starters)
+        assert(cached.num_terminators == program.num_terminators)
+        assert(cached.analysis.program is cached.remote_calls)
+        for p_idx, var_values in walk_program(program.remote_calls):
+            assert(cached.find_children(p_idx, var_values) == program.find_children(p_idx, var_values))
+            assert(cached.num_parents(p_idx, var_values) == program.num_parents(p_idx, var_values))
+        # a different problem size is compiled again
+        cholesky_program(self.cache, N=7)
+        assert(self.cache.hits == 3)
+        assert(self.cache.misses == 3)
+
+    def test_dag_cache(self):
+        program = cholesky_program(self.cache, materialize=True)
+        cached = cholesky_program(self.cache, materialize=True)
+        assert(cached.dag is not None)
+        assert((cached.dag.children == program.dag.children).all())
+
+    def test_corrupt_entry(self):
+        cholesky_program(self.cache)
+        for name in os.listdir(self.root):
+            with open(os.path.join(self.root, name), "wb") as f:
+                f.write(b"garbage")
+        program = cholesky_program(self.cache)
+        assert(self.cache.hits == 0)
+        assert(len(program.starters) == 1)
+
+    def test_eviction(self):
+        cholesky_program(self.cache, N=5)
+        entry_size = self.cache.size()
+        self.cache.max_bytes = entry_size
+        cholesky_program(self.cache, N=6)
+        assert(self.cache.size() <= entry_size)
+        self.cache.clear()
+        assert(self.cache.size() == 0)
+
+    def test_unwritable_cache(self):
+        # e.g. a read only HOME, programs still compile without the cache
+        path = os.path.join(self.root, "file")
+        with open(path, "w") as f:
+            f.write("not a directory")
+        cache = CompileCache(os.path.join(path, "compile_cache"))
+        with self.assertLogs("numpywren.compile_cache", level="WARNING"):
+            program = cholesky_program(cache)
+        assert(len(program.starters) == 1)
+        assert(cache.size() == 0)
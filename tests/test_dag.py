@@ -0,0 +1,111 @@
+import os
+import pickle
+import random
+import shutil
+import string
+import tempfile
+
+import numpy as np
+
+from numpywren.matrix import BigMatrix
+from numpywren.algs import CHOLESKY, GEMM, QR
+from numpywren.block_store import LocalBlockStore
+from numpywren.compiler import lpcompile_for_execution, walk_program
+from numpywren.dag import MaterializedDAG
+
+
+def dummy_matrix(num_dims=2):
+    key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(64))
+    shape = tuple([1 for x in range(num_dims)])
+    return BigMatrix(key, shape=shape, shard_sizes=shape, write_header=False)
+
+def verify_dag(program, dag):
+    nodes = walk_program(program.remote_calls)
+    assert(dag.num_nodes == len(nodes))
+    for p_idx, var_values in nodes:
+        assert(dag.find_children(p_idx, var_values) == program.analysis.find_children(p_idx, var_values))
+        assert(dag.num_parents(p_idx, var_values) == len(program.analysis.find_parents(p_idx, var_values)))
+    assert(sorted([(p, sorted(v.items())) for p, v in dag.starters()]) ==
+           sorted([(p, sorted(v.items())) for p, v in program.starters]))
+
+def test_cholesky_dag():
+    program = lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"], materialize=True)(dummy_matrix(), dummy_matrix(), dummy_matrix(num_dims=3), 8, 0)
+    verify_dag(program, program.dag)
+    assert(program.find_children(0, {}) == program.analysis.find_children(0, {}))
+    program_2 = pickle.loads(pickle.dumps(program))
+    verify_dag(program_2, program_2.dag)
+
+def test_gemm_dag():
+    program = lpcompile_for_execution(GEMM, inputs=["A", "B"], outputs=["Out"], materialize=True)(dummy_matrix(), dummy_matrix(), 3, 2, 8, dummy_matrix(num_dims=4), dummy_matrix(num_dims=3))
+    verify_dag(program, program.dag)
+
+def test_dag_serialization():
+    program = lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"])(dummy_matrix(), dummy_matrix(), dummy_matrix(num_dims=3), 6, 0)
+    assert(program.dag is None)
+    dag = program.materialize()
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "cholesky.npz")
+        dag.save(path)
+        dag_2 = MaterializedDAG.load(path)
+        store = LocalBlockStore(root)
+        dag.put(store, "test", "dags/cholesky")
+        dag_3 = MaterializedDAG.get(store, "test", "dags/cholesky")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    for loaded in [dag_2, dag_3]:
+        assert(np.array_equal(loaded.children, dag.children))
+        assert(np.array_equal(loaded.child_offsets, dag.child_offsets))
+        verify_dag(program, loaded)
+
+def bottom_levels(program):
+    levels = {}
+    def level(p_idx, var_values):
+        key = (p_idx, tuple(sorted(var_values.items())))
+        if (key not in levels):
+            children = program.analysis.find_children(p_idx, var_values)
+            levels[key] = 1 + max([level(*child) for child in children] + [0])
+        return levels[key]
+    for p_idx, var_values in walk_program(program.remote_calls):
+        level(p_idx, var_values)
+    return levels
+
+def check_panel_order(program):
+    ''' Without a DAG every node of a panel outranks every node of a later
+        one, whatever line it is on. Panels are the iterations of the
+        outermost i loop, the unrolled first panel before it is panel 0
+    '''
+    priorities = {}
+    for p_idx, var_values in walk_program(program.remote_calls):
+        priorities.setdefault(var_values.get("i", 0), []).append(program.priority(p_idx, var_values))
+    panels = sorted(priorities.keys())
+    assert(len(panels) > 2)
+    assert(min(priorities[0]) == 1.0)
+    for panel, next_panel in zip(panels, panels[1:]):
+        assert(min(priorities[panel]) > max(priorities[next_panel]))
+
+def test_priorities():
+    program = lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"])(dummy_matrix(), dummy_matrix(), dummy_matrix(num_dims=3), 6, 0)
+    # without a DAG: earlier iterations of the outermost loop first
+    assert(program.priority(0, {}) == 1.0)
+    chol_line = [p for p, v in walk_program(program.remote_calls) if v.keys() == {"i"}][0]
+    chol = [program.priority(chol_line, {"i": i}) for i in range(1, 6)]
+    assert(chol == sorted(chol, reverse=True))
+    assert(len(set(chol)) == len(chol))
+    assert(program.eval_expr(chol_line, {"i": 1}).priority == chol[0])
+    check_panel_order(program)
+    # the first panel's trsm and syrk lines come before every later panel
+    trsm_line = [p for p, v in walk_program(program.remote_calls) if v.keys() == {"j"}][0]
+    assert(program.priority(trsm_line, {"j": 5}) == 1.0)
+    qr = lpcompile_for_execution(QR, inputs=["I"], outputs=["Rs"])(dummy_matrix(), dummy_matrix(num_dims=3), dummy_matrix(num_dims=3),
+                                                                   dummy_matrix(num_dims=3), dummy_matrix(num_dims=4), 8, 0)
+    check_panel_order(qr)
+    # with a DAG: bottom levels relative to the critical path
+    dag = program.materialize()
+    levels = bottom_levels(program)
+    assert((sorted(dag.levels().tolist()) == sorted(levels.values())))
+    critical_path = max(levels.values())
+    for p_idx, var_values in walk_program(program.remote_calls):
+        key = (p_idx, tuple(sorted(var_values.items())))
+        assert(program.priority(p_idx, var_values) == levels[key]/critical_path)
+    assert(program.priority(0, {}) == 1.0)
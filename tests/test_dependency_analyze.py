@@ -2,13 +2,14 @@ import time
 import random
 from timeit import default_timer as timer
 import string
+import pickle
 
 from numpywren import compiler
 from numpywren.matrix import BigMatrix
 import numpy as np
 from numpywren.matrix_init import shard_matrix
 from numpywren.algs import *
-from numpywren.compiler import lpcompile, walk_program, find_parents, find_children
+from numpywren.compiler import lpcompile, walk_program, find_parents, find_children, DependencyAnalysis
 
 def dummy_matrix(key_len=256, num_dims=2):
     key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(key_len))
@@ -30,6 +31,19 @@ def verify_program(program):
             parent_children = find_children(program, p_idx_parent, parent_vars)
             assert current_node in parent_children
 
+def sort_nodes(nodes):
+    return sorted([(p_idx, sorted(loop_vars.items())) for p_idx, loop_vars in nodes])
+
+def verify_analysis(program):
+    ''' The compiled analysis has to agree with the sympy solver on every node '''
+    analysis = pickle.loads(pickle.dumps(DependencyAnalysis(program)))
+    for p_idx, loop_vars in walk_program(program):
+        parents = find_parents(program, p_idx, loop_vars)
+        assert sort_nodes(analysis.find_parents(p_idx, loop_vars)) == sort_nodes(parents)
+        assert analysis.num_parents(p_idx, loop_vars) == len(parents)
+        children = find_children(program, p_idx, loop_vars)
+        assert sort_nodes(analysis.find_children(p_idx, loop_vars)) == sort_nodes(children)
+
 def test_simple_linear():
     A = dummy_matrix()
     B = dummy_matrix()
@@ -105,6 +119,50 @@ def test_gemm():
     program = lpcompile(GEMM)(A,B,M,N,K,Temp,Out)
     verify_program(program)
 
+def test_analysis():
+    A = dummy_matrix()
+    B = dummy_matrix()
+    verify_analysis(lpcompile(SimpleTestLinear)(A,B,int(8)))
+    verify_analysis(lpcompile(SimpleTestLinear2)(A,B,int(8)))
+    verify_analysis(lpcompile(SimpleTestNonLinear)(A,B,int(8)))
+    C = dummy_matrix(num_dims=3)
+    verify_analysis(lpcompile(CHOLESKY)(A,B,C,8,0))
+    V = dummy_matrix(num_dims=2)
+    T = dummy_matrix(num_dims=2)
+    R = dummy_matrix(num_dims=2)
+    verify_analysis(lpcompile(TSQR)(dummy_matrix(num_dims=1),V,T,R,16))
+    Temp = dummy_matrix(num_dims=4)
+    Out = dummy_matrix(num_dims=3)
+    verify_analysis(lpcompile(GEMM)(A,B,4,4,16,Temp,Out))
+
+def test_analysis_benchmark():
+    A = dummy_matrix()
+    B = dummy_matrix()
+    C = dummy_matrix(num_dims=3)
+    program = lpcompile(CHOLESKY)(A,B,C,16,0)
+    t = time.time()
+    analysis = DependencyAnalysis(program)
+    print("analysis compile time", time.time() - t)
+    states = walk_program(program)
+    random.seed(0)
+    states = random.sample(states, 50)
+    # solvers compile their index functions on first use
+    for p_idx, loop_vars in states:
+        analysis.find_children(p_idx, loop_vars)
+        analysis.find_parents(p_idx, loop_vars)
+    times = {}
+    for name, children_fn, parents_fn in [("sympy", lambda *x: find_children(program, *x), lambda *x: find_parents(program, *x)),
+                                          ("compiled", analysis.find_children, analysis.find_parents)]:
+        t = time.time()
+        for p_idx, loop_vars in states:
+            children_fn(p_idx, loop_vars)
+            parents_fn(p_idx, loop_vars)
+        e = time.time()
+        times[name] = e - t
+        print("{0} us per query".format(name), 1e6*(e - t)/(2*len(states)))
+    # loose, compiled queries are orders of magnitude faster than sympy ones
+    assert times["compiled"]*2 < times["sympy"]
+
 def test_bdfac():
     A = dummy_matrix(num_dims=2)
     V = dummy_matrix(num_dims=3)
@@ -0,0 +1,131 @@
+import concurrent.futures as fs
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from numpywren.host_cache import HostBlockCache
+
+
+def read_block(root, key):
+    ''' Read key from the cache in another worker process '''
+    cache = HostBlockCache(1 << 20, root=root, namespace="program")
+    block = cache.get(key)
+    return isinstance(block, np.memmap), np.array(block)
+
+
+class HostBlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_shared_between_processes(self):
+        cache = HostBlockCache(1 << 20, root=self.root, namespace="program")
+        key = ("Cholesky(X)", "bucket", (2, 1))
+        block = np.asfortranarray(np.random.randn(8, 8))
+        assert(cache.get(key) is None)
+        cache.put(key, block)
+        with fs.ProcessPoolExecutor(1) as executor:
+            mapped, read = executor.submit(read_block, self.root, key).result()
+        assert(mapped)
+        assert(np.array_equal(read, block))
+        # another program's blocks of the same name are not shared
+        other = HostBlockCache(1 << 20, root=self.root, namespace="other_program")
+        assert(key not in other)
+        assert(cache.stats() == {"hits": 0, "misses": 1, "evictions": 0})
+
+    def test_eviction(self):
+        block = np.zeros((16, 16))
+        cache = HostBlockCache(1 << 20, root=self.root)
+        cache.put(("A", "bucket", (0, 0)), block)
+        cache.max_bytes = 3*cache.size()
+        for i in range(3):
+            cache.put(("A", "bucket", (i, 0)), block)
+            time.sleep(0.01)
+        mapped = cache.get(("A", "bucket", (0, 0)))
+        time.sleep(0.01)
+        cache.put(("A", "bucket", (3, 0)), block)
+        # (1, 0) was the least recently used block
+        assert(("A", "bucket", (1, 0)) not in cache)
+        assert(all([("A", "bucket", (i, 0)) in cache for i in [0, 2, 3]]))
+        assert(cache.evictions == 1)
+        assert(cache.size() <= cache.max_bytes)
+        # evicted blocks stay valid for the processes that mapped them
+        cache.clear()
+        assert(np.array_equal(mapped, block))
+        # blocks larger than the whole cache are never stored
+        cache.put(("B", "bucket", (0, 0)), np.zeros((64, 64)))
+        assert(("B", "bucket", (0, 0)) not in cache)
+
+    def test_corrupt_index(self):
+        block = np.ones((16, 16))
+        cache = HostBlockCache(1 << 20, root=self.root)
+        cache.put(("A", "bucket", (0, 0)), block)
+        cache.max_bytes = 2*cache.size()
+        with open(os.path.join(self.root, "index"), "wb") as f:
+            f.write(b"garbage")
+        time.sleep(0.01)
+        cache.put(("A", "bucket", (1, 0)), block)
+        time.sleep(0.01)
+        cache.put(("A", "bucket", (2, 0)), block)
+        # the index was rebuilt from the blocks on disk
+        assert(("A", "bucket", (0, 0)) not in cache)
+        assert(np.array_equal(cache.get(("A", "bucket", (2, 0))), block))
+
+    def test_copy_on_write(self):
+        key = ("A", "bucket", (0, 0))
+        cache = HostBlockCache(1 << 20, root=self.root)
+        cache.put(key, np.eye(4))
+        # writes to a mapped block stay private to the reader
+        block = cache.get(key)
+        block[np.diag_indices(4)] += 1.0
+        assert(np.array_equal(block, 2*np.eye(4)))
+        assert(np.array_equal(cache.get(key), np.eye(4)))
+
+    def test_clear_namespace(self):
+        key = ("A", "bucket", (0, 0))
+        finished = HostBlockCache(1 << 20, root=self.root, namespace="finished_program")
+        running = HostBlockCache(1 << 20, root=self.root, namespace="running_program")
+        finished.put(key, np.eye(4))
+        running.put(key, np.eye(4))
+        size = running.size()
+        finished.clear_namespace()
+        assert(key not in finished)
+        assert(key in running)
+        assert(running.size() == size//2)
+        assert(list(finished._load_index().keys()) == [os.path.basename(running._path(key))])
+
+    def test_failed_write(self):
+        key = ("A", "bucket", (0, 0))
+        cache = HostBlockCache(1 << 20, root=self.root)
+        # a full /dev/shm only costs the cache a block
+        with mock.patch("numpywren.host_cache.np.save", side_effect=OSError(28, "No space left on device")):
+            with self.assertLogs("numpywren.host_cache", level="WARNING"):
+                cache.put(key, np.eye(4))
+        assert(key not in cache)
+        assert([x for x in os.listdir(self.root) if x.endswith(".tmp")] == [])
+        cache.put(key, np.eye(4))
+        assert(np.array_equal(cache.get(key), np.eye(4)))
+
+    def test_evict_before_write(self):
+        block = np.zeros((16, 16))
+        cache = HostBlockCache(1 << 20, root=self.root)
+        cache.put(("A", "bucket", (0, 0)), block)
+        cache.max_bytes = 2*cache.size()
+        sizes = []
+        save = np.save
+        def recording_save(f, value):
+            sizes.append(cache.size())
+            save(f, value)
+        with mock.patch("numpywren.host_cache.np.save", side_effect=recording_save):
+            for i in range(1, 4):
+                cache.put(("A", "bucket", (i, 0)), block)
+        # room for every block was made before it was written
+        assert(all([size + cache.max_bytes//2 <= cache.max_bytes for size in sizes]))
+        assert(cache.evictions == 2)
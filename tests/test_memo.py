@@ -0,0 +1,64 @@
+import pickle
+import random
+import string
+import concurrent.futures as fs
+
+from numpywren.matrix import BigMatrix
+from numpywren.algs import CHOLESKY
+from numpywren.compiler import lpcompile, CompiledLambdaPackProgram, find_children, eval_remote_call
+from numpywren.utils import LRUMemo
+
+
+def dummy_matrix(num_dims=2):
+    key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(64))
+    shape = tuple([1 for x in range(num_dims)])
+    return BigMatrix(key, shape=shape, shard_sizes=shape, write_header=False)
+
+def cholesky_program(N=4):
+    remote_calls = lpcompile(CHOLESKY)(dummy_matrix(), dummy_matrix(), dummy_matrix(num_dims=3), N, 0)
+    return CompiledLambdaPackProgram(remote_calls, [], 0, ["I"], ["O"])
+
+def test_lru_memo():
+    memo = LRUMemo(max_items=2)
+    assert(memo.get("f", 1, lambda: "a") == "a")
+    assert(memo.get("f", 1, lambda: "b") == "a")
+    memo.get("f", 2, lambda: "c")
+    memo.get("g", 1, lambda: "d")
+    # ("f", 1) was least recently used
+    assert(memo.get("f", 1, lambda: "e") == "e")
+    assert(len(memo.cache) == 2)
+    assert(memo.stats() == {"f": {"hits": 1, "misses": 3}, "g": {"hits": 0, "misses": 1}})
+    memo.stats(reset=True)
+    assert(memo.stats() == {})
+
+def test_program_memo():
+    program = cholesky_program()
+    children = program.find_children(0, {})
+    assert(children == find_children(program.remote_calls, 0, {}))
+    # callers get their own copies
+    children[0][1]["j"] = 100
+    assert(program.find_children(0, {}) == find_children(program.remote_calls, 0, {}))
+    assert(program.is_terminator(0) == program.is_terminator(0))
+    ib_0 = program.eval_expr(1, {"j": 2})
+    ib_1 = program.eval_expr(1, {"j": 2})
+    assert(ib_0 is not ib_1)
+    assert(ib_0.instrs[0] is not ib_1.instrs[0])
+    assert([str(x) for x in ib_1.instrs] == [str(x) for x in eval_remote_call(program.remote_calls[1], {"j": 2}).instrs])
+    stats = program.memo_stats()
+    assert(stats["find_children"] == {"hits": 1, "misses": 1})
+    assert(stats["is_terminator"] == {"hits": 1, "misses": 1})
+    assert(stats["eval_expr"] == {"hits": 1, "misses": 1})
+    program_2 = pickle.loads(pickle.dumps(program))
+    assert(program_2.memo_stats() == {})
+    assert(program_2.find_children(0, {}) == find_children(program.remote_calls, 0, {}))
+
+def test_program_memo_threads():
+    program = cholesky_program()
+    nodes = [(1, {"j": j}) for j in range(1, 4)] * 20
+    with fs.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda n: program.find_children(*n), nodes))
+    for (p_idx, var_values), children in zip(nodes, results):
+        assert(children == program.analysis.find_children(p_idx, var_values))
+    stats = program.memo_stats()["find_children"]
+    assert(stats["hits"] + stats["misses"] == len(nodes))
+    assert(stats["misses"] < len(nodes))
@@ -0,0 +1,441 @@
+import asyncio
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import fakeredis
+import numpy as np
+
+from numpywren import lambdapack as lp
+from numpywren import utils
+from numpywren.algs import CHOLESKY
+from numpywren.block_store import LocalBlockStore
+from numpywren.compiler import lpcompile_for_execution, walk_program
+from numpywren.exceptions import CorruptShardException
+from numpywren.host_cache import HostBlockCache
+from numpywren.job_runner import LRUCache, Claim, LambdaPackExecutor, start_pipeline, run_worker, lambdapack_run_with_failures
+from numpywren.matrix import BigMatrix
+from numpywren.matrix_utils import constant_zeros
+from numpywren.task_queue import LeaseManager
+
+
+class LocalProgram(object):
+    ''' The counters the pipeline stages update '''
+    block_sparse = False
+
+    def __init__(self):
+        self.flops = 0
+        self.read_bytes = 0
+
+    def incr_flops(self, flops):
+        self.flops += flops
+
+    def incr_read(self, read_size, wire_read_size):
+        self.read_bytes += read_size
+
+    def decr_up(self, amount):
+        pass
+
+    def handle_exception(self, error, tb, expr_idx, var_values):
+        raise Exception(error + tb)
+
+
+class KernelTracker(object):
+    ''' Threads kernels ran on and how many of them ran at once '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.threads.add(threading.get_ident())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def slow_kernel(x, threads=None):
+    with threads:
+        time.sleep(0.2)
+    return np.eye(2)*x
+
+
+class SlowMatrix(object):
+    ''' Blocks of a matrix that take latency seconds to read '''
+    key = "slow"
+    bucket = "bucket"
+    shard_sizes = (2, 2)
+    dtype = np.float64
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.reads = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def true_block_idx(self, *bidxs):
+        return bidxs
+
+    async def get_block_async(self, loop, *bidxs, stats=None):
+        self.reads += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        return np.eye(2)*bidxs[0]
+
+
+class CorruptMatrix(SlowMatrix):
+    ''' A matrix whose shards always fail their checksum '''
+    async def get_block_async(self, loop, *bidxs, stats=None):
+        self.reads += 1
+        raise CorruptShardException("checksum mismatch")
+
+
+def add_blocks(*blocks):
+    return sum(blocks)
+
+
+def run_pipeline(loop, blocks, compute_slots=1, max_inflight_reads=32, host_cache=None):
+    read_queue, compute_queue, write_queue = [asyncio.Queue(len(blocks), loop=loop) for _ in range(3)]
+    async def run():
+        executor = start_pipeline(loop, LocalProgram(), read_queue, compute_queue, write_queue,
+                                  compute_slots=compute_slots, io_slots=2, lambda_start=time.time(), timeout=60,
+                                  max_inflight_reads=max_inflight_reads, host_cache=host_cache)
+        events = [asyncio.Event(loop=loop) for _ in blocks]
+        t = time.time()
+        for i, (block, event) in enumerate(zip(blocks, events)):
+            await read_queue.put((i, {}, block, 0, event))
+        await asyncio.gather(*[event.wait() for event in events], loop=loop)
+        executor.shutdown(wait=False)
+        return time.time() - t
+    elapsed = loop.run_until_complete(run())
+    # stop the consumers still waiting on their queues
+    consumers = asyncio.all_tasks(loop)
+    for task in consumers:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*consumers, loop=loop, return_exceptions=True))
+    return elapsed
+
+
+def run_blocks(num_blocks, compute_slots):
+    loop = asyncio.new_event_loop()
+    tracker = KernelTracker()
+    blocks = [lp.InstructionBlock([lp.RemoteCall(0, slow_kernel, [float(i)], 1, ["0"], threads=tracker)])
+              for i in range(num_blocks)]
+    try:
+        run_pipeline(loop, blocks, compute_slots=compute_slots)
+    finally:
+        loop.close()
+    for i, block in enumerate(blocks):
+        assert(np.allclose(block.instrs[0].results[0], np.eye(2)*i))
+    return tracker
+
+
+class LocalControlPlane(object):
+    region = "us-west-2"
+
+    def __init__(self):
+        self.client = fakeredis.FakeStrictRedis()
+
+
+class FailingProgram(LocalProgram):
+    ''' A program whose nodes fail before they run '''
+    hash = "failing_program"
+
+    def __init__(self):
+        super().__init__()
+        self.control_plane = LocalControlPlane()
+        self.errors = []
+
+    def get_node_status(self, expr_idx, var_values):
+        raise Exception("node status unavailable")
+
+    def handle_exception(self, error, tb, expr_idx, var_values):
+        self.errors.append(error)
+
+
+class ReadyProgram(FailingProgram):
+    ''' A program whose nodes are ready and read one block of matrix '''
+    def __init__(self, matrix):
+        super().__init__()
+        self.matrix = matrix
+        self.program = self
+        self.post_ops = []
+
+    def get_node_status(self, expr_idx, var_values):
+        return lp.NS.READY
+
+    def set_node_status(self, expr_idx, var_values, status):
+        pass
+
+    def eval_expr(self, expr_idx, var_values):
+        return lp.InstructionBlock([lp.RemoteRead(0, self.matrix, expr_idx, 0)])
+
+    def post_op(self, expr_idx, var_values, ret_code, inst_block, tb=None):
+        self.post_ops.append(ret_code)
+
+
+def local_cholesky(store, N, shard_size, eager=False):
+    X = np.random.randn(N*shard_size, N*shard_size)
+    A = X.dot(X.T) + np.eye(X.shape[0])
+    shard_sizes = (shard_size, shard_size)
+    A_sharded = BigMatrix("pipeline_test_A", shape=A.shape, shard_sizes=shard_sizes, write_header=True, store=store)
+    for i in range(N):
+        for j in range(N):
+            A_sharded.put_block(A[i*shard_size:(i+1)*shard_size, j*shard_size:(j+1)*shard_size], i, j)
+    S = BigMatrix("pipeline_test_S", shape=(N+1, A.shape[0], A.shape[0]), shard_sizes=(1, shard_size, shard_size), write_header=True, parent_fn=constant_zeros, store=store)
+    O = BigMatrix("pipeline_test_O", shape=A.shape, shard_sizes=shard_sizes, write_header=True, parent_fn=constant_zeros, store=store)
+    p0 = lpcompile_for_execution(CHOLESKY, inputs=["I"], outputs=["O"])
+    compiled = p0(O, A_sharded, S, N, 0)
+    program = lp.LambdaPackProgram(compiled, config=None, eager=eager, task_queue="memory", plane=LocalControlPlane())
+    return program, A, O
+
+
+class PipelineTest(unittest.TestCase):
+    def test_concurrent_compute(self):
+        serial = run_blocks(4, compute_slots=1)
+        assert(serial.max_in_flight == 1)
+        assert(len(serial.threads) == 1)
+        concurrent = run_blocks(4, compute_slots=4)
+        assert(concurrent.max_in_flight == 4)
+        assert(len(concurrent.threads) == 4)
+
+    def test_concurrent_reads(self):
+        loop = asyncio.new_event_loop()
+        try:
+            matrix = SlowMatrix(0.1)
+            reads = [lp.RemoteRead(0, matrix, i, 0) for i in range(4)]
+            block = lp.InstructionBlock(reads + [lp.RemoteCall(0, add_blocks, reads, 1, ["0", "1", "2", "3"])])
+            run_pipeline(loop, [block])
+            assert(matrix.max_in_flight == 4)
+            assert(np.allclose(block.instrs[-1].results[0], np.eye(2)*6))
+            assert(all([x.end_time - x.start_time >= 0.1 for x in reads]))
+            # the in flight limit holds across the blocks of a worker, a block
+            # read twice by one node is only fetched once
+            matrix = SlowMatrix(0.05)
+            blocks = []
+            for j in range(2):
+                reads = [lp.RemoteRead(0, matrix, i, 0) for i in [0, 1, 2, 2]]
+                blocks.append(lp.InstructionBlock(reads + [lp.RemoteCall(0, add_blocks, reads, 1, ["0", "1", "2", "3"])]))
+            run_pipeline(loop, blocks, max_inflight_reads=2)
+            assert(matrix.max_in_flight == 2)
+            assert(matrix.reads == 6)
+            assert(all([np.allclose(b.instrs[-1].results[0], np.eye(2)*5) for b in blocks]))
+        finally:
+            loop.close()
+
+    def test_corrupt_shard(self):
+        loop = asyncio.new_event_loop()
+        try:
+            matrix = CorruptMatrix(0)
+            read = lp.RemoteRead(0, matrix, 0, 0)
+            read.cache = None
+            # a shard that stays corrupt fails the read after a few retries
+            with self.assertRaises(CorruptShardException):
+                loop.run_until_complete(read())
+            assert(matrix.reads == read.MAX_CORRUPT_RETRIES + 1)
+        finally:
+            loop.close()
+
+    def test_blas_threads(self):
+        assert(utils.blas_threads_per_slot(3, num_cores=8) == 2)
+        assert(utils.blas_threads_per_slot(16, num_cores=8) == 1)
+        with utils.limit_blas_threads(1):
+            assert(np.allclose(np.eye(3).dot(np.eye(3)), np.eye(3)))
+        # without threadpoolctl the limit is skipped with a single warning
+        with mock.patch.object(utils, "threadpool_limits", None), mock.patch.object(utils, "_warned_blas_threads", False):
+            with self.assertLogs(utils.logger, level="WARNING") as logs:
+                for _ in range(3):
+                    with utils.limit_blas_threads(1):
+                        pass
+            assert(len(logs.output) == 1)
+
+    def test_post_op_stage(self):
+        for eager in [False, True]:
+            root = tempfile.mkdtemp()
+            loop = asyncio.new_event_loop()
+            try:
+                program, A, O = local_cholesky(LocalBlockStore(root), N=3, shard_size=4, eager=eager)
+                program.start()
+                shared_state, stats = run_worker(loop, program, pipeline_width=2, timeout=60, idle_timeout=5)
+                assert(program.program_status() == lp.PS.SUCCESS)
+                # a slot is only handed back once the node finished post_op
+                assert(shared_state["busy_workers"] == 0)
+                statuses = [program.get_node_status(i, v) for i, v in walk_program(program.program.remote_calls)]
+                assert(all([s == lp.NS.FINISHED for s in statuses]))
+                assert(len(shared_state["all_operator_refs"]) == len(statuses))
+                assert(np.allclose(O.numpy(), np.linalg.cholesky(A)))
+                # blocks written by a node are read back from the cache
+                assert(stats["cache_stats"]["hits"] > 0)
+                # blocks of the input were never written here and miss
+                assert(stats["cache_stats"]["misses"] > 0)
+                # and the worker added its counters to the program's on shutdown
+                hits = program.control_plane.client.get("{0}_cache_hits".format(program.hash))
+                assert(int(hits) == stats["cache_stats"]["hits"])
+                assert("memo_stats" in stats)
+                program.free()
+            finally:
+                consumers = asyncio.all_tasks(loop)
+                for task in consumers:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*consumers, loop=loop, return_exceptions=True))
+                loop.close()
+                shutil.rmtree(root, ignore_errors=True)
+
+    def test_run_with_failures(self):
+        root = tempfile.mkdtemp()
+        try:
+            program, A, O = local_cholesky(LocalBlockStore(root), N=2, shard_size=4)
+            program.start()
+            res = lambdapack_run_with_failures("pipeline_test_failure", program, pipeline_width=2, timeout=60, idle_timeout=5)
+            assert(program.program_status() == lp.PS.SUCCESS)
+            assert(len(res["exec_time"]) > 0)
+            # the worker's loop is closed but no longer installed as the current one
+            try:
+                assert(not asyncio.get_event_loop().is_closed())
+            except RuntimeError:
+                pass
+            assert(np.allclose(O.numpy(), np.linalg.cholesky(A)))
+            program.free()
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def test_failed_node_releases_claim(self):
+        loop = asyncio.new_event_loop()
+        try:
+            program = FailingProgram()
+            leases = LeaseManager(loop)
+            shared_state = {"busy_workers": 2, "running_times": [], "last_busy_time": 0}
+            executor = LambdaPackExecutor(program, loop, LRUCache(), None, leases=leases, shared_state=shared_state)
+            queue = object()
+            claims = []
+            for i in range(2):
+                task = types.SimpleNamespace(handle=i)
+                leases.add(queue, task, time.time() + 60)
+                claims.append(Claim(queue, task, time.time()))
+            with self.assertRaises(Exception):
+                loop.run_until_complete(executor.start(0, {}, claims[0]))
+            # the exception of a failed eager child is retrieved and logged
+            with self.assertLogs("numpywren.job_runner", level="ERROR"):
+                task = executor.start_eager(0, {}, claims[1])
+                loop.run_until_complete(asyncio.gather(task, loop=loop, return_exceptions=True))
+            assert(len(executor.eager_tasks) == 0)
+            # both leases are dropped and both slots handed back, once
+            assert(len(leases.leases) == 0)
+            executor.release(claims[0])
+            assert(shared_state["busy_workers"] == 0)
+            assert(len(shared_state["running_times"]) == 2)
+            assert(len(program.errors) == 2)
+        finally:
+            loop.close()
+
+    def test_failed_node_unpins(self):
+        class ClosedQueue(object):
+            async def put(self, item):
+                raise Exception("read queue closed")
+        loop = asyncio.new_event_loop()
+        try:
+            program = ReadyProgram(SlowMatrix(0))
+            cache = LRUCache()
+            shared_state = {"busy_workers": 1, "running_times": [], "last_busy_time": 0}
+            executor = LambdaPackExecutor(program, loop, cache, ClosedQueue(), leases=LeaseManager(loop), shared_state=shared_state)
+            claim = Claim(object(), types.SimpleNamespace(handle=0), time.time())
+            # an eager child fails after it took over its parent's pins
+            claim.pinned = [("parent", "bucket", (0, 0))]
+            cache.pin(claim.pinned)
+            with self.assertRaises(Exception):
+                loop.run_until_complete(executor.start(1, {}, claim))
+            assert(program.post_ops == [lp.PS.EXCEPTION])
+            assert(len(cache.pins) == 0)
+            assert(claim.pinned == [])
+            # unpinning twice never fails
+            cache.unpin([("parent", "bucket", (0, 0))])
+            assert(len(cache.pins) == 0)
+        finally:
+            loop.close()
+
+    def test_cancelled_node(self):
+        loop = asyncio.new_event_loop()
+        try:
+            program = ReadyProgram(SlowMatrix(0))
+            cache = LRUCache()
+            shared_state = {"busy_workers": 1, "running_times": [], "last_busy_time": 0}
+            # nothing consumes the read queue, the node waits on its reads
+            executor = LambdaPackExecutor(program, loop, cache, asyncio.Queue(loop=loop), leases=LeaseManager(loop), shared_state=shared_state)
+            claim = Claim(object(), types.SimpleNamespace(handle=0), time.time())
+            async def cancel():
+                task = loop.create_task(executor.start(0, {}, claim))
+                await asyncio.sleep(0.1, loop=loop)
+                assert(len(cache.pins) == 1)
+                task.cancel()
+                await asyncio.gather(task, loop=loop, return_exceptions=True)
+            loop.run_until_complete(cancel())
+            # a worker shutting down is not a failure of the node
+            assert(program.post_ops == [])
+            assert(program.errors == [])
+            assert(len(cache.pins) == 0)
+            assert(shared_state["busy_workers"] == 0)
+        finally:
+            loop.close()
+
+    def test_block_cache(self):
+        block = np.zeros((4, 4))
+        cache = LRUCache(max_bytes=3*block.nbytes)
+        for i in range(3):
+            cache[("A", "bucket", (i, 0))] = block
+        assert(cache.get(("A", "bucket", (0, 0))) is block)
+        assert(cache.get(("A", "bucket", (5, 0))) is None)
+        cache[("A", "bucket", (3, 0))] = block
+        # (1, 0) was the least recently used block
+        assert(("A", "bucket", (1, 0)) not in cache)
+        assert(cache.nbytes == 3*block.nbytes)
+        # pinned blocks outlive the budget until they are unpinned
+        pinned = [("A", "bucket", (0, 0)), ("A", "bucket", (2, 0))]
+        cache.pin(pinned)
+        for i in range(4, 6):
+            cache[("A", "bucket", (i, 0))] = block
+        assert(all([key in cache for key in pinned]))
+        assert(cache.nbytes == 3*block.nbytes)
+        # a node pins its blocks before they are read into the cache
+        pinned += [("A", "bucket", (5, 0)), ("A", "bucket", (6, 0))]
+        cache.pin(pinned[-2:])
+        cache[("A", "bucket", (6, 0))] = block
+        assert(cache.nbytes == 4*block.nbytes)
+        cache.unpin(pinned)
+        assert(cache.nbytes <= cache.max_bytes)
+        # blocks larger than the whole budget are never cached
+        cache[("B", "bucket", (0, 0))] = np.zeros((8, 8))
+        assert(("B", "bucket", (0, 0)) not in cache)
+        stats = cache.stats()
+        assert(stats["hits"] == 1 and stats["misses"] == 1)
+        assert(stats["evictions"] == 7 - len(cache))
+
+    def test_host_cache(self):
+        root = tempfile.mkdtemp()
+        loop = asyncio.new_event_loop()
+        try:
+            matrix = SlowMatrix(0.05)
+            # two workers on one host, the second one maps the blocks the
+            # first one read instead of going to the block store
+            for worker in range(2):
+                host_cache = HostBlockCache(1 << 20, root=root, namespace="program")
+                reads = [lp.RemoteRead(0, matrix, i, 0) for i in range(4)]
+                block = lp.InstructionBlock(reads + [lp.RemoteCall(0, add_blocks, reads, 1, ["0", "1", "2", "3"])])
+                run_pipeline(loop, [block], host_cache=host_cache)
+                assert(np.allclose(block.instrs[-1].results[0], np.eye(2)*6))
+                assert(all([x.host_cache is None for x in reads]))
+            assert(matrix.reads == 4)
+            assert(host_cache.stats()["hits"] == 4)
+        finally:
+            loop.close()
+            shutil.rmtree(root, ignore_errors=True)
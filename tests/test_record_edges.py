@@ -0,0 +1,55 @@
+from numpywren.lambdapack import record_edges, NS, PS
+import fakeredis
+import unittest
+
+
+def child_target(name, num_parents, parent):
+    return ("edge_{0}_{1}".format(parent, name), "edgesum_{0}".format(name), "node_{0}".format(name),
+            num_parents, NS.READY.value, NS.FINISHED.value)
+
+
+class RecordEdgesTestClass(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+
+    def test_diamond(self):
+        # a -> b, a -> c, b -> d, c -> d
+        ready = record_edges(self.client, "node_a", NS.POST_OP.value, [child_target("b", 1, "a"), child_target("c", 1, "a")])
+        assert(ready == [0, 1])
+        assert(int(self.client.get("node_a")) == NS.POST_OP.value)
+        assert(int(self.client.get("node_b")) == NS.READY.value)
+        ready = record_edges(self.client, "node_b", NS.POST_OP.value, [child_target("d", 2, "b")])
+        assert(ready == [])
+        assert(self.client.get("node_d") == None)
+        ready = record_edges(self.client, "node_c", NS.POST_OP.value, [child_target("d", 2, "c")])
+        assert(ready == [0])
+        assert(int(self.client.get("edgesum_d")) == 2)
+
+    def test_replay(self):
+        record_edges(self.client, "node_b", NS.POST_OP.value, [child_target("d", 2, "b")])
+        # replaying the same edge must not count twice
+        ready = record_edges(self.client, "node_b", NS.POST_OP.value, [child_target("d", 2, "b")])
+        assert(ready == [])
+        assert(int(self.client.get("edgesum_d")) == 1)
+        ready = record_edges(self.client, "node_c", NS.POST_OP.value, [child_target("d", 2, "c")])
+        assert(ready == [0])
+        # a replayed parent re-readies an unfinished child but never a finished one
+        assert(record_edges(self.client, "node_c", NS.POST_OP.value, [child_target("d", 2, "c")]) == [0])
+        self.client.set("node_d", NS.FINISHED.value)
+        assert(record_edges(self.client, "node_c", NS.POST_OP.value, [child_target("d", 2, "c")]) == [])
+
+    def test_terminators(self):
+        self.client.set("program", PS.RUNNING.value)
+        def terminator(name):
+            return ("edge_{0}_return".format(name), "program_return", "program", 2, "", PS.SUCCESS.value)
+        assert(record_edges(self.client, "node_x", NS.POST_OP.value, [terminator("x")]) == [])
+        assert(record_edges(self.client, "node_x", NS.POST_OP.value, [terminator("x")]) == [])
+        assert(int(self.client.get("program")) == PS.RUNNING.value)
+        assert(record_edges(self.client, "node_y", NS.POST_OP.value, [child_target("z", 1, "y"), terminator("y")]) == [0, 1])
+        # an empty ready status leaves setting the program's status to the caller
+        assert(int(self.client.get("program")) == PS.RUNNING.value)
+        assert(int(self.client.get("node_z")) == NS.READY.value)
+        # a terminator replayed before the program succeeded reports it again
+        assert(record_edges(self.client, "node_y", NS.POST_OP.value, [terminator("y")]) == [0])
+        self.client.set("program", PS.SUCCESS.value)
+        assert(record_edges(self.client, "node_y", NS.POST_OP.value, [terminator("y")]) == [])
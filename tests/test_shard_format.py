@@ -0,0 +1,145 @@
+from numpywren.matrix import BigMatrix
+from numpywren.block_store import LocalBlockStore
+from numpywren.exceptions import CorruptShardException
+from numpywren.shard_format import encode_block, decode_block, HEADER_SIZE, CODECS
+import numpy as np
+import asyncio
+import unittest
+import tempfile
+import shutil
+import io
+
+
+class ShardFormatTestClass(unittest.TestCase):
+    def test_roundtrip(self):
+        np.random.seed(0)
+        arrays = [np.random.randn(32, 16),
+                  np.asfortranarray(np.random.randn(16, 8)),
+                  np.random.randn(16, 16)[::2, 1:],
+                  np.arange(10, dtype=np.int32).reshape(1, 10, 1),
+                  np.array([[1 + 2j]]),
+                  np.zeros((4, 0))]
+        for X in arrays:
+            data = encode_block(X)
+            assert(len(data) == HEADER_SIZE + X.nbytes)
+            Y = decode_block(data)
+            assert(Y.dtype == X.dtype)
+            assert(Y.shape == X.shape)
+            assert(np.array_equal(X, Y))
+        X = np.asfortranarray(np.random.randn(16, 8))
+        assert(decode_block(encode_block(X)).flags.f_contiguous)
+
+    def test_npy_compat(self):
+        X = np.random.randn(8, 8)
+        outb = io.BytesIO()
+        np.save(outb, X)
+        assert(np.array_equal(decode_block(outb.getvalue()), X))
+        X_obj = np.array([{"a": 1}, None], dtype=object)
+        assert(decode_block(encode_block(X_obj))[0]["a"] == 1)
+
+    def test_checksum(self):
+        data = encode_block(np.ones((8, 8)))
+        data[HEADER_SIZE + 3] ^= 0xff
+        with self.assertRaises(CorruptShardException):
+            decode_block(data)
+        with self.assertRaises(CorruptShardException):
+            decode_block(encode_block(np.ones((8, 8)))[:-8])
+
+    def test_old_shards_readable(self):
+        root = tempfile.mkdtemp()
+        try:
+            store = LocalBlockStore(root)
+            X = np.random.randn(16, 16)
+            X_sharded = BigMatrix("shard_format_test", shape=X.shape, shard_sizes=(8, 8), bucket="test", store=store)
+            X_sharded.put_block(X[:8, :8], 0, 0)
+            outb = io.BytesIO()
+            np.save(outb, X[8:, :8])
+            store.put("test", X_sharded.__shard_idx_to_key__((1, 0)), outb.getvalue())
+            assert(np.array_equal(X_sharded.get_block(0, 0), X[:8, :8]))
+            assert(np.array_equal(X_sharded.get_block(1, 0), X[8:, :8]))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+class ShardCodecTestClass(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = LocalBlockStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_codecs(self):
+        X = np.tril(np.random.randn(256, 256))
+        for codec in ["zlib", "lz4", "zstd", "blosc"]:
+            if (not CODECS[codec].available): continue
+            data = encode_block(X, codec=codec)
+            assert(len(data) < X.nbytes)
+            Y = decode_block(data)
+            assert(np.array_equal(X, Y))
+            assert(Y.flags.writeable)
+
+    def test_heuristic(self):
+        # random data does not compress, tiny blocks are not worth it
+        X = np.random.randn(256, 256)
+        assert(len(encode_block(X, codec="zlib")) == HEADER_SIZE + X.nbytes)
+        X = np.zeros((4, 4))
+        assert(len(encode_block(X, codec="zlib")) == HEADER_SIZE + X.nbytes)
+
+    def test_matrix_codec(self):
+        X = np.triu(np.random.randn(512, 512))
+        X_sharded = BigMatrix("shard_codec_test", shape=X.shape, shard_sizes=(256, 256), bucket="test", store=self.store, codec="zlib", write_header=True)
+        stats = {}
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(X_sharded.put_block_async(X[:256, :256], loop, 0, 0, stats=stats))
+        assert(0 < stats["wire_bytes"] < X[:256, :256].nbytes)
+        X_sharded.put_block(X[:256, 256:], 0, 1)
+        X_sharded_2 = BigMatrix("shard_codec_test", bucket="test", store=self.store)
+        assert(X_sharded_2.codec == "zlib")
+        stats = {}
+        block = loop.run_until_complete(X_sharded_2.get_block_async(loop, 0, 0, stats=stats))
+        assert(np.array_equal(block, X[:256, :256]))
+        assert(0 < stats["wire_bytes"] < X[:256, :256].nbytes)
+        assert(np.array_equal(X_sharded_2.get_block(0, 1), X[:256, 256:]))
+        loop.close()
+
+    def test_unknown_codec(self):
+        with self.assertRaises(CorruptShardException):
+            BigMatrix("shard_codec_test", shape=(4, 4), shard_sizes=(2, 2), bucket="test", store=self.store, codec="gzip9")
+
+
+class ShardLayoutTestClass(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = LocalBlockStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_pack_roundtrip(self):
+        for shape in [(16, 16), (32, 16), (16, 32), (16, 16, 1)]:
+            X = np.random.randn(*shape)
+            M = X.reshape([d for d in shape if d != 1])
+            for layout, tri in [("lower", np.tril), ("upper", np.triu)]:
+                X_tri = tri(M).reshape(shape)
+                data = encode_block(X_tri, layout=layout)
+                assert(len(data) < HEADER_SIZE + X.nbytes)
+                assert(np.array_equal(decode_block(data), X_tri))
+            # not triangular, stored dense
+            assert(len(encode_block(X, layout="lower")) == HEADER_SIZE + X.nbytes)
+
+    def test_matrix_layout(self):
+        X = np.random.randn(64, 64)
+        L = np.linalg.cholesky(X.dot(X.T) + 64*np.eye(64))
+        O = BigMatrix("shard_layout_test", shape=L.shape, shard_sizes=(32, 32), bucket="test", store=self.store)
+        loop = asyncio.new_event_loop()
+        stats = {}
+        loop.run_until_complete(O.put_block_async(L[:32, :32], loop, 0, 0, stats=stats, layout="lower"))
+        assert(stats["wire_bytes"] < L[:32, :32].nbytes*0.6)
+        # writing through a transposed view flips the triangle
+        stats = {}
+        loop.run_until_complete(O.T.put_block_async(L[32:, 32:].T, loop, 1, 1, stats=stats, layout="upper"))
+        assert(stats["wire_bytes"] < L[32:, 32:].nbytes*0.6)
+        loop.close()
+        assert(np.array_equal(O.get_block(0, 0), L[:32, :32]))
+        assert(np.array_equal(O.get_block(1, 1), L[32:, 32:]))
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+import unittest
+
+import fakeredis
+
+from numpywren.lambdapack import set_many, node_message, NS
+from numpywren.task_queue import send_message_batches, SQS_BATCH_SIZE
+
+
+class LocalSQS(object):
+    ''' In memory stand in for an SQS client with a fixed latency per request '''
+    def __init__(self, latency=0.002, fail_every=None):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.messages = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.messages.append(MessageBody)
+        return {}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert(len(Entries) <= SQS_BATCH_SIZE)
+        time.sleep(self.latency)
+        failed = []
+        with self.lock:
+            self.calls += 1
+            for entry in Entries:
+                if (self.fail_every is not None and self.calls % self.fail_every == 0):
+                    failed.append({"Id": entry["Id"], "SenderFault": False, "Code": "InternalError"})
+                else:
+                    self.messages.append(entry["MessageBody"])
+        return {"Successful": [], "Failed": failed}
+
+
+class StartTestClass(unittest.TestCase):
+    def test_send_message_batches(self):
+        sqs = LocalSQS(latency=0)
+        bodies = [node_message(0, {"i": i}) for i in range(95)]
+        calls = send_message_batches(sqs, "queue", bodies, num_threads=4)
+        assert(calls == 10)
+        assert(sorted(sqs.messages) == sorted(bodies))
+        assert(json.loads(sqs.messages[0])[0] == 0)
+
+    def test_send_message_batches_retry(self):
+        sqs = LocalSQS(latency=0, fail_every=3)
+        bodies = [node_message(1, {"i": i}) for i in range(100)]
+        send_message_batches(sqs, "queue", bodies, num_threads=1)
+        assert(sorted(sqs.messages) == sorted(bodies))
+
+    def test_set_many(self):
+        client = fakeredis.FakeStrictRedis()
+        keys = ["node_{0}".format(i) for i in range(2500)]
+        set_many(client, keys, NS.READY.value)
+        assert(all([int(x) == NS.READY.value for x in client.mget(keys)]))
+
+    def test_start_benchmark(self):
+        bodies = [node_message(0, {"i": i, "j": j}) for i in range(10) for j in range(50)]
+        sqs = LocalSQS()
+        t = time.time()
+        for body in bodies:
+            sqs.send_message(QueueUrl="queue", MessageBody=body)
+        e = time.time()
+        print("send_message", len(bodies), "messages", e - t)
+        sqs = LocalSQS()
+        t = time.time()
+        send_message_batches(sqs, "queue", bodies, num_threads=16)
+        e = time.time()
+        print("send_message_batches", len(bodies), "messages", e - t, "calls", sqs.calls)
+        assert(sqs.calls == len(bodies)//SQS_BATCH_SIZE)
@@ -8,7 +8,7 @@ from numpywren.matrix import BigMatrix
 import numpy as np
 from numpywren.matrix_init import shard_matrix
 from numpywren.algs import *
-from numpywren.compiler import lpcompile, walk_program, find_starters, find_terminators
+from numpywren.compiler import lpcompile, walk_program, find_starters, find_terminators, count_terminators, recursive_range_walk, recursive_range_walk_symbolic, copy_scope
 from test_dependency_analyze import dummy_matrix
 
 def test_cholesky():
@@ -42,6 +42,45 @@ def test_gemm():
     assert len(find_starters(program, input_matrices=["A", "B"]))  == M*N*K
     assert len(find_terminators(program, output_matrices=["Out"]))  == M*N
 
+def verify_range_walk(program):
+    for p_idx in program.keys():
+        scope = program[p_idx].scope
+        symbolic = [{k: int(v) for k, v in x.items()} for x in recursive_range_walk_symbolic(copy_scope(scope))]
+        assert recursive_range_walk(scope) == symbolic
+
+def test_range_walk():
+    A = dummy_matrix()
+    B = dummy_matrix()
+    verify_range_walk(lpcompile(SimpleTestNonLinear)(A,B,8))
+    verify_range_walk(lpcompile(CHOLESKY)(A,B,dummy_matrix(num_dims=3),12,0))
+    verify_range_walk(lpcompile(TSQR)(dummy_matrix(num_dims=1),A,B,dummy_matrix(),13))
+    verify_range_walk(lpcompile(GEMM)(A,B,3,4,17,dummy_matrix(num_dims=4),dummy_matrix(num_dims=3)))
+    verify_range_walk(lpcompile(QR)(A,B,dummy_matrix(),dummy_matrix(),dummy_matrix(num_dims=4),12,0))
+    program = lpcompile(CHOLESKY)(A,B,dummy_matrix(num_dims=3),20,0)
+    assert count_terminators(program, ["O"]) == len(find_terminators(program, ["O"]))
+
+def test_range_walk_benchmark():
+    A = dummy_matrix(num_dims=2)
+    B = dummy_matrix(num_dims=2)
+    M = 32
+    program = lpcompile(GEMM)(A,B,M,M,M,dummy_matrix(num_dims=4),dummy_matrix(num_dims=3))
+    find_starters(program, input_matrices=["A", "B"])
+    t = time.time()
+    starters = find_starters(program, input_matrices=["A", "B"])
+    num_terminators = count_terminators(program, output_matrices=["Out"])
+    e = time.time()
+    print("starters + terminators", len(starters), num_terminators, e - t)
+    t = time.time()
+    fast = recursive_range_walk(program[0].scope)
+    fast_time = time.time() - t
+    t = time.time()
+    symbolic = recursive_range_walk_symbolic(copy_scope(program[0].scope))
+    symbolic_time = time.time() - t
+    print("range walk of starters", fast_time, "symbolic", symbolic_time)
+    assert len(fast) == len(symbolic) == M*M*M
+    # loose, the compiled walk is several times faster on any machine
+    assert fast_time < symbolic_time
+
 
 if __name__ == "__main__":
     test_qr()
@@ -0,0 +1,264 @@
+import asyncio
+import pickle
+import time
+import unittest
+
+import fakeredis
+
+from numpywren.lambdapack import node_message
+from numpywren.task_queue import InMemoryTaskQueue, RedisTaskQueue, TaskFetcher, LeaseManager, get_task_queue
+
+
+class LocalControlPlane(object):
+    def __init__(self):
+        self.client = fakeredis.FakeStrictRedis()
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class RecordingTaskQueue(InMemoryTaskQueue):
+    ''' Remembers how long each receive call was allowed to wait '''
+    def __init__(self, name):
+        super().__init__(name)
+        self.waits = []
+
+    async def receive_batch(self, max_messages=1, visibility_timeout=200, wait_time=0, loop=None):
+        self.waits.append(wait_time)
+        return await super().receive_batch(max_messages=max_messages, visibility_timeout=visibility_timeout,
+                                           wait_time=wait_time, loop=loop)
+
+
+class TaskQueueTests(object):
+    def test_send_receive_delete(self):
+        bodies = [node_message(0, {"i": i}) for i in range(25)]
+        self.queue.send_batch(bodies)
+        tasks = run(self.queue.receive_batch(max_messages=10))
+        assert(len(tasks) == 10)
+        tasks += run(self.queue.receive_batch(max_messages=100))
+        assert(sorted([t.body for t in tasks]) == sorted(bodies))
+        assert(len(set([t.message_id for t in tasks])) == len(bodies))
+        for t in tasks:
+            run(self.queue.delete(t))
+        assert(run(self.queue.receive_batch(max_messages=10, visibility_timeout=0)) == [])
+
+    def test_visibility_timeout(self):
+        self.queue.send_batch(["a"])
+        task, = run(self.queue.receive_batch(visibility_timeout=0.2))
+        assert(run(self.queue.receive_batch()) == [])
+        time.sleep(0.3)
+        redelivered, = run(self.queue.receive_batch(visibility_timeout=0.2))
+        assert(redelivered.body == "a")
+        run(self.queue.extend_visibility(redelivered, 10))
+        time.sleep(0.3)
+        assert(run(self.queue.receive_batch()) == [])
+        run(self.queue.delete(redelivered))
+
+    def test_extend_visibility_batch(self):
+        self.queue.send_batch(["a", "b", "c"])
+        tasks = run(self.queue.receive_batch(max_messages=3, visibility_timeout=0.2))
+        run(self.queue.extend_visibility_batch(tasks[:2], 10))
+        time.sleep(0.3)
+        redelivered = run(self.queue.receive_batch(max_messages=3))
+        assert([t.body for t in redelivered] == [tasks[2].body])
+        run(self.queue.release(tasks[:2]))
+        assert(len(run(self.queue.receive_batch(max_messages=3))) == 2)
+
+    def test_wait_time(self):
+        t = time.time()
+        assert(run(self.queue.receive_batch(wait_time=0.2)) == [])
+        assert(time.time() - t >= 0.2)
+
+    def test_destroy(self):
+        self.queue.send_batch(["a", "b"])
+        self.queue.destroy()
+        self.queue.create()
+        assert(run(self.queue.receive_batch(max_messages=10)) == [])
+
+
+class InMemoryTaskQueueTest(TaskQueueTests, unittest.TestCase):
+    def setUp(self):
+        self.queue = get_task_queue("memory", "test_queue")
+        self.queue.create()
+
+    def tearDown(self):
+        self.queue.destroy()
+
+    def test_pickle(self):
+        queue = pickle.loads(pickle.dumps(self.queue))
+        queue.send_batch(["a"])
+        task, = run(self.queue.receive_batch())
+        assert(task.body == "a")
+        assert(len(queue) == 1)
+
+
+class RedisTaskQueueTest(TaskQueueTests, unittest.TestCase):
+    def setUp(self):
+        self.queue = get_task_queue("redis", "test_queue", control_plane=LocalControlPlane())
+        self.queue.create()
+
+    def tearDown(self):
+        self.queue.destroy()
+
+
+class TaskFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.queues = [get_task_queue("memory", "test_queue_{0}".format(i)) for i in range(2)]
+        for q in self.queues:
+            q.create()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        for q in self.queues:
+            q.destroy()
+        self.loop.close()
+
+    def test_prefetch(self):
+        self.queues[0].send_batch(["low_{0}".format(i) for i in range(20)])
+        self.queues[1].send_batch(["high_{0}".format(i) for i in range(3)])
+        fetcher = TaskFetcher(self.queues, self.loop, buffer_size=4, wait_time=0.1)
+        async def claim(n):
+            fetcher.start()
+            claimed = []
+            for i in range(n):
+                queue, task, _ = await fetcher.get(timeout=1)
+                await queue.delete(task, loop=self.loop)
+                claimed.append(task.body)
+            # let the fetcher refill the buffer
+            await asyncio.sleep(0.05, loop=self.loop)
+            buffered = fetcher.buffer.qsize()
+            assert(buffered > 0)
+            await fetcher.close()
+            assert(fetcher.released == buffered)
+            return claimed
+        claimed = self.loop.run_until_complete(claim(13))
+        assert(claimed[:3] == ["high_0", "high_1", "high_2"])
+        assert(claimed[3:] == ["low_{0}".format(i) for i in range(10)])
+        # unclaimed tasks went back to the queue and are visible right away
+        assert(len(self.queues[0]) == 10)
+        tasks = run(self.queues[0].receive_batch(max_messages=10))
+        assert(len(tasks) == 10)
+
+    def test_batched_receives(self):
+        self.queues[0].send_batch(["low_{0}".format(i) for i in range(40)])
+        fetcher = TaskFetcher(self.queues[:1], self.loop, buffer_size=10, wait_time=0.1)
+        async def claim(n):
+            fetcher.start()
+            for i in range(n):
+                queue, task, _ = await fetcher.get(timeout=1)
+                await queue.delete(task, loop=self.loop)
+            await fetcher.close()
+        self.loop.run_until_complete(claim(40))
+        print("receive calls", fetcher.receive_calls, "for", fetcher.received, "tasks")
+        assert(fetcher.received == 40)
+        assert(fetcher.receive_calls <= 40//4)
+
+    def test_get_timeout(self):
+        fetcher = TaskFetcher(self.queues, self.loop, buffer_size=2, wait_time=0.1)
+        async def get():
+            fetcher.start()
+            claimed = await fetcher.get(timeout=0.3)
+            await fetcher.close()
+            return claimed
+        assert(self.loop.run_until_complete(get()) is None)
+        assert(fetcher.closed)
+        assert(self.loop.run_until_complete(fetcher.get()) is None)
+
+
+    def test_poll_all_queues(self):
+        queues = [RecordingTaskQueue("test_queue_recording_{0}".format(i)) for i in range(2)]
+        for q in queues:
+            q.create()
+        fetcher = TaskFetcher(queues, self.loop, buffer_size=2, wait_time=0.1)
+        async def claim():
+            fetcher.start()
+            assert(await fetcher.get(timeout=0.5) is None)
+            # a task sent to the high priority queue while idle is still received
+            queues[1].send_batch(["high_0"])
+            queue, task, _ = await fetcher.get(timeout=1)
+            await fetcher.close()
+            return task.body
+        try:
+            assert(self.loop.run_until_complete(claim()) == "high_0")
+            # idle rounds long poll every queue, not just the lowest priority one
+            assert(all([max(q.waits) == 0.1 for q in queues]))
+            assert(all([w <= 0.1 for q in queues for w in q.waits]))
+        finally:
+            for q in queues:
+                q.destroy()
+
+    def test_buffered_tasks_leased(self):
+        self.queues[0].send_batch(["task_{0}".format(i) for i in range(4)])
+        leases = LeaseManager(self.loop, min_timeout=0.3)
+        fetcher = TaskFetcher(self.queues[:1], self.loop, buffer_size=4, wait_time=0.1, visibility_timeout=0.3, leases=leases)
+        async def buffer():
+            leases.start()
+            fetcher.start()
+            # outlive the receive's visibility timeout before claiming a task
+            await asyncio.sleep(1.0, loop=self.loop)
+            assert(await self.queues[0].receive_batch() == [])
+            assert(len(leases.leases) == 4)
+            queue, task, _ = await fetcher.get(timeout=1)
+            await fetcher.close()
+            await leases.close()
+            return task
+        claimed = self.loop.run_until_complete(buffer())
+        # tasks handed back are no longer leased, the claimed one still is
+        assert(list(leases.leases.values())[0][1] == claimed)
+        assert(len(leases.leases) == 1)
+        assert(len(leases.durations) == 0)
+        assert(len(run(self.queues[0].receive_batch(max_messages=4))) == 3)
+
+
+class LeaseManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = get_task_queue("memory", "test_queue")
+        self.queue.create()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.queue.destroy()
+        self.loop.close()
+
+    def test_leases(self):
+        self.queue.send_batch(["task_{0}".format(i) for i in range(15)])
+        leases = LeaseManager(self.loop, min_timeout=0.3)
+        async def work():
+            leases.start()
+            tasks = await self.queue.receive_batch(max_messages=15, visibility_timeout=0.3)
+            for task in tasks:
+                leases.add(self.queue, task, time.time() + 0.3)
+            # outlive the initial visibility timeout several times
+            await asyncio.sleep(1.0, loop=self.loop)
+            assert(await self.queue.receive_batch() == [])
+            for task in tasks:
+                leases.remove(self.queue, task)
+                await self.queue.delete(task, loop=self.loop)
+            await leases.close()
+        self.loop.run_until_complete(work())
+        # every tick extends all the tasks with one call
+        assert(leases.extended >= 15*2)
+        assert(leases.extend_calls == leases.extended//15)
+        assert(leases.lease_timeout() >= 2.0)
+        assert(len(self.queue) == 0)
+
+    def test_lease_timeout(self):
+        leases = LeaseManager(self.loop, min_timeout=60, max_timeout=1000)
+        assert(leases.lease_timeout() == 60)
+        leases.durations.extend([10, 45])
+        assert(leases.lease_timeout() == 90)
+        leases.durations.append(5000)
+        assert(leases.lease_timeout() == 1000)
+
+
+def test_unknown_task_queue():
+    try:
+        get_task_queue("kafka", "test_queue")
+    except ValueError:
+        return
+    assert(False)